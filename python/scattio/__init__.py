@@ -119,6 +119,10 @@ Various raw format readers are available:
 
 These readers preserve the namespace of the original file format.  There is
 little consistency between the interfaces.
+
+The readers open files through :mod:`fileio`, so files can be gzip, bzip2
+or xz compressed, or read from within a .zip or .tar bundle using a path
+such as "bundle.zip/run/file.ng7".
 """
 
 from formats import load
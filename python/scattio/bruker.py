@@ -1,6 +1,8 @@
 import struct
 import numpy
 
+from . import fileio
+
 MEAS_FLAG = {
     0: 'unmeasured',
     1: 'measured',
@@ -269,9 +271,15 @@ EXTRA_RECORD = {
     }
 
 
+def sniff(head, size):
+    """
+    Return True if the start of the file *head* has the Bruker RAW magic.
+    """
+    return head.startswith("RAW1.01")
+
 def load(filename):
     # pull in the entire file
-    with open(filename, 'rb') as f:
+    with fileio.open(filename) as f:
         data = f.read()
     if data[:7] != "RAW1.01":
         raise ValueError("Could not load %r: not a Bruker XRD RAW file"%
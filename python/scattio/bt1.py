@@ -3,6 +3,8 @@ import time
 
 import numpy
 
+from . import fileio
+
 #==== fpx file ====
 # Motor no.  4    Intensity at Detector:    1Dec 10 2010 16:17
 #    0.9990          5684
@@ -49,10 +51,10 @@ class ICPBT1(object):
         ])
     def __init__(self, filename):
         basename = os.path.basename(filename)
-        if os.path.getsize(filename) == 0:
+        if fileio.getsize(filename) == 0:
             raise ValueError('empty file')
 
-        with open(filename, 'rt') as file:
+        with fileio.open(filename) as file:
             self.path = filename
             self._read_file(file)
 
@@ -0,0 +1,300 @@
+# This program is public domain
+"""
+Catalog of raw instrument data files.
+
+The catalog records the run metadata from the header of each data file
+in a set of directories, so that runs can be selected without opening
+every file::
+
+    from scattio.catalog import Catalog
+    cat = Catalog('runs.db')
+    cat.update('/data/ng7', '/data/bt7')
+    for run in cat.query(instrument='NG7', wavelength=(4.7,4.8)):
+        print run['path'], run['date'], run['sample']
+
+The headers are read by :func:`formats.summary`, so any format with a
+registered header summary can be cataloged.  Files which are not a
+recognized format are ignored.  The catalog is stored in an SQLite
+database, with one row per file and indexed columns for the common
+metadata (see :data:`COLUMNS`).  The remaining header values are stored
+as JSON and can also be used in queries.
+
+Updates are incremental: only the files whose size or modification time
+has changed since the last update are read again, and files which have
+been removed are dropped from the catalog.
+"""
+__all__ = ["Catalog"]
+
+import os
+import json
+import time
+import sqlite3
+
+from . import formats
+
+# Indexed metadata columns
+COLUMNS = ('format', 'instrument', 'run', 'date', 'wavelength',
+           'temperature', 'sample', 'comment', 'points')
+_INDEXED = ('instrument', 'run', 'date', 'wavelength', 'temperature',
+            'sample')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    path TEXT PRIMARY KEY,
+    mtime REAL,
+    size INTEGER,
+    format TEXT,
+    instrument TEXT,
+    run TEXT,
+    date TEXT,
+    wavelength REAL,
+    temperature REAL,
+    sample TEXT,
+    comment TEXT,
+    points INTEGER,
+    metadata TEXT,
+    error TEXT
+);
+""" + "".join("CREATE INDEX IF NOT EXISTS runs_%s ON runs(%s);\n"%(c,c)
+              for c in _INDEXED)
+
+_INSERT = "INSERT OR REPLACE INTO runs VALUES (%s)"%",".join("?"*(len(COLUMNS)+5))
+
+class Catalog(object):
+    """
+    Catalog of data files stored in the SQLite database *filename*.
+
+    The default filename ":memory:" keeps the catalog in memory.
+    """
+    def __init__(self, filename=":memory:"):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def update(self, *paths):
+        """
+        Add the data files in *paths* to the catalog.
+
+        Each path may be a file or a directory, which is searched
+        recursively.  Only new or modified files are read.  Files which
+        were in a directory when it was last cataloged but are no longer
+        there are removed.
+
+        Returns a dictionary with the number of files which were *added*,
+        *updated*, *unchanged*, *removed* or *failed*.  Files which fail
+        to load are recorded with the error message, and are not tried
+        again until they change.
+        """
+        counts = dict.fromkeys(('added', 'updated', 'unchanged', 'removed',
+                                'failed'), 0)
+        for top in paths:
+            top = os.path.abspath(top)
+            known = self._known(top)
+            rows = []
+            for path in _files(top):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue # removed while walking
+                stamp = known.pop(path, None)
+                if stamp == (st.st_mtime, st.st_size):
+                    counts['unchanged'] += 1
+                    continue
+                row = _read_row(path, st)
+                if row is None:
+                    # Not a data file; drop it if it was cataloged before
+                    if stamp is not None: known[path] = stamp
+                    continue
+                counts['failed' if row[-1] else
+                       'added' if stamp is None else 'updated'] += 1
+                rows.append(row)
+            with self.db:
+                self.db.executemany(_INSERT, rows)
+                self.db.executemany("DELETE FROM runs WHERE path=?",
+                                    [(p,) for p in known])
+            counts['removed'] += len(known)
+        return counts
+
+    def _known(self, top):
+        """
+        Return {path: (mtime, size)} for the cataloged files under *top*.
+        """
+        prefix = top if top.endswith(os.sep) else top+os.sep
+        cursor = self.db.execute(
+            "SELECT path, mtime, size FROM runs"
+            " WHERE path=? OR substr(path,1,?)=?",
+            (top, len(prefix), prefix))
+        return dict((p,(m,s)) for p,m,s in cursor)
+
+    def query(self, **criteria):
+        """
+        Return the metadata of the runs matching *criteria*, ordered by
+        path.
+
+        Each criterion is *key=value*, where value is a single value, a
+        (low, high) range with None for an open end, a glob pattern
+        such as 'jul04*' for strings, or None for missing values.  Keys
+        in :data:`COLUMNS` are looked up in the database index, and other
+        header keys are checked after loading the metadata.
+
+        Each run is returned as a dictionary with the *path* of the file
+        and the header values from :func:`formats.summary`.  Files which
+        failed to load are not returned.
+        """
+        where, args, extra = ["error IS NULL"], [], {}
+        for key, value in criteria.items():
+            if key not in COLUMNS:
+                extra[key] = value
+            elif value is None:
+                where.append("%s IS NULL"%key)
+            elif isinstance(value, tuple):
+                low, high = value
+                if low is not None:
+                    where.append("%s >= ?"%key)
+                    args.append(low)
+                if high is not None:
+                    where.append("%s <= ?"%key)
+                    args.append(high)
+            elif isinstance(value, basestring) and _is_glob(value):
+                where.append("%s GLOB ?"%key)
+                args.append(value)
+            else:
+                where.append("%s = ?"%key)
+                args.append(value)
+        cursor = self.db.execute(
+            "SELECT path, metadata FROM runs WHERE %s ORDER BY path"
+            %" AND ".join(where), args)
+        result = []
+        for path, metadata in cursor:
+            run = json.loads(metadata)
+            if all(_matches(run.get(k, None), v) for k,v in extra.items()):
+                run['path'] = path
+                result.append(run)
+        return result
+
+    def failures(self):
+        """
+        Return the list of (path, error) for files which failed to load.
+        """
+        return list(self.db.execute(
+            "SELECT path, error FROM runs WHERE error IS NOT NULL"
+            " ORDER BY path"))
+
+def _files(top):
+    if not os.path.isdir(top):
+        if os.path.exists(top): yield top
+        return
+    for root, dirs, files in os.walk(top):
+        dirs.sort()
+        for f in sorted(files):
+            yield os.path.join(root, f)
+
+def _read_row(path, st):
+    """
+    Return the database row for a data file, or None if it is not in a
+    format which can be summarized.
+    """
+    try:
+        formats.SUMMARIES.lookup(path)
+    except ValueError:
+        return None
+    try:
+        metadata = formats.summary(path)
+    except Exception, exc:
+        values = [None]*len(COLUMNS) + [None, "%s: %s"%(type(exc).__name__,exc)]
+    else:
+        metadata = dict((str(k), _jsonable(v)) for k,v in metadata.items())
+        values = ([metadata[k] for k in COLUMNS]
+                  + [json.dumps(metadata, sort_keys=True), None])
+    return tuple([path, st.st_mtime, st.st_size] + values)
+
+def _jsonable(value):
+    if hasattr(value, 'item'): value = value.item() # numpy scalars
+    if isinstance(value, str):
+        return value.decode('latin-1')
+    if value is None or isinstance(value, (unicode, int, long, float, bool)):
+        return value
+    return str(value)
+
+def _is_glob(value):
+    return '*' in value or '?' in value or '[' in value
+
+def _matches(actual, value):
+    if value is None:
+        return actual is None
+    elif actual is None:
+        return False
+    elif isinstance(value, tuple):
+        low, high = value
+        return (low is None or actual >= low) and (high is None or actual <= high)
+    elif isinstance(value, basestring) and _is_glob(value):
+        import fnmatch
+        return fnmatch.fnmatchcase(unicode(actual), value)
+    else:
+        return actual == value
+
+_QBUFFER = """\
+'qscan001.ng1' 'Jan 12 2005 10:20' 'Q'        1.    1  'NEUT'   3  'RAW'
+  Filename         Date            Scan       Mon    Prf  Base   #pts  Type
+Q scan
+   40   40   40   40    25.0   25.0   25.0    1  0  0  90.0    0  0  1
+ Collimation      Mosaic    Orientation
+    3.837    3.837    6.300   90.000   90.000  120.000
+ Lattice   a  b  c   alpha  beta  gamma
+    0.000    0.000   14.700    3.354    3.354  295.000    0.000
+ E-center  Delta-E  Ef  Fixed:  EF  M-dsp  A-dsp  T-start  T-incr
+    1.000    0.000    0.000    0.010    0.000    0.000    0.000
+ Q-center  Q-step  H-field
+  Q(x)     Q(y)     Q(z)     MIN      #1 COUNTS
+  1.000    0.000    0.000    1.00     12
+  1.010    0.000    0.000    1.00     15
+  1.020    0.000    0.000    1.00     11
+"""
+
+def test():
+    import shutil, tempfile
+    from .utils import example
+    tempdir = tempfile.mkdtemp()
+    try:
+        cat = Catalog(os.path.join(tempdir, 'catalog.db'))
+        ng7 = os.path.dirname(example('ng7','jul04031.ng7'))
+        bt7 = os.path.dirname(example('bt7','TbMnO3_85000.bt7'))
+        sans = os.path.join(tempdir, 'sans')
+        os.mkdir(sans)
+        for f in 'SILIC001.SA3_SRK_S101', 'SILIC002.SA3_SRK_S102', 'README':
+            shutil.copy2(example('sans',f), sans)
+        # Q-buffer ICP header, which differs from the I and R buffers
+        with open(os.path.join(sans, 'qscan001.ng1'), 'w') as fid:
+            fid.write(_QBUFFER)
+        counts = cat.update(ng7, bt7, sans)
+        assert counts['added'] == 12 and counts['failed'] == 0, counts
+
+        # Query by indexed columns, ranges, patterns and other header fields
+        runs = cat.query(instrument='NG7', wavelength=(4.7,4.8))
+        assert [r['run'] for r in runs] == ['jul04031.ng7', 'mar06036.ng7']
+        assert len(cat.query(run='TbMnO3_8500[0-2]')) == 3
+        assert len(cat.query(format='NCNR SANS', temperature=(None,0))) == 2
+        assert [r['run'] for r in cat.query(ExptID='16363')] == ['largeq_90397']
+        qscan = cat.query(scantype='Q')
+        assert [(r['run'], r['temperature']) for r in qscan] == [('qscan001.ng1', 295.)]
+
+        # Incremental update
+        counts = cat.update(ng7, bt7, sans)
+        assert counts['unchanged'] == 12 and counts['added'] == 0, counts
+        path = os.path.join(sans, 'SILIC001.SA3_SRK_S101')
+        os.utime(path, (time.time(), time.time()+10))
+        os.remove(os.path.join(sans, 'SILIC002.SA3_SRK_S102'))
+        with open(os.path.join(sans, 'BAD.SA3_SRK_S103'), 'wb') as fid:
+            fid.write('x'*33316)
+        counts = cat.update(sans)
+        assert (counts['updated'], counts['removed'], counts['failed']) == (1,1,1)
+        assert len(cat.failures()) == 1
+        assert len(cat.query(format='NCNR SANS')) == 1
+        cat.close()
+    finally:
+        shutil.rmtree(tempdir)
+
+if __name__ == "__main__": test()
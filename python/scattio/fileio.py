@@ -0,0 +1,318 @@
+# This program is public domain
+"""
+Read access to raw data files.
+
+All the readers in the package open their files through :func:`open`,
+which chooses the access path for the file:
+
+* large plain files are memory mapped, so bulk parsers can work on the
+  whole file without copying it, and small ones are read in one call,
+* files ending in .gz, .bz2 or .xz are decompressed in one go into
+  memory rather than being read through the line by line decompressors,
+* files inside .zip or .tar experiment bundles are read directly from
+  the bundle, using a path such as *bundle.zip/run/file.ng7*, and are
+  themselves decompressed if they end in .gz, .bz2 or .xz.
+
+The returned :class:`DataFile` supports *read*, *readline*, *seek*,
+*tell* and iteration over lines like an ordinary file opened in binary
+mode, and *buffer* gives the whole contents for bulk tokenizing::
+
+    with fileio.open(path) as fid:
+        header = fid.readline()
+        values = numpy.fromstring(fid.read(), sep=' ')
+
+Reading .xz files requires the lzma module (python 3 or backports.lzma).
+"""
+__all__ = ["open", "DataFile", "head", "getsize", "stat", "exists"]
+
+import os
+import mmap
+import zlib
+import struct
+import bz2
+import gzip
+import tarfile
+import zipfile
+from cStringIO import StringIO
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+_open = open
+
+# Plain files at least this size are memory mapped rather than read
+MMAP_BYTES = 2**20
+# Compressed file extensions and bundle file extensions
+_COMPRESSED = ('.gz', '.bz2', '.xz')
+_BUNDLES = ('.zip', '.tar', '.tgz', '.tar.gz', '.tbz2', '.tar.bz2')
+
+class DataFile(object):
+    """
+    Contents of a data file, read like a file opened in binary mode.
+
+    *name* is the path to the file and *buffer* is the whole contents,
+    either an mmap or a string.
+    """
+    def __init__(self, name, buffer):
+        self.name = name
+        self.buffer = buffer
+        if isinstance(buffer, mmap.mmap):
+            self._stream = buffer
+        else:
+            self._stream = StringIO(buffer)
+        self.closed = False
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def read(self, size=-1):
+        position = self._stream.tell()
+        if size < 0 and position == 0 and isinstance(self.buffer, str):
+            # Whole file; return the contents without copying them
+            self._stream.seek(0, 2)
+            return self.buffer
+        if size < 0:
+            size = len(self.buffer) - position
+        return self._stream.read(size)
+
+    def readline(self):
+        return self._stream.readline()
+
+    def readlines(self):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self._stream.readline, '')
+
+    def seek(self, offset, whence=0):
+        self._stream.seek(offset, whence)
+
+    def tell(self):
+        return self._stream.tell()
+
+    def close(self):
+        if not self.closed and isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def open(path, mmap_bytes=None):
+    """
+    Open the data file *path* for reading, returning a :class:`DataFile`.
+
+    Plain files of at least *mmap_bytes*, or :data:`MMAP_BYTES` if it is
+    None, are memory mapped.  Use *mmap_bytes=0* to map files of any size.
+
+    Raises IOError if the file does not exist or can't be decompressed.
+    """
+    archive, member = _split_bundle(path)
+    if member is not None:
+        return DataFile(path, _decompress(member, _read_member(archive, member)))
+    elif path.endswith(_COMPRESSED):
+        with _open(path, 'rb') as fid:
+            return DataFile(path, _decompress(path, fid.read()))
+    if mmap_bytes is None: mmap_bytes = MMAP_BYTES
+    with _open(path, 'rb') as fid:
+        buffer = None
+        if os.fstat(fid.fileno()).st_size >= mmap_bytes:
+            try:
+                buffer = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error):
+                pass # special files can't be mapped
+        if buffer is None:
+            buffer = fid.read()
+    return DataFile(path, buffer)
+
+def head(path, size):
+    """
+    Return up to the first *size* bytes of the data in *path*.
+
+    Only the start of compressed files is decompressed, so this is much
+    cheaper than :func:`open` for checking the file type.  Gzip files are
+    recognized by their signature even without the .gz extension.
+    """
+    chunk = max(size, 2**16)
+    archive, member = _split_bundle(path)
+    if member is not None:
+        start = _read_member(archive, member, size=chunk)
+        name = member
+    else:
+        with _open(path, 'rb') as fid:
+            start = fid.read(chunk)
+        name = path
+    if name.endswith('.gz') or start.startswith('\x1f\x8b'):
+        start = zlib.decompressobj(16+zlib.MAX_WBITS).decompress(start, size)
+    elif name.endswith('.bz2'):
+        try:
+            start = bz2.BZ2Decompressor().decompress(start)
+        except EOFError:
+            pass
+    elif name.endswith('.xz'):
+        start = _lzma().LZMADecompressor().decompress(start)
+    return start[:size]
+
+def getsize(path, decompress=True):
+    """
+    Return the size of the data in *path* after decompression.
+
+    The size is taken from the file system, the bundle index or the gzip
+    trailer where possible.  Otherwise, as for .bz2 and .xz files, the
+    whole file is decompressed to find its size, unless *decompress* is
+    False, in which case None is returned.
+    """
+    archive, member = _split_bundle(path)
+    if member is None and not path.endswith(_COMPRESSED):
+        return os.path.getsize(path)
+    elif member is not None and not member.endswith(_COMPRESSED):
+        return _member_info(archive, member)
+    elif member is None and path.endswith('.gz'):
+        # The gzip trailer holds the data size modulo 2**32
+        with _open(path, 'rb') as fid:
+            fid.seek(-4, 2)
+            return struct.unpack('<I', fid.read(4))[0]
+    elif not decompress:
+        return None
+    with open(path) as fid:
+        return len(fid)
+
+def stat(path):
+    """
+    Return os.stat for *path*, or for the bundle containing it.
+    """
+    archive, _ = _split_bundle(path)
+    return os.stat(archive)
+
+def exists(path):
+    """
+    Return True if *path* is a file or a file in a bundle.
+    """
+    archive, member = _split_bundle(path)
+    if member is None:
+        return os.path.isfile(path)
+    try:
+        _member_info(archive, member)
+    except IOError:
+        return False
+    return True
+
+def _split_bundle(path):
+    """
+    Return (bundle, member) if *path* is within a zip or tar file, or
+    (path, None) if it is not.
+    """
+    if os.path.exists(path):
+        return path, None
+    parts = []
+    archive = path
+    while True:
+        archive, tail = os.path.split(archive)
+        if not tail:
+            return path, None
+        parts.insert(0, tail)
+        if archive.lower().endswith(_BUNDLES) and os.path.isfile(archive):
+            return archive, "/".join(parts)
+
+def _read_member(archive, member, size=-1):
+    try:
+        if zipfile.is_zipfile(archive):
+            with zipfile.ZipFile(archive) as bundle:
+                with bundle.open(member) as fid:
+                    return fid.read(size) if size >= 0 else fid.read()
+        with tarfile.open(archive) as bundle:
+            fid = bundle.extractfile(member)
+            if fid is None:
+                raise KeyError(member)
+            return fid.read(size) if size >= 0 else fid.read()
+    except (KeyError, tarfile.TarError, zipfile.BadZipfile), exc:
+        raise IOError("can't read %r from %r: %s"%(member, archive, exc))
+
+def _member_info(archive, member):
+    try:
+        if zipfile.is_zipfile(archive):
+            with zipfile.ZipFile(archive) as bundle:
+                return bundle.getinfo(member).file_size
+        with tarfile.open(archive) as bundle:
+            return bundle.getmember(member).size
+    except (KeyError, tarfile.TarError, zipfile.BadZipfile), exc:
+        raise IOError("can't read %r from %r: %s"%(member, archive, exc))
+
+def _decompress(name, data):
+    try:
+        if name.endswith('.gz'):
+            return gzip.GzipFile(fileobj=StringIO(data)).read()
+        elif name.endswith('.bz2'):
+            return bz2.decompress(data)
+        elif name.endswith('.xz'):
+            return _lzma().decompress(data)
+    except (IOError, EOFError, zlib.error), exc:
+        raise IOError("can't decompress %r: %s"%(name, exc))
+    return data
+
+def _lzma():
+    if lzma is None:
+        raise IOError("reading .xz files requires the lzma module")
+    return lzma
+
+def test():
+    import shutil, tempfile
+    from .utils import example
+    source = example('ng7', 'jul04031.ng7')
+    raw = _open(source, 'rb').read()
+    tempdir = tempfile.mkdtemp()
+    try:
+        # Plain, compressed and bundled copies all read the same
+        paths = [source]
+        path = os.path.join(tempdir, 'jul04031.ng7.gz')
+        with gzip.open(path, 'wb') as fid: fid.write(raw)
+        paths.append(path)
+        path = os.path.join(tempdir, 'jul04031.ng7.bz2')
+        with _open(path, 'wb') as fid: fid.write(bz2.compress(raw))
+        paths.append(path)
+        bundle = os.path.join(tempdir, 'expt.zip')
+        with zipfile.ZipFile(bundle, 'w') as fid:
+            fid.write(source, 'ng7/jul04031.ng7')
+        paths.append(os.path.join(bundle, 'ng7', 'jul04031.ng7'))
+        bundle = os.path.join(tempdir, 'expt.tar.gz')
+        with tarfile.open(bundle, 'w:gz') as fid:
+            fid.add(paths[1], 'ng7/jul04031.ng7.gz')
+        paths.append(os.path.join(bundle, 'ng7', 'jul04031.ng7.gz'))
+        lines = raw.splitlines(True)
+        with open(source, mmap_bytes=0) as fid:
+            assert isinstance(fid.buffer, mmap.mmap)
+            assert list(fid) == lines
+        with open(source) as fid:
+            assert isinstance(fid.buffer, str)
+        for path in paths:
+            assert exists(path) and getsize(path) == len(raw), path
+            assert getsize(path, decompress=False) in (len(raw), None), path
+            assert head(path, 20) == raw[:20], path
+            with open(path) as fid:
+                assert fid.readline() == lines[0]
+                offset = fid.tell()
+                assert list(fid) == lines[1:]
+                fid.seek(offset)
+                assert fid.read() == raw[offset:]
+                assert fid.buffer[:len(raw)] == raw
+        assert getsize(paths[2], decompress=False) is None
+        assert getsize(paths[3], decompress=False) == len(raw)
+        assert stat(paths[-1]).st_size == os.path.getsize(bundle)
+        assert not exists(os.path.join(bundle, 'missing'))
+        try:
+            open(os.path.join(bundle, 'ng7', 'missing'))
+        except IOError:
+            pass
+        else:
+            raise AssertionError("missing member not detected")
+    finally:
+        shutil.rmtree(tempdir)
+
+if __name__ == "__main__": test()
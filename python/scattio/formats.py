@@ -28,6 +28,19 @@ accessed directly.  Note that some data formats can store multiple
 measurements in the file, so the returned structure may contain
 multiple NeXus entries.
 
+=== Conversion cache ===
+
+Raw files are converted to NeXus when they are loaded.  The converted
+files can be kept in a cache directory so that loading the same file
+again only needs to read the cached NeXus file.  The cache is off
+unless $SCATTIO_CACHE names the cache directory, or it is turned on with
+
+    formats.set_cache('path/to/cache', max_bytes=2**30)
+
+which also sets the maximum size of the cache.  Use
+formats.set_cache(None) to turn it off again.  Loaded files are in
+memory trees whether or not they come from the cache.
+
 === Registering new formats ===
 
 New formats can be created and register using
@@ -40,14 +53,26 @@ function interface.
 
 import os.path
 from .registry import ExtensionRegistry
-__all__ = ['load','datadir']
+__all__ = ['load','summary','datadir','set_cache']
 
 datadir = os.path.join(os.path.dirname(__file__),'examples')
 
+# Version of the raw to NeXus converters, used to identify cached
+# conversions.  Increment this when the converted files change.
+CONVERTER_VERSION = 1
+
+# Conversion cache, or None if caching is disabled.  The cache is
+# created on first use from (directory, max_bytes).
+CACHE = None
+_CACHE_CONFIG = (os.environ.get('SCATTIO_CACHE') or None, None)
+
 
 # Shared registry for all reflectometry formats
 REGISTRY = ExtensionRegistry()
 
+# Shared registry for header summaries
+SUMMARIES = ExtensionRegistry()
+
 def load(filename, format=None):
     """
     Load the reflectometry measurement description and the data.
@@ -59,6 +84,85 @@ def load(filename, format=None):
     """
     return REGISTRY.load(filename, format=format)
 
+def set_cache(directory, max_bytes=None):
+    """
+    Set the directory and maximum size in bytes of the conversion cache.
+
+    If *directory* is None, converted files are not cached.
+    """
+    global CACHE, _CACHE_CONFIG
+    CACHE, _CACHE_CONFIG = None, (directory, max_bytes)
+
+def _cached(convert=None, depends=None):
+    """
+    Return a loader which caches the result of the converter *convert*.
+
+    If the result also depends on settings other than the file, such as a
+    table of corrections, *depends()* returns a value identifying them,
+    which becomes part of the cache key.  Use *@_cached(depends=...)* to
+    decorate the converter in that case.
+    """
+    if convert is None:
+        return lambda convert: _cached(convert, depends)
+    def loader(file):
+        global CACHE
+        directory, max_bytes = _CACHE_CONFIG
+        if not directory:
+            return convert(file)
+        if CACHE is None:
+            from .nxscache import ConversionCache, MAX_BYTES
+            CACHE = ConversionCache(os.path.expanduser(directory),
+                                    max_bytes if max_bytes else MAX_BYTES)
+        version = (CONVERTER_VERSION if depends is None
+                   else (CONVERTER_VERSION, depends()))
+        return CACHE.load(file, convert, convert.__name__, version)
+    loader.__name__, loader.__doc__ = convert.__name__, convert.__doc__
+    return loader
+
+def register_sniff(loader, sniff):
+    """
+    Register a test of the file contents for *loader*.
+
+    *sniff(head, size)* is called with the first few kilobytes of the
+    file and the file size, and returns True if *loader* can read the file.
+    Loaders whose sniff functions match are tried before loaders without
+    one, and loaders whose sniff functions fail are tried last.
+    """
+    REGISTRY.sniff(loader, sniff)
+
+def summary(filename, format=None):
+    """
+    Read the run metadata from the header of a raw data file.
+
+    Returns a dictionary with keys *format*, *instrument*, *run*, *date*,
+    *wavelength*, *temperature*, *sample*, *comment* and *points*, which
+    are None if they are not available from the header, plus the other
+    header values for the format.  The date is an ISO 8601 string.
+
+    Use available_summaries() to list the formats which can be summarized.
+    """
+    return SUMMARIES.load(filename, format=format)
+
+def available_summaries():
+    """
+    Return a list of file formats which can be summarized.
+    """
+    return SUMMARIES.formats()
+
+def register_summary(ext, summarizer):
+    """
+    Register a header summary function for a file extension.
+
+    Like register(), this should be called for each extension and for
+    the format name.  The summarizer has the signature:
+
+        metadata = summarizer('path/to/file.ext')
+
+    where metadata is a dictionary as described in summary().  It should
+    read only as much of the file as needed for the header.
+    """
+    SUMMARIES[ext] = summarizer
+
 def available():
     """
     Return a list of available file formats.
@@ -94,12 +198,14 @@ def register(ext,loader):
 
     After initialization, the application will make a call to data.load()
     to read in the complete metadata.  In order to support large datasets,
-    data.detector.counts can use weak references.  In that case the
-    file format should set data.detector.loadcounts to a method which
-    can load the counts from the file.  If load() has already loaded
-    the counts in it can set data.detector.counts = weakref.ref(counts)
-    for the weak reference behaviour, or simply data.detector.counts = counts
-    if the data is small.
+    the detector counts can be loaded on first use.  In that case the
+    file format should store a :class:`utils.LazyCounts` object wrapping
+    a method which loads the counts from the file.  The counts are then
+    held by weak reference, with the most recently used arrays kept in
+    :data:`utils.COUNTS_CACHE`, which can be emptied when memory is low
+    with *COUNTS_CACHE.shrink()*.  If the data is small, simply store the
+    counts array.  The ICP, ICE and SANS readers support this through
+    their *lazy* option.
 
     Both loader() and data.load() should call the self.resetQ() before
     returning in order to set the Qx-Qz values from the instrument geometry.
@@ -110,11 +216,17 @@ def register(ext,loader):
     REGISTRY[ext] = loader
 
 # Delayed loading of file formats
+def _icp_wavelengths():
+    from .ncnr.icpformat import WAVELENGTHS
+    return WAVELENGTHS.digest()
+
+@_cached(depends=_icp_wavelengths)
 def icp_ng7(file):
     """NCNR NG-7 ICP file loader"""
     from .ncnr.ng7nxs import convert
     return convert(file, ":entry")
 
+@_cached(depends=_icp_wavelengths)
 def icp_ng1(file):
     """NCNR NG-7 ICP file loader"""
     from .ncnr.ng1nxs import convert
@@ -125,16 +237,97 @@ def nexus(file):
     from h5py import File
     return File(file, 'r')
 
+@_cached
 def vax_sans(file):
     """NCNR SANS VAX file loader"""
     from .ncnr.sansnxs import convert
     return convert(file, ":entry")
 
+@_cached
 def ice_bt7(file):
     """NCNR BT-7 ICE file loader"""
     from .ncnr.bt7nxs import convert
     return convert(file, ":entry")
 
+# Delayed loading of header summaries
+_SUMMARY_KEYS = ('instrument', 'run', 'date', 'wavelength', 'temperature',
+                 'sample', 'comment', 'points')
+def _summary(format, header, **kw):
+    result = dict.fromkeys(_SUMMARY_KEYS)
+    result.update(header)
+    result.update(kw, format=format)
+    return result
+
+def icp_summary(file):
+    """NCNR ICP header summary"""
+    from .ncnr.icpformat import summary
+    icp = summary(file)
+    header = dict((k,v) for k,v in vars(icp).items()
+                  if isinstance(v, (basestring, int, float, bool)))
+    del header['path']
+    # Q, T and B buffers record the start temperature as tstart, and
+    # have no wavelength
+    return _summary('NCNR ICP', header,
+                    instrument=icp.filename.split('.')[1].upper(),
+                    run=icp.filename, date=icp.date.isoformat(),
+                    wavelength=getattr(icp, 'wavelength', None),
+                    temperature=getattr(icp, 'Tstart',
+                                        getattr(icp, 'tstart', None)),
+                    sample=icp.comment, comment=icp.comment,
+                    points=icp.points)
+
+def vax_sans_summary(file):
+    """NCNR SANS VAX header summary"""
+    import datetime
+    from . import fileio
+    from .ncnr.sansformat import read_headers, DATETIME_FORMAT
+    if fileio.getsize(file) != 33316:
+        raise IOError("'%s' is not a SANS RAW file"%file)
+    record = read_headers([file])[0]
+    header = dict((k, record[k].item()) for k in record.dtype.names)
+    date = datetime.datetime.strptime(header['run.datetime'], DATETIME_FORMAT)
+    return _summary('NCNR SANS', header,
+                    instrument=file.rsplit('.',1)[1][:3].upper(),
+                    run=header['fname.filename'], date=date.isoformat(),
+                    wavelength=header['resolution.lmda'],
+                    temperature=header['sample.temp'],
+                    sample=header['sample.labl'],
+                    comment=header['sample.labl'])
+
+def ice_bt7_summary(file):
+    """NCNR BT-7 ICE header summary"""
+    import datetime
+    from .ncnr.iceformat import summary
+    metadata = summary(file).metadata
+    header = dict((k,v) for k,v in metadata.items()
+                  if isinstance(v, (basestring, int, float, bool)))
+    if 'FixedE' in metadata:
+        header['FixedE'] = "%s %g"%metadata['FixedE']
+    date = datetime.datetime.fromtimestamp(metadata['Epoch'])
+    return _summary('NCNR ICE', header,
+                    instrument=metadata['InstrName'],
+                    run=metadata['Filename'], date=date.isoformat(),
+                    sample=metadata.get('ExptName', None),
+                    comment=metadata.get('Comment', None),
+                    points=metadata.get('Npoints', None))
+
+# Delayed loading of content sniffers
+def icp_sniff(head, size):
+    from .ncnr.icpformat import sniff
+    return sniff(head, size)
+
+def nexus_sniff(head, size):
+    # HDF-5 signature, which may follow a user block of 512*2**k bytes
+    return any(head[k:k+8] == '\x89HDF\r\n\x1a\n' for k in (0,512,1024,2048))
+
+def sans_sniff(head, size):
+    from .ncnr.sansformat import sniff
+    return sniff(head, size)
+
+def ice_sniff(head, size):
+    from .ncnr.iceformat import sniff
+    return sniff(head, size)
+
 # Register extensions with file formats
 register('.nxs*', nexus)
 register('NeXus', nexus)
@@ -153,29 +346,87 @@ register('.SA[123]*', vax_sans)
 register('NCNR BT-7', ice_bt7)
 register('.bt7', ice_bt7)
 
-def test():
-    from .utils import example
+register_sniff(nexus, nexus_sniff)
+register_sniff(icp_ng7, icp_sniff)
+register_sniff(icp_ng1, icp_sniff)
+register_sniff(vax_sans, sans_sniff)
+register_sniff(ice_bt7, ice_sniff)
 
-    # make sure we've defined the various file formats
-    assert set(available()) == set(['NCNR NG-1','NCNR NG-7','NCNR SANS','NCNR BT-7','NeXus']),available()
+# Register extensions with header summaries
+register_summary('.ng7', icp_summary)
+register_summary('.ng7.gz', icp_summary)
+register_summary('.[nc][abcdg]1', icp_summary)
+register_summary('.[nc][abcdg]1.gz', icp_summary)
+register_summary('NCNR ICP', icp_summary)
 
-    # check that examples are found and loaded; don't check that they have
-    # correct content since that will be done by individual loader tests
-    ng7file = load(example('ng7','jul04031.ng7'))
-    wavelength = ng7file["/entry/instrument/monochromator/wavelength"].value/10
-    assert (wavelength-0.476) < 1e-6  # float32(4.76)/10 is not exactly 0.476
+register_summary('.SA[123]*', vax_sans_summary)
+register_summary('NCNR SANS', vax_sans_summary)
 
-    #ng1file = example('ng1','psih1001.ng1')
-    #assert load(ng1file).name == 'gsip4007.ng1'
+register_summary('.bt7', ice_bt7_summary)
+register_summary('NCNR ICE', ice_bt7_summary)
 
-    #cg1file = example('cg1area','psdca022.cg1.gz')
-    #assert loadmeta(cg1file).name == 'psdca022.cg1'
+SUMMARIES.sniff(icp_summary, icp_sniff)
+SUMMARIES.sniff(vax_sans_summary, sans_sniff)
+SUMMARIES.sniff(ice_bt7_summary, ice_sniff)
 
-    sansfile = os.path.join(datadir,'sans','SILIC001.SA3_SRK_S101')
-    assert load(sansfile)["/entry/file_name"].value == 'SILIC001.SA3_SRK_S101'
+def test():
+    import tempfile, shutil
+    from .utils import example
+    from .memnexus import File
 
-    bt7file = example('bt7','201102-16363-largeq_90397.bt7')
-    assert load(bt7file)["/entry/file_name"].value == 'largeq_90397'
+    # make sure we've defined the various file formats
+    assert set(available()) == set(['NCNR NG-1','NCNR NG-7','NCNR SANS','NCNR BT-7','NeXus']),available()
 
+    # don't touch the user's conversion cache
+    config = _CACHE_CONFIG
+    cachedir = tempfile.mkdtemp()
+    set_cache(None)
+    try:
+        # check that examples are found and loaded; don't check that they have
+        # correct content since that will be done by individual loader tests
+        ng7file = load(example('ng7','jul04031.ng7'))
+        wavelength = ng7file["/entry/instrument/monochromator/wavelength"].value/10
+        assert (wavelength-0.476) < 1e-6  # float32(4.76)/10 is not exactly 0.476
+
+        #ng1file = example('ng1','psih1001.ng1')
+        #assert load(ng1file).name == 'gsip4007.ng1'
+
+        #cg1file = example('cg1area','psdca022.cg1.gz')
+        #assert loadmeta(cg1file).name == 'psdca022.cg1'
+
+        sansfile = os.path.join(datadir,'sans','SILIC001.SA3_SRK_S101')
+        assert load(sansfile)["/entry/file_name"].value == 'SILIC001.SA3_SRK_S101'
+
+        bt7file = example('bt7','201102-16363-largeq_90397.bt7')
+        assert load(bt7file)["/entry/file_name"].value == 'largeq_90397'
+
+        # check that the file contents select the loader
+        assert REGISTRY.last_choice == (ice_bt7, 'sniff matched')
+        assert (REGISTRY.choose(example('ng7','jul04031.ng7'))
+                == [(icp_ng7, 'sniff matched')])
+        assert [fn for fn,_ in REGISTRY.choose(sansfile, format='NCNR SANS')] == [vax_sans]
+        assert REGISTRY.choose(bt7file, format='NCNR SANS')[0][1] == 'sniff rejected'
+
+        # check that conversions are cached
+        set_cache(cachedir)
+        converted = load(sansfile)
+        cached = load(sansfile)
+        assert cached is not converted
+        assert isinstance(converted, File) and isinstance(cached, File)
+        assert cached["/entry/file_name"].value == 'SILIC001.SA3_SRK_S101'
+        assert cached.attrs['file_name'] == converted.attrs['file_name']
+        assert cached.attrs['file_name'] == os.path.join(cachedir,
+                                                        os.listdir(cachedir)[0])
+        counts = "/entry/DASlogs/areaDetector/counts"
+        assert (cached[counts].value == converted[counts].value).all()
+        assert cached[counts] is cached["/entry/instrument/detector/data"]
+        cached[counts].attrs['units'] = 'counts'
+        load(bt7file)
+        assert len(os.listdir(cachedir)) == 2
+        CACHE.evict(max_bytes=1)
+        assert os.listdir(cachedir) == []
+    finally:
+        set_cache(*config)
+        shutil.rmtree(cachedir)
 
 if __name__ == "__main__": test()
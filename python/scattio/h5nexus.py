@@ -7,7 +7,8 @@ attribute *name* in the Group or Dataset *g*.  It also adds the tree()
 method to groups, which returns a formatted summary tree.
 """
 __all__ = ["open", "group", "field", "append", "extend", "link",
-           "walk", "datasets"]
+           "walk", "datasets", "CompressionPolicy", "Appender", "TreeIndex",
+           "tree", "iter_tree"]
 import new
 import os
 
@@ -17,6 +18,7 @@ import numpy
 # The following forces natural naming onto 
 from . import h5natural
 from . import iso8601
+from . import memnexus
 
 # Conforms to the following version of the NeXus standard
 __version__ = "4.2.1"
@@ -42,6 +44,7 @@ def open(filename, mode="r", timestamp=None, creator=None, **kw):
         w-   create empty file, fail if exists
         a    open file read-write or create empty file
         mem  create empty in-memory file
+        tree create empty in-memory tree without HDF-5
         ==== =========================================
 
     *timestamp* : string, datetime, time_struct or float
@@ -67,28 +70,38 @@ def open(filename, mode="r", timestamp=None, creator=None, **kw):
     When it is not provided a unique temporary filename is generated
     and backing_store=False.
 
+    Mode "tree" returns a :class:`memnexus.File`, a pure python tree
+    with the same interface for creating and reading groups and fields.
+    It is much faster to build than an HDF-5 file, and can be written
+    to one later using its save() method.
+
     Returns an H5 file object.
     """
-    if mode=="mem":
+    global _MEMFILE_COUNT
+    if mode=="tree":
+        if not filename:
+            _MEMFILE_COUNT += 1
+            filename = "temp%05d.nxs"%_MEMFILE_COUNT
+        f = memnexus.File(filename)
+        preexisting = False
+    elif mode=="mem":
         mode = "a"
         if filename:
             kw.update({'driver':'core', 'backing_store':True})
         else:
             kw.update({'driver':'core', 'backing_store':False})
-            global _MEMFILE_COUNT
             _MEMFILE_COUNT += 1
             filename = "temp%05d.nxs"%_MEMFILE_COUNT
 
-    preexisting = os.path.exists(filename)
-
-    try:
-        f = h5.File(filename, mode, **kw)
-    except IOError, exc:
-        _annotate_exception(exc,"when opening %s with mode %s"%(filename,mode))
-        raise
-        
+    if mode != "tree":
+        preexisting = os.path.exists(filename)
+        try:
+            f = h5.File(filename, mode, **kw)
+        except IOError, exc:
+            _annotate_exception(exc,"when opening %s with mode %s"%(filename,mode))
+            raise
         
-    if (mode == "a" and not preexisting) or mode == "w":
+    if (mode == "a" and not preexisting) or mode in ("w", "tree"):
         if timestamp is None:
             timestr = iso8601.now()
         else:
@@ -160,9 +173,79 @@ def link(node, link):
 
 # Default chunk size for extensible objects
 CHUNK_SIZE = 1000
+# Target chunk size in bytes for extensible objects, by compression filter.
+# Chunks should be well below the 1 MiB HDF5 chunk cache.
+CHUNK_BUDGET = {None: 2**16, 'gzip': 2**16, 'lzf': 2**16}
+# Minimum number of frames in a chunk for column access
+COLUMN_FRAMES = 1024
 # Options passed to h5 create_dataset
 _CREATE_OPTS = ['chunks','maxshape','compression',
                 'compression_opts','shuffle','fletcher32']
+
+class CompressionPolicy(object):
+    """
+    Choose the compression for a new field from its dtype, size and rank.
+
+    *compression* : 'none|gzip|lzf' or int
+        Default compression.  An integer gives the gzip compression level.
+    *shuffle* : boolean
+        Default for reordering the bytes before compression.
+    *min_size* : int
+        Fields of at most *min_size* bytes per frame are not compressed.
+        The default is CHUNK_SIZE.
+    *rules* : [dict, ...]
+        Overrides for particular fields.  Each rule is a dictionary with
+        *compression* and/or *shuffle* settings and any of the selectors
+        *kind* (string of acceptable numpy dtype kind codes), *rank*
+        (minimum number of dimensions) and *size* (minimum size in bytes).
+        The first rule whose selectors all match the field is used.
+
+    For example, to use lzf for integer detector images, no compression
+    for strings and gzip level 1 for everything else::
+
+        policy = CompressionPolicy(1, rules=[
+            {'kind': 'iu', 'rank': 2, 'compression': 'lzf', 'shuffle': True},
+            {'kind': 'S', 'compression': 'none'},
+            ])
+    """
+    def __init__(self, compression=9, shuffle=False, min_size=None, rules=()):
+        self.compression = compression
+        self.shuffle = shuffle
+        self.min_size = min_size
+        self.rules = list(rules)
+
+    def options(self, dtype, shape):
+        """
+        Return the create_dataset compression options for a field.
+
+        *shape* is the shape of the field, or the maxshape of an
+        extensible field with None for the extensible dimensions.
+        """
+        dtype = numpy.dtype(dtype)
+        size = numpy.prod([d for d in shape if d])*dtype.itemsize
+        compression, shuffle = self.compression, self.shuffle
+        for rule in self.rules:
+            if (('kind' in rule and dtype.kind not in rule['kind'])
+                or ('rank' in rule and len(shape) < rule['rank'])
+                or ('size' in rule and size < rule['size'])):
+                continue
+            compression = rule.get('compression', compression)
+            shuffle = rule.get('shuffle', shuffle)
+            break
+        min_size = self.min_size if self.min_size is not None else CHUNK_SIZE
+        if compression in (None, 'none') or size <= min_size:
+            return {}
+        elif compression in ('gzip', 'lzf'):
+            opts = {'compression': compression}
+        else:
+            opts = {'compression': 'gzip', 'compression_opts': compression}
+        if shuffle:
+            opts['shuffle'] = True
+        return opts
+
+# Default compression policy for field
+COMPRESSION = CompressionPolicy(9)
+
 def field(node, path, **kw):
     """
     Create a data object.
@@ -220,19 +303,24 @@ def field(node, path, **kw):
 
     *chunks* : [int, ...]
         Storage block size on disk, which is also the basic compression
-        size.  By default *chunks* is set from maxshape, with the
-        first unspecified dimension set such that the chunk size is
-        greater than nexus.CHUNK_SIZE. :func:`make_chunks` is used
-        to determine the default value.
+        size.  By default *chunks* is set from maxshape and the
+        compression filter by :func:`make_chunks`.
+
+    *access* : 'frame|column'
+        Expected access pattern for extensible datasets, used for the
+        default *chunks*.  The default is 'frame'.
 
     *compression* : 'none|gzip|szip|lzf' or int
         Dataset compression style.  If not specified, then compression
-        defaults to 'szip' for large datasets, otherwise it defaults to
-        'none'. Datasets are considered large if each frame in maxshape
-        is bigger than CHUNK_SIZE.  Eventmode data, with its small frame
-        size but large number of frames, will need to set compression
-        explicitly.  If compression is an integer, then use gzip compression
-        with that compression level.
+        is chosen by *policy*. If compression is an integer, then use
+        gzip compression with that compression level.
+
+    *policy* : CompressionPolicy
+        Compression policy to use when *compression* is not given.
+        Defaults to h5nexus.COMPRESSION, which uses gzip level 9 for
+        datasets in which each frame in maxshape is bigger than
+        CHUNK_SIZE.  Eventmode data, with its small frame size but
+        large number of frames, will need to set compression explicitly.
 
     *compression_opts* : ('ec|nn', int)
         szip compression options.
@@ -267,6 +355,8 @@ def field(node, path, **kw):
     units = kw.pop('units', None)
     label = kw.pop('label', None)
     attrs = kw.pop('attrs', {})
+    policy = kw.pop('policy', None) or COMPRESSION
+    access = kw.pop('access', 'frame')
     
     if kw: raise TypeError("unknown keyword(s) "+", ".join(kw.keys()))
 
@@ -287,9 +377,8 @@ def field(node, path, **kw):
             except TypeError:
                 raise TypeError("data type %r not understood when creating %s"
                                 %(dtype,target))
-        if ('compression' not in create_opts
-            and data.nbytes > CHUNK_SIZE):
-            create_opts['compression'] = 9
+        if 'compression' not in create_opts:
+            create_opts.update(policy.options(data.dtype, data.shape))
         # HDF can't handle length 0 fixed size arrays
         if not all(data.shape):
             create_opts['maxshape'] = [(dim if dim else None) for dim in data.shape]
@@ -300,22 +389,23 @@ def field(node, path, **kw):
         maxshape = create_opts.pop('maxshape', None)
         chunks = create_opts.pop('chunks', None)
         compression = create_opts.pop('compression', None)
-        dtype = numpy.dtype(dtype) if dtype is not None else numpy.float32
+        dtype = numpy.dtype(dtype if dtype is not None else numpy.float32)
         if shape and maxshape is None:
             raise TypeError("Need to specify shape or maxshape for dataset %s"%target)
         if shape is None:
             shape = [(k if k else 0) for k in maxshape]
         if maxshape is None:
             maxshape = shape
-        if chunks is None:
-            chunks = make_chunks(maxshape, dtype, CHUNK_SIZE)
         if compression is None:
-            size = numpy.prod([d for d in maxshape if d])*dtype.itemsize
-            compression = 9 if size > CHUNK_SIZE else None
-        elif compression == 'none':
-            compression = None
+            create_opts.update(policy.options(dtype, maxshape))
+        elif compression != 'none':
+            create_opts['compression'] = compression
+        if chunks is None:
+            chunks = make_chunks(maxshape, dtype,
+                                 compression=create_opts.get('compression'),
+                                 access=access)
         create_opts.update(shape=shape,maxshape=maxshape,dtype=dtype,
-                           compression=compression,chunks=chunks)
+                           chunks=chunks)
 
     # Numeric data needs units
     if dtype.kind in ('u','i','f','c') and units is None:
@@ -391,12 +481,105 @@ def extend(node, data):
 
     For more complicated operations, use node.resize to expand the
     data space then assign directly to the desired slice.
+
+    When streaming many frames, :class:`Appender` is much faster.
     """
     if len(data) > 0:
         node.resize(node.shape[0]+data.shape[0], axis=0)
-        node[-data.shape[0]:-1] = data
+        node[-data.shape[0]:] = data
+
+class Appender(object):
+    """
+    Buffered append to a data node which is extensible in its first
+    dimension.
+
+    Frames are collected in memory and written in blocks of *buffer_size*
+    frames, growing the data node by doubling as needed.  The default
+    buffer size is a multiple of the chunk size holding about *MAX_BUFFER*
+    bytes.  Until the appender is closed, the node may be longer than the
+    data written; *len(appender)* is the number of frames appended so far.
 
-def make_chunks(maxshape, dtype, min_chunksize):
+    Use as::
+
+        with Appender(node) as stream:
+            for frame in frames:
+                stream.append(frame)
+    """
+    MAX_BUFFER = 2**20
+    def __init__(self, node, buffer_size=None):
+        self.node = node
+        self._length = node.shape[0]
+        frame_shape = node.shape[1:]
+        if buffer_size is None:
+            frame_bytes = int(numpy.prod(frame_shape))*node.dtype.itemsize
+            chunk = node.chunks[0] if node.chunks else 1
+            buffer_size = max(1, self.MAX_BUFFER//(frame_bytes*chunk))*chunk
+        self._buffer = numpy.empty([buffer_size]+list(frame_shape),
+                                   dtype=node.dtype)
+        self._count = 0
+
+    def __len__(self):
+        return self._length + self._count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, data):
+        """
+        Append one frame.
+        """
+        data = numpy.asarray(data)
+        self.extend(data.reshape((1,)+data.shape))
+
+    def extend(self, data):
+        """
+        Append a group of frames.
+        """
+        data = numpy.asarray(data)
+        if data.shape[1:] != self._buffer.shape[1:]:
+            raise ValueError("frame shape %s does not match %s in %s"
+                             %(data.shape[1:], self._buffer.shape[1:],
+                               self.node.name))
+        size = len(self._buffer)
+        start = 0
+        while start < len(data):
+            n = min(len(data)-start, size-self._count)
+            self._buffer[self._count:self._count+n] = data[start:start+n]
+            self._count += n
+            start += n
+            if self._count == size:
+                self.flush()
+
+    def flush(self):
+        """
+        Write the buffered frames to the node.
+        """
+        if self._count == 0:
+            return
+        end = self._length + self._count
+        if end > self.node.shape[0]:
+            self.node.resize(max(end, 2*self.node.shape[0]), axis=0)
+        try:
+            self.node[self._length:end] = self._buffer[:self._count]
+        except Exception, exc:
+            _annotate_exception(exc, "while appending to %s"%self.node.name)
+            raise
+        self._length = end
+        self._count = 0
+
+    def close(self):
+        """
+        Write the buffered frames and trim the node to the data length.
+        """
+        self.flush()
+        if self.node.shape[0] != self._length:
+            self.node.resize(self._length, axis=0)
+
+def make_chunks(maxshape, dtype, min_chunksize=0, budget=None,
+                compression=None, access='frame'):
     """
     Determine chunk size for storage.
 
@@ -406,27 +589,253 @@ def make_chunks(maxshape, dtype, min_chunksize):
         Storage type.
     *min_chunksize* : int
         Minimum size recommended for the chunk.
+    *budget* : int
+        Target size of the chunk in bytes.  Defaults to the CHUNK_BUDGET
+        for the *compression* filter.
+    *compression* : 'none|gzip|szip|lzf' or int
+        Compression filter for the dataset.
+    *access* : 'frame|column'
+        Expected access pattern.  With 'frame', chunks hold as many
+        whole frames as fit in the budget, splitting the frame only if
+        it is bigger than the budget.  With 'column', frames are split
+        so that each chunk holds at least COLUMN_FRAMES frames, which
+        is faster for reading the history of individual detector pixels
+        but slower for reading single frames.
+
+    Only the first extensible dimension spans multiple frames; the chunk
+    size for any other extensible dimension is 1.  Returns None if no
+    dimension is extensible.
     """
     varying_idx = [i for i,v in enumerate(maxshape) if v is None]
-    if varying_idx:
-        chunks = [(v if v else 1) for v in maxshape] # Non-zero dims
-        fixed_size = numpy.prod(chunks) * numpy.dtype(dtype).itemsize
-        chunks[varying_idx[0]] = min_chunksize//fixed_size + 1
-        chunks = tuple(chunks)
+    if not varying_idx:
+        return None
+    if budget is None:
+        if compression == 'none':
+            compression = None
+        elif compression not in CHUNK_BUDGET:
+            compression = 'gzip'
+        budget = CHUNK_BUDGET[compression]
+    budget = max(budget, min_chunksize)
+    itemsize = numpy.dtype(dtype).itemsize
+    frame_idx = [i for i,v in enumerate(maxshape) if v is not None]
+    chunks = [(v if v else 1) for v in maxshape] # Non-zero dims
+    for i in varying_idx:
+        chunks[i] = 1
+    if access == 'column':
+        limit = max(itemsize, budget//COLUMN_FRAMES)
+    elif access == 'frame':
+        limit = budget
     else:
-        chunks = None
-    return chunks
+        raise ValueError("access should be 'frame' or 'column'")
+    # Halve the largest frame dimension until the frame part fits
+    while frame_idx and numpy.prod(chunks)*itemsize > limit:
+        k = max(frame_idx, key=lambda i: chunks[i])
+        if chunks[k] == 1:
+            break
+        chunks[k] = (chunks[k]+1)//2
+    frame_bytes = int(numpy.prod(chunks))*itemsize
+    chunks[varying_idx[0]] = max(1, budget//frame_bytes)
+    return tuple(chunks)
 
 def _name(node):
     return node.name.split("/")[-1]
 
+_KIND = {h5.h5o.TYPE_GROUP: 'group', h5.h5o.TYPE_DATASET: 'dataset',
+         h5.h5o.TYPE_NAMED_DATATYPE: 'datatype'}
+class TreeIndex(object):
+    """
+    Index of the groups, datasets and links below an HDF-5 group.
+
+    The index is built from a single HDF-5 link traversal, looking up
+    the type and NeXus class of each object once.  It is a snapshot of
+    the file, so it must be rebuilt if the file is modified.
+
+    *root* : h5 group
+        Group which was indexed.
+    *links* : {path: (type, value)}
+        Links below root, by path relative to root.  The link type is
+        'hard', 'soft' or 'external', with value the object address,
+        the link path or (filename, path) respectively.  A group which
+        is reachable by several hard links is listed under one path.
+    *kind* : {address: 'group|dataset|datatype'}
+        Type of each object.
+    *nxclass* : {address: string}
+        NeXus class of each group which has one.
+    *children* : {address: [(name, path), ...]}
+        Links within each group, with the path of the link in *links*.
+
+    :func:`walk`, :func:`datasets` and *tree* use the index to traverse
+    the file.  External links are resolved when they are traversed, but
+    the externally linked groups are not descended.
+
+    A :class:`memnexus.Group` can also be indexed, with the object id
+    used as its address.
+    """
+    def __init__(self, root):
+        if not isinstance(root, (h5.Group, memnexus.Group)):
+            raise TypeError("must index a group")
+        self.root = root
+        self.links, self.kind, self.nxclass, self.children = {}, {}, {}, {}
+        if isinstance(root, memnexus.Group):
+            self._index_tree()
+            return
+        rootid = root.id
+        self.address = h5.h5o.get_info(rootid).addr
+        self._add_object(".", self.address)
+        links = rootid.links
+        def visit(name, info):
+            parent, _, child = name.rpartition('/')
+            self.children[self.links[parent][1] if parent
+                          else self.address].append((child, name))
+            if info.type == h5.h5l.TYPE_HARD:
+                self.links[name] = ('hard', info.u)
+                if info.u not in self.kind:
+                    self._add_object(name, info.u)
+            elif info.type == h5.h5l.TYPE_SOFT:
+                self.links[name] = ('soft', links.get_val(name))
+            else:
+                self.links[name] = ('external', links.get_val(name))
+        links.visit(visit, info=True)
+
+    def _add_object(self, name, address):
+        rootid = self.root.id
+        kind = _KIND.get(h5.h5o.get_info(rootid, name).type, None)
+        self.kind[address] = kind
+        if kind == 'group':
+            self.children[address] = []
+            if h5.h5a.exists(rootid, "NX_class", obj_name=name):
+                attr = h5.h5a.open(rootid, "NX_class", obj_name=name)
+                value = numpy.empty(attr.shape, attr.dtype)
+                attr.read(value)
+                self.nxclass[address] = str(value.flat[0])
+
+    def _index_tree(self):
+        self.address = id(self.root)
+        self.kind[self.address] = 'group'
+        stack = [("", self.root)]
+        while stack:
+            prefix, group = stack.pop()
+            address = id(group)
+            self.children[address] = []
+            if 'NX_class' in group.attrs:
+                self.nxclass[address] = str(group.attrs['NX_class'])
+            for name, node in group.items():
+                path = prefix+name
+                self.children[address].append((name, path))
+                self.links[path] = ('hard', id(node))
+                if id(node) not in self.kind:
+                    if isinstance(node, memnexus.Group):
+                        self.kind[id(node)] = 'group'
+                        stack.append((path+"/", node))
+                    else:
+                        self.kind[id(node)] = 'dataset'
+
+    def path(self, relpath):
+        """
+        Return the absolute path for a path relative to the root.
+        """
+        base = self.root.name
+        return (base if base.endswith('/') else base+'/') + relpath
+
+    def resolve(self, relpath):
+        """
+        Return (kind, location) for the object at *relpath*, following
+        soft links.
+
+        *location* is the object address, or (filename, path) for external
+        links.  *kind* is None for dangling links.
+        """
+        for _ in range(100): # soft link depth limit
+            link_type, value = self.links[relpath]
+            if link_type == 'hard':
+                return self.kind[value], value
+            elif link_type == 'external':
+                node = self.root.get(relpath, None)
+                if isinstance(node, h5.Group):
+                    return 'group', value
+                elif isinstance(node, h5.Dataset):
+                    return 'dataset', value
+                else:
+                    return None, value
+            # Soft link: look up in the index if it is below root
+            if not value.startswith('/'):
+                parent = relpath.rpartition('/')[0]
+                value = self.path(parent+'/'+value if parent else value)
+            base = self.path('')
+            if value.startswith(base) and value[len(base):] in self.links:
+                relpath = value[len(base):]
+                continue
+            try:
+                info = h5.h5o.get_info(self.root.file.id, value)
+            except KeyError:
+                return None, None
+            return _KIND.get(info.type, None), info.addr
+        raise RuntimeError("too many levels of soft links at "+relpath)
+
+    def listing(self, relpath="", address=None):
+        """
+        Return the list of (name, relpath, kind, location) for each link in
+        the group at *relpath*.
+        """
+        if address is None:
+            address = self.resolve(relpath)[1] if relpath else self.address
+        prefix = relpath+'/' if relpath else ''
+        return [(name, prefix+name)+self.resolve(link)
+                for name, link in self.children[address]]
+
+    def walk(self, topdown=True):
+        """
+        Walk the indexed tree.  See :func:`walk` for details.
+        """
+        return self._walk(self.root, "", self.address, topdown, set())
+
+    def _walk(self, node, relpath, address, topdown, active):
+        groups, datasets, where = [], [], {}
+        for name, path, kind, location in self.listing(relpath, address):
+            if kind == 'group':
+                child = node[name]
+                groups.append(child)
+                where[id(child)] = (path, location)
+            elif kind == 'dataset':
+                datasets.append(node[name])
+            else:
+                raise TypeError("Expected group or dataset at %s"
+                                %self.path(path))
+        active.add(address)
+        if topdown:
+            yield node, groups, datasets
+        for g in groups:
+            path, location = where[id(g)]
+            # Walk each path to a group, but don't loop on cycles
+            if location in active or location not in self.children:
+                continue
+            for args in self._walk(g, path, location, topdown, active):
+                yield args
+        if not topdown:
+            yield node, groups, datasets
+        active.remove(address)
+
+    def paths(self):
+        """
+        Yield (relpath, kind, location) for every path in the tree.
+        """
+        stack = [("", self.address, set([self.address]))]
+        while stack:
+            relpath, address, active = stack.pop()
+            for _, path, kind, location in self.listing(relpath, address):
+                yield path, kind, location
+                if (kind == 'group' and location not in active
+                    and location in self.children):
+                    stack.append((path, location, active|set([location])))
+
 def walk(node, topdown=True):
     """
     Walk an HDF-5 tree.
 
     Yields a sequence of (parent,groups,datasets).
 
-    *node* is root of the tree, which should be an HDF-5 group.
+    *node* is root of the tree, which should be an HDF-5 group, or a
+    :class:`TreeIndex` of the tree.
 
     *topdown* is true if parent node should be visited before children.
 
@@ -434,24 +843,8 @@ def walk(node, topdown=True):
     the set of groups visited.
     """
     #print "entering walk with",node
-    if not isinstance(node, h5.Group):
-        raise TypeError("must walk a group")
-    groups, datasets = [],[]
-    for n in node.values():
-        if isinstance(n, h5.Dataset):
-            datasets.append(n)
-        elif isinstance(n, h5.Group):
-            groups.append(n)
-        else:
-            raise TypeError("Expected group or dataset")
-    if topdown:
-        yield node, groups, datasets
-        for g in groups:
-            for args in walk(g, topdown=topdown): yield args
-    else:
-        for g in groups:
-            for args in walk(g, topdown=topdown): yield args
-        yield node, groups, datasets
+    index = node if isinstance(node, TreeIndex) else TreeIndex(node)
+    return index.walk(topdown=topdown)
 
 def datasets(root):
     """
@@ -462,30 +855,15 @@ def datasets(root):
     *DAS_logs/Temperature/average_value*, *sample/temperature*,
     *sample/temperature_env/average_value* and *data/temperature*.
 
+    *root* can also be a :class:`TreeIndex` of the tree.
+
     The datasets are not returned in any particular order.
     """
+    index = root if isinstance(root, TreeIndex) else TreeIndex(root)
     datasets = {}
-    links = root.file.id.links
-    for node, _groups, fields in walk(root):
-        for f in fields:
-            # Save name since softlink handling chases down links
-            linkname = f.name
-            # Chase down link to a file location or an external file
-            while True:
-                linkinfo = links.get_info(f.name)
-                if linkinfo.type == h5.h5l.TYPE_SOFT:
-                    f = node[links.get_val(f.name)]
-                    continue
-                elif linkinfo.type == h5.h5l.TYPE_HARD:
-                    location = linkinfo.u
-                    break
-                elif linkinfo.type == h5.h5l.TYPE_EXTERNAL:
-                    location = links.get_value(f.name)
-                    break
-            # Return list associated with location, or create new one
-            linkset = datasets.setdefault(location,[])
-            # Add name to list
-            linkset.append(linkname)
+    for path, kind, location in index.paths():
+        if kind == 'dataset':
+            datasets.setdefault(location,[]).append(index.path(path))
     return list(datasets.values())  # Return copy of items
 
 def _simple_copy(source,target,exact=False):
@@ -541,7 +919,7 @@ def _simple_copy(source,target,exact=False):
             for k,v in obj.attrs.iteritems():
                 t.attrs[k] = v
 
-def tree(self, depth=1, attrs=True, indent=0):
+def tree(self, depth=1, attrs=True, indent=0, limit=None, max_children=None):
     """
     Return the structure of the HDF 5 tree as a string.
 
@@ -552,34 +930,61 @@ def tree(self, depth=1, attrs=True, indent=0):
     *attrs* is False if attributes should be hidden
 
     *indent* is the indent for each line.
+
+    *limit* is the maximum number of lines, or None for no limit.
+
+    *max_children* is the maximum number of fields and of subgroups to
+    show for each group, or None for no limit.
+
+    See :func:`iter_tree` for large files.
     """
-    return "\n".join(_tree_format(group, indent, attrs, depth))
-# Add Tree attribute to h5py Group
+    return "\n".join(iter_tree(self, depth=depth, attrs=attrs, indent=indent,
+                               limit=limit, max_children=max_children))
+# Add Tree attribute to h5py Group and to the in-memory tree Group
 h5.Group.tree = new.instancemethod(tree, None, h5.Group)
+memnexus.Group.tree = new.instancemethod(tree, None, memnexus.Group)
+
+def iter_tree(group, depth=1, attrs=True, indent=0, limit=None,
+              max_children=None):
+    """
+    Iterate over the lines of the structure of the HDF 5 tree.
 
+    Lines are formatted as they are requested, and only the values shown
+    are read from the file: the first string or the first six numbers of
+    a vector, and nothing for higher dimensional fields.  With *depth*,
+    *limit* and *max_children* set, this is safe to use on large files.
 
-def _tree_format(node, indent, attrs, depth):
+    See :func:`tree` for a description of the parameters.
+    """
+    index = TreeIndex(group)
+    lines = _tree_format(index, group, "", index.address, indent, attrs,
+                         depth, max_children)
+    for count, line in enumerate(lines):
+        if limit is not None and count >= limit:
+            yield " "*indent + "..."
+            break
+        yield line
+
+def _tree_format(index, node, relpath, address, indent, attrs, depth,
+                 max_children=None):
     """
     Return an iterator for the lines in a formatted HDF5 tree.
 
     Individual lines are not terminated by newline.
     """
-    if not isinstance(node, h5.Group):
-        raise TypeError("must walk a group")
-
     # Find fields and subgroups within the group; do this ahead of time
     # so that we can show all fields before any subgroups.
     groups, datasets = [],[]
-    for n in node.values():
-        if isinstance(n, h5.Dataset):
-            datasets.append(n)
-        elif isinstance(n, h5.Group):
-            groups.append(n)
+    for name, path, kind, location in index.listing(relpath, address):
+        if kind == 'dataset':
+            datasets.append((name, path))
+        elif kind == 'group':
+            groups.append((name, path, location))
         else:
-            raise TypeError("Expected group or dataset")
+            raise TypeError("Expected group or dataset at %s"%index.path(path))
 
     # Yield group as "nodename(nxclass)"
-    yield "".join( (" "*indent, _group_str(node)) )
+    yield "".join( (" "*indent, _group_str(index, node.name, address)) )
 
     # Yield group attributes as "  @attr: value"
     indent += 2
@@ -588,14 +993,13 @@ def _tree_format(node, indent, attrs, depth):
             yield s
 
     # Yield fields as "  field[NxM]: value"
-    for field in datasets:
+    for name, path in datasets[:max_children]:
+        field = node[name]
         #print field
 
-        # Field name is tail of path
-        name = field.name.split('/')[-1]
-
         # Short circuit links
-        if 'target' in field.attrs and field.attrs['target'] != field.name:
+        if ('target' in field.attrs
+                and field.attrs['target'] != index.path(path)):
             yield "".join( (" "*indent, name, " -> ", field.attrs['target']) )
             continue
 
@@ -607,18 +1011,18 @@ def _tree_format(node, indent, attrs, depth):
             shape = ''
         #shape = '['+'x'.join( str(dim) for dim in field.shape)+']'+str(field.dtype)
 
-        # Format string or numeric value
+        # Format string or numeric value, reading only what is shown
         size = numpy.prod(field.shape)
-        if str(field.dtype).startswith("|S"):
+        if field.dtype.kind in ('S','U','O'):
             if size == 0:
                 value = '['*ndim + ']'*ndim
             elif ndim == 0:
-                value = _limited_str(field.value)
+                value = _limited_str(field[()])
             elif ndim == 1:
                 if size == 1:
-                    value = _limited_str(field.value[0])
+                    value = _limited_str(field[0])
                 else:
-                    value = _limited_str(field.value[0])+', ... '
+                    value = _limited_str(field[0])+', ... '
                 value = '['+value+']'
             else:
                 value = '[[...]]'
@@ -626,16 +1030,12 @@ def _tree_format(node, indent, attrs, depth):
             if size == 0:
                 value = '['*ndim + ']'*ndim
             elif ndim == 0:
-                value = "%g"%field.value
+                value = "%g"%field[()]
             elif ndim == 1:
-                if size == 0:
-                    value = '[]'
-                elif size == 1:
-                    value = "%g"%field.value[0]
-                elif size <= 6:
-                    value = ' '.join("%g"%v for v in field.value)
+                if size <= 6:
+                    value = ' '.join("%g"%v for v in field[:])
                 else:
-                    value =  ' '.join("%g"%v for v in field.value[:6]) + ' ...'
+                    value =  ' '.join("%g"%v for v in field[:6]) + ' ...'
                 value = '['+value+']'
             else:
                 value = '[[...]]'
@@ -647,16 +1047,24 @@ def _tree_format(node, indent, attrs, depth):
         if attrs:
             for s in _yield_attrs(field, indent+2):
                 yield s
+    if max_children is not None and len(datasets) > max_children:
+        yield "".join( (" "*indent, "... %d more fields"
+                        %(len(datasets)-max_children)) )
 
     # Yield groups.
     # If recursive, show group details, otherwise just show name.
     if depth>0:
-        for g in groups:
-            for s in _tree_format(g, indent, attrs, depth-1):
+        for name, path, location in groups[:max_children]:
+            for s in _tree_format(index, node[name], path, location,
+                                  indent, attrs, depth-1, max_children):
                 yield s
     else:
-        for g in groups:
-            yield "".join( (" "*indent, _group_str(g)) )
+        for name, path, location in groups[:max_children]:
+            yield "".join( (" "*indent,
+                            _group_str(index, index.path(path), location)) )
+    if max_children is not None and len(groups) > max_children:
+        yield "".join( (" "*indent, "... %d more groups"
+                        %(len(groups)-max_children)) )
 
 def _yield_attrs(node, indent):
     """
@@ -666,13 +1074,13 @@ def _yield_attrs(node, indent):
         if k not in ("NX_class", "target"):
             yield "".join( (" "*indent, "@", k, ": ", str(node.attrs[k])) )
 
-def _group_str(node):
+def _group_str(index, name, address):
     """
     Return the name and nexus class of a node.
     """
-    if node.name == "/": return "root"
-    nxclass = "("+node.attrs["NX_class"]+")" if "NX_class" in node.attrs else ""
-    return node.name.split("/")[-1] + nxclass
+    if name == "/": return "root"
+    nxclass = "("+index.nxclass[address]+")" if address in index.nxclass else ""
+    return name.split("/")[-1] + nxclass
 
 def _limited_str(s, width=40):
     """
@@ -758,9 +1166,96 @@ def test():
     G2theta = set(('/entry/data/two_theta','/entry/instrument/detector/two_theta'))
     assert (S1 == Gcounts and S2 == G2theta) or (S1 == G2theta and S2 == Gcounts)
 
+    # Soft links and the tree index
+    nxs['/entry/data/soft_counts'] = h5.SoftLink('/entry/instrument/detector/counts')
+    index = TreeIndex(nxs)
+    assert index.nxclass[index.links['entry'][1]] == 'NXentry'
+    assert (index.resolve('entry/data/soft_counts')
+            == index.resolve('entry/data/counts'))
+    assert sorted(len(s) for s in datasets(index)) == [2,3]
+    assert sum(len(d) for _,_,d in walk(index)) == 5
+    del nxs['/entry/data/soft_counts']
+
+    # Bounded tree
+    lines = list(iter_tree(nxs, depth=numpy.inf, attrs=False, max_children=1))
+    assert lines[-2:] == ["      ... 1 more fields", "    ... 1 more groups"]
+    lines = list(iter_tree(nxs, depth=numpy.inf, limit=3))
+    assert len(lines) == 4 and lines[-1] == "..."
+
+    # Streaming frames
+    frames = numpy.arange(5*3*2).reshape(5,3,2)
+    stream = h5nexus.field(detector, 'stream', maxshape=[None,3,2],
+                           dtype='int32', units="counts")
+    h5nexus.extend(stream, frames[:2])
+    h5nexus.append(stream, frames[2])
+    assert (stream[:] == frames[:3]).all()
+    with h5nexus.Appender(stream, buffer_size=2) as appender:
+        appender.append(frames[3])
+        appender.extend(frames)
+        appender.extend(frames[:0])
+        assert len(appender) == 9
+    assert (stream[:] == numpy.vstack((frames[:4],frames))).all()
+
+    # Compression policy
+    policy = CompressionPolicy(1, rules=[
+        {'kind': 'iu', 'rank': 2, 'compression': 'lzf', 'shuffle': True}])
+    frames = h5nexus.field(detector, 'frames', data=numpy.zeros((4,16,16),'i'),
+                           units="counts", policy=policy)
+    assert frames.compression == 'lzf' and frames.shuffle
+    x = h5nexus.field(detector, 'x', data=numpy.arange(1000.), units="mm",
+                      policy=policy)
+    assert x.compression == 'gzip' and x.compression_opts == 1 and not x.shuffle
+    y = h5nexus.field(detector, 'y', data=numpy.arange(10.), units="mm",
+                      policy=policy)
+    assert y.compression is None
+    z = h5nexus.field(detector, 'z', maxshape=[None,1000], units="mm")
+    assert z.compression == 'gzip' and z.compression_opts == 9
+
+    # Chunk planning
+    assert make_chunks([None], 'float64', budget=2**16) == (2**13,)
+    assert make_chunks([None,128,128], 'int32', budget=2**18) == (4,128,128)
+    assert make_chunks([None,1024,1024], 'int32', budget=2**20) == (1,512,512)
+    assert make_chunks([None,128,128], 'int32', budget=2**18,
+                       access='column') == (1024,8,8)
+    assert make_chunks([None,128], 'int32', compression='lzf') == (128,128)
+    assert make_chunks([10,20], 'int32') is None
+
     # All done
     nxs.close()
 
+    # In-memory tree with the same interface
+    mem = h5nexus.open(None, 'tree', creator='test')
+    h5nexus.group(mem, 'entry', 'NXentry')
+    h5nexus.group(mem, '/entry/data', 'NXdata')
+    detector = h5nexus.group(mem, '/entry/detector', 'NXdetector')
+    h5nexus.field(detector, 'counts', data=counts, dtype="int32",
+                  units="counts")
+    h5nexus.link(detector['counts'], '/entry/data/counts')
+    assert (mem['/entry/data/counts'].value == counts).all()
+    assert mem['entry']['data/counts'] is detector.Fcounts
+    assert detector.Fcounts.Aunits == 'counts'
+    assert mem['/entry/data/counts'].attrs['target'] == '/entry/detector/counts'
+    assert [len(s) for s in datasets(mem)] == [2]
+    assert ("      counts -> /entry/detector/counts"
+            in mem.tree(depth=numpy.inf, attrs=False).split('\n'))
+    stream = h5nexus.field(detector, 'stream', maxshape=[None,3], units="mm")
+    h5nexus.extend(stream, numpy.ones((2,3)))
+    h5nexus.append(stream, numpy.zeros(3))
+    assert stream.shape == (3,3) and stream[:,0].tolist() == [1,1,0]
+    import tempfile
+    fid, path = tempfile.mkstemp(suffix='.nxs')
+    os.close(fid)
+    try:
+        mem.save(path)
+        nxs = h5nexus.open(path, 'r')
+        assert (nxs['/entry/data/counts'].value == counts).all()
+        assert nxs.attrs['creator'] == 'test'
+        assert nxs['/entry/detector/stream'].maxshape == (None,3)
+        assert [len(s) for s in datasets(nxs)] == [2,1]
+        nxs.close()
+    finally:
+        os.remove(path)
+
 def main():
     """
     Print a summary tree describing the hdf file.
@@ -774,7 +1269,7 @@ def main():
         for fname in files:
             h = open(fname, "r")
             print "===",fname,"==="
-            print h.tree(attrs=attrs,depth=inf)
+            print h.tree(attrs=attrs,depth=numpy.inf)
             h.close()
     else:
         print "usage: python -m nice.stream.nexus [-a] files"
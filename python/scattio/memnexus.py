@@ -0,0 +1,394 @@
+"""
+In-memory NeXus tree.
+
+This is a pure python/numpy replacement for the h5py File, Group and
+Dataset objects, used when a NeXus structure is built only to be read
+back within the same process, for example when a raw data file is
+converted to NeXus by :func:`formats.load`.  Building the tree does not
+touch HDF-5 and does not compress the data.
+
+The tree is created with *mode="tree"* in :func:`h5nexus.open`, and
+filled in with the usual :func:`h5nexus.group`, :func:`h5nexus.field`
+and :func:`h5nexus.link` calls.  It supports the parts of the h5py
+interface used for reading NeXus files: absolute and relative paths,
+*node.value*, slicing, *node.attrs*, *node.name*, *node.parent*,
+iteration over groups and natural naming (*g.Fname*, *g.Aname*).
+
+Hard links are represented by the same object appearing in more than
+one group.  The *name* of a linked object is the path at which it was
+created.
+
+Use :meth:`File.save` to write the tree to an HDF-5 file, and
+:func:`load` to read an HDF-5 file back into a tree.
+"""
+__all__ = ["File", "Group", "Dataset", "Attrs", "load"]
+
+import numpy
+
+class Attrs(dict):
+    """
+    Attribute dictionary.
+
+    Like h5py, numeric attributes are stored as numpy arrays, with
+    scalars returned as numpy scalars.  Strings are stored unchanged.
+    """
+    def __setitem__(self, key, value):
+        if not isinstance(value, basestring):
+            value = numpy.asarray(value)
+            if value.ndim == 0: value = value[()]
+        dict.__setitem__(self, key, value)
+
+    def update(self, *args, **kw):
+        for k,v in dict(*args, **kw).items(): self[k] = v
+
+    def create(self, name, data, shape=None, dtype=None):
+        if dtype is not None: data = numpy.asarray(data, dtype=dtype)
+        if shape is not None: data = numpy.reshape(data, shape)
+        self[name] = data
+
+class _Node(object):
+    def __init__(self, parent, name):
+        self.parent = parent if parent is not None else self
+        self.name = name
+        self.attrs = Attrs()
+
+    @property
+    def file(self):
+        node = self
+        while node.parent is not node: node = node.parent
+        return node
+
+    # Natural naming, as provided by h5natural for h5py objects
+    def __getattr__(self, key):
+        if key[0] == 'A' and key[1:] in self.attrs:
+            return self.attrs[key[1:]]
+        elif key[0] == 'F' and isinstance(self, Group) and key[1:] in self:
+            return self[key[1:]]
+        raise AttributeError('%r object has no attribute %r'
+                             %(self.__class__.__name__, key))
+
+    def _child_name(self, name):
+        return "/"+name if self.name == "/" else self.name+"/"+name
+
+class Group(_Node):
+    """
+    NeXus group, with children accessed by path.
+    """
+    def __init__(self, parent, name):
+        _Node.__init__(self, parent, name)
+        self._children = {}
+
+    def _lookup(self, path):
+        """
+        Return the parent group and child name for *path*.
+
+        Raises KeyError if the parent group does not exist.
+        """
+        node = self.file if path.startswith('/') else self
+        parts = [p for p in path.split('/') if p and p != '.']
+        if not parts:
+            return None, node
+        for p in parts[:-1]:
+            node = node._children.get(p) if isinstance(node, Group) else None
+            if node is None:
+                raise KeyError("Path %s doesn't exist"%path)
+        if not isinstance(node, Group):
+            raise KeyError("Path %s doesn't exist"%path)
+        return node, parts[-1]
+
+    def __getitem__(self, path):
+        parent, child = self._lookup(path)
+        if parent is None: return child
+        try:
+            return parent._children[child]
+        except KeyError:
+            raise KeyError("Path %s doesn't exist"%path)
+
+    def get(self, path, default=None):
+        try:
+            return self[path]
+        except KeyError:
+            return default
+
+    def __contains__(self, path):
+        try:
+            self[path]
+        except KeyError:
+            return False
+        return True
+
+    def __setitem__(self, path, obj):
+        """
+        Link *obj* into the tree at *path*, or create a dataset if *obj*
+        is not a node.
+        """
+        if not isinstance(obj, _Node):
+            self.create_dataset(path, data=obj)
+            return
+        parent, child = self._lookup(path)
+        if parent is None or child in parent._children:
+            raise RuntimeError("Unable to create link (name already exists)")
+        parent._children[child] = obj
+
+    def __delitem__(self, path):
+        parent, child = self._lookup(path)
+        if parent is None: raise KeyError("Can't delete the root group")
+        del parent._children[child]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._children)
+
+    def keys(self):
+        return sorted(self._children.keys())
+
+    def values(self):
+        return [self._children[k] for k in self.keys()]
+
+    def items(self):
+        return [(k,self._children[k]) for k in self.keys()]
+
+    iterkeys = __iter__
+    def itervalues(self): return iter(self.values())
+    def iteritems(self): return iter(self.items())
+
+    def _new_child(self, path, cls, *args):
+        parent, child = self._lookup(path)
+        if parent is None or child in parent._children:
+            raise ValueError("Unable to create %s (name already exists)"%path)
+        node = cls(parent, parent._child_name(child), *args)
+        parent._children[child] = node
+        return node
+
+    def create_group(self, path):
+        """
+        Create a group at *path*.  The parent group must exist.
+        """
+        return self._new_child(path, Group)
+
+    def require_group(self, path):
+        node = self.get(path)
+        return node if node is not None else self.create_group(path)
+
+    def create_dataset(self, path, shape=None, dtype=None, data=None,
+                       maxshape=None, **kw):
+        """
+        Create a dataset at *path*.
+
+        Storage keywords such as *chunks* and *compression* are recorded
+        on the dataset so that they can be used by :meth:`File.save`.
+        """
+        if data is not None:
+            data = numpy.array(data, dtype=dtype)
+            if shape is not None: data = data.reshape(shape)
+        else:
+            dtype = numpy.dtype(dtype if dtype is not None else 'float32')
+            data = numpy.zeros(shape, dtype=dtype)
+        return self._new_child(path, Dataset, data, maxshape, kw)
+
+    def visititems(self, func):
+        """
+        Call *func(name, node)* for each object below the group, with
+        *name* relative to the group.  Like h5py, each object is visited
+        only once.  The visit stops if *func* returns anything but None.
+        """
+        seen = set([id(self)])
+        stack = [("", self)]
+        while stack:
+            prefix, group = stack.pop(0)
+            for k,node in group.items():
+                if id(node) in seen: continue
+                seen.add(id(node))
+                name = prefix+k
+                result = func(name, node)
+                if result is not None: return result
+                if isinstance(node, Group): stack.append((name+"/", node))
+
+    def visit(self, func):
+        return self.visititems(lambda name,node: func(name))
+
+    def __repr__(self):
+        return '<memnexus group "%s" (%d members)>'%(self.name, len(self))
+
+class Dataset(_Node):
+    """
+    NeXus field, stored as a numpy array.
+
+    Like h5py, indexing the dataset returns a copy of the data.
+    """
+    def __init__(self, parent, name, data, maxshape=None, storage={}):
+        _Node.__init__(self, parent, name)
+        self._data = data
+        self.maxshape = tuple(maxshape) if maxshape is not None else data.shape
+        self.chunks = storage.get('chunks', None)
+        self.compression = storage.get('compression', None)
+        self.compression_opts = storage.get('compression_opts', None)
+        self.shuffle = storage.get('shuffle', False)
+
+    shape = property(lambda self: self._data.shape)
+    dtype = property(lambda self: self._data.dtype)
+    size = property(lambda self: self._data.size)
+    ndim = property(lambda self: self._data.ndim)
+    value = property(lambda self: self[()])
+
+    def __len__(self):
+        return len(self._data)
+
+    def __getitem__(self, key):
+        value = self._data[key]
+        return value.copy() if isinstance(value, numpy.ndarray) else value
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+
+    def __array__(self, dtype=None):
+        return numpy.asarray(self._data, dtype=dtype)
+
+    def resize(self, size, axis=None):
+        """
+        Resize the dataset.  Extensible dimensions are those with
+        None in *maxshape*.
+        """
+        if axis is not None:
+            shape = list(self.shape)
+            shape[axis] = size
+            size = shape
+        size = tuple(size)
+        for n,limit in zip(size, self.maxshape):
+            if limit is not None and n > limit:
+                raise ValueError("Unable to resize %s beyond maxshape"%self.name)
+        data = numpy.zeros(size, dtype=self.dtype)
+        common = tuple(slice(0,min(a,b)) for a,b in zip(size, self.shape))
+        data[common] = self._data[common]
+        self._data = data
+
+    def __repr__(self):
+        return '<memnexus dataset "%s": shape %s, type "%s">'%(
+            self.name, self.shape, self.dtype.str)
+
+class File(Group):
+    """
+    Root of an in-memory NeXus tree.
+    """
+    def __init__(self, filename, mode="a"):
+        Group.__init__(self, None, "/")
+        self.filename = filename
+        self.mode = mode
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def save(self, filename, compression=None, file_name=None):
+        """
+        Write the tree to the HDF-5 file *filename*.
+
+        Fields are compressed according to the
+        :class:`h5nexus.CompressionPolicy` *compression*, or
+        *h5nexus.COMPRESSION* if none is given, unless compression was
+        given when the field was created.  Hard links are preserved.
+        The root attributes are copied, but *file_name* is set to
+        *file_name*, or to *filename* if it is not given, which allows
+        the file to be written under a temporary name and moved later.
+        """
+        from . import h5nexus
+        policy = compression if compression is not None else h5nexus.COMPRESSION
+        root = h5nexus.open(filename, mode="w")
+        try:
+            if file_name is not None: root.attrs['file_name'] = file_name
+            for k,v in self.attrs.items():
+                if k not in ('file_name', 'HDF5_Version'): root.attrs[k] = v
+            created = {}
+            def write(name, node):
+                if isinstance(node, Group):
+                    target = root.create_group(name)
+                else:
+                    target = _save_dataset(root, name, node, policy)
+                created[id(node)] = target
+                target.attrs.update(node.attrs)
+            self.visititems(write)
+            # Hard links are the objects visited under another name
+            for group_name, group in [("", self)] + [
+                    (k, v) for k,v in _groups(self)]:
+                for k,node in group.items():
+                    path = group_name+"/"+k
+                    if path.lstrip('/') not in root:
+                        root[path] = created[id(node)]
+        finally:
+            root.close()
+
+def load(filename):
+    """
+    Read the HDF-5 file *filename* into a :class:`File` tree.
+
+    Hard links are preserved.  Extensible fields keep their *maxshape*
+    and chunks, but the compression of the file is not recorded, so a
+    saved copy uses the compression policy given to :meth:`File.save`.
+    """
+    import h5py as h5
+    source = h5.File(filename, 'r')
+    try:
+        root = File(filename)
+        root.attrs.update(source.attrs.items())
+        address = lambda node: h5.h5o.get_info(node.id).addr
+        nodes = {address(source): root}
+        stack = [(source, root)]
+        while stack:
+            group, target = stack.pop(0)
+            for k in group:
+                node = group.get(k)
+                if node is None: continue # dangling soft link
+                addr = address(node)
+                if addr in nodes:
+                    target[k] = nodes[addr]
+                    continue
+                if isinstance(node, h5.Group):
+                    child = target.create_group(k)
+                    stack.append((node, child))
+                else:
+                    child = target.create_dataset(k, data=node[()],
+                                                  maxshape=node.maxshape,
+                                                  chunks=node.chunks)
+                child.attrs.update(node.attrs.items())
+                nodes[addr] = child
+    finally:
+        source.close()
+    return root
+
+def _groups(group):
+    """
+    Return (path, group) for each group below *group*, following links.
+    """
+    result, stack, seen = [], [("", group)], set([id(group)])
+    while stack:
+        prefix, node = stack.pop(0)
+        for k,child in node.items():
+            if isinstance(child, Group) and id(child) not in seen:
+                seen.add(id(child))
+                result.append((prefix+"/"+k, child))
+                stack.append((prefix+"/"+k, child))
+    return result
+
+def _save_dataset(root, name, node, policy):
+    opts = {}
+    if node.compression is not None:
+        opts.update(compression=node.compression, shuffle=node.shuffle)
+        if node.compression_opts is not None:
+            opts['compression_opts'] = node.compression_opts
+    elif node.size:
+        opts.update(policy.options(node.dtype, node.shape))
+    if node.maxshape != node.shape or not all(node.shape):
+        opts['maxshape'] = tuple((None if n is None or n == 0 else n)
+                                 for n in node.maxshape)
+        if node.chunks is not None: opts['chunks'] = node.chunks
+    return root.create_dataset(name, data=node._data, **opts)
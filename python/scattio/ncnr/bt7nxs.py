@@ -12,10 +12,9 @@ import numpy
 import iso8601
 import h5nexus
 
-from . import jsonutil
 from . import iceformat
 from .utils import format_timestamp, template
-from .write_nexus import write_nexus, main_driver
+from .write_nexus import write_nexus, load_layout, main_driver
 
 # FIXME: these names need to be kept in sync with the names used in bt7.json
 _ICE_TO_NICE = {
@@ -167,7 +166,7 @@ def convert(infile, outfile=":entry"):
     """
     icedata = iceformat.read(infile)
     nicedata = bt7_ice_to_nice(icedata)
-    nexus_layout = jsonutil.relaxed_load(template("bt7nxs.json"))
+    nexus_layout = load_layout(template("bt7nxs.json"))
     #import pprint; pprint.pprint(nexus_layout)
     if not outfile:
         outfile = os.path.basename(os.path.splitext(infile)[0]) + ":entry"
@@ -20,6 +20,13 @@ or just read in the metadata::
      F = iceformat.summary(path)
      print F.metadata
 
+or follow a file which is still being written::
+
+     import iceformat
+     F = iceformat.ICE(path).follow()
+     ...
+     if F.refresh(): print F.data['Detector'][-1]
+
 The returned data object *F* has the following attributes:
 
     *path*
@@ -41,14 +48,14 @@ The returned data object *F* has the following attributes:
     *data*
 
         Set of data columns, with data['ColumnName'] giving the values.
-        Numerical data has already been converted to numbers.  The remaining
-        data are saved as strings.  Some columns have been renamed for
-        consistency and clarity.
+        Numerical data has already been converted to float64 arrays, with
+        'N/A' stored as NaN.  The remaining data are saved as string arrays.
+        Some columns have been renamed for consistency and clarity.
 
 See the :ref:`bt7format` for a description of the *metadata* and *data*
 fields.
 """
-__all__ = ['ICE','read','summary','undo_camel_case','main']
+__all__ = ['ICE','read','summary','sniff','undo_camel_case','main']
 import sys
 import time
 import re
@@ -56,7 +63,9 @@ import os
 
 import numpy as N
 
+from . import fileio
 from .scanparser import parse_scan
+from .utils import LazyCounts
 
 MACS_MONOCHROMATOR_BLADES = ['MonBlade%02d'%d for d in range(1,22)]
 MACS_ANALYZER_BLADES = ['AnalyzerTheta%02d'%d for d in range(1,21)]
@@ -173,6 +182,12 @@ _RENAME_COLUMNS = {
     #'DFMRot': 'MonoRot',  # drop 'DFM'; it appears to duplicate DFMRot
 }
 
+# Columns which always contain text, even if the first value looks numeric
+_TEXT_COLUMNS = set([
+    'Flip', 'FilTran', 'HKL', 'PreMonoColl',
+    'AColMon', 'BColMon', 'BeFilMon', 'MgFilMon', 'PgFilMon', # MACS
+    ])
+
 # Special field formats
 _FIELD_FORMATTERS = dict(
     Path = lambda F,k: F.path,
@@ -187,6 +202,17 @@ _FIELD_FORMATTERS = dict(
     FixedE = lambda F,k: "%s=%g"%(F.metadata[k]) if k in F.metadata else ""
     )
 
+# Special field formats which need the data as well as the header
+_DATA_FORMATTERS = set(['ScanRanges', 'ScanVarying'])
+
+# Metadata and columns which are computed from the data
+_DERIVED_FIELDS = set([
+    'PreMonoCollType', 'PreMonoCollDivergence',
+    'PostAnaCollType', 'PostAnaCollDivergence',
+    'DiffGroup', 'SpecGroup',
+    'TimeStamp', 'Ei', 'Ef',
+    ])
+
 # Fields to include by default when summarizing
 _DEFAULT_FIELDS = [
     #
@@ -278,12 +304,19 @@ class ICE(object):
         self.metadata = {}
         self.data = {}
         self.header = ""
+        self._header_end = None  # file offset of the first data line
+        self._columns = []     # columns stored in the file
+        self._npoints = 0      # points read so far
+        self._offset = None    # end of the last complete line when following
+        self._buffers = None   # column storage when following
+        self._lazy = []        # detector columns not yet read
+        self._counts = None    # LazyCounts for the detector columns
 
     def summary(self):
         """
         Read the header section of the file, not the data.
         """
-        file = open(self.path, 'r')
+        file = fileio.open(self.path)
         self._readheader(file, self.path)
         file.close()
         return self
@@ -292,19 +325,73 @@ class ICE(object):
     def instrument(self):
         return "MACS" if self.metadata.get('InstrName','')=="NG0" else "BT7"
 
-    def read(self, maxlines=N.Inf):
+    def read(self, maxlines=N.Inf, lazy=False):
         """
         Read the header and data
+
+        If the header has already been read by :meth:`summary` then it is
+        not parsed again; instead the data is read starting from the end
+        of the header.
+
+        If *lazy*, the columns in the detector groups are not stored in
+        *data*.  They are read from the file by :meth:`group` and
+        :meth:`counts` when needed, and kept only as long as they fit in
+        :data:`utils.COUNTS_CACHE` or are otherwise in use.
         """
-        file = open(self.path, 'r')
+        file = fileio.open(self.path)
+        if self._header_end is not None and not self.data:
+            file.seek(self._header_end)
+        else:
+            self._readheader(file, self.path)
+        self._buffers = self._offset = None
+        self._readdata(file, maxlines=maxlines, lazy=lazy)
+        file.close()
+        return self
+
+    def follow(self):
+        """
+        Read the header and data, and prepare for :meth:`refresh`.
+
+        Use this rather than :meth:`read` for a file which is still being
+        written, such as during a live scan.  Only complete lines are read.
+        The data columns are stored with spare capacity so that new points
+        can be added cheaply.
+        """
+        file = fileio.open(self.path)
         self._readheader(file, self.path)
-        if self.instrument == "MACS":
-            self.metadata['DiffGroup'] = MACS_DIFF_GROUP
-            self.metadata['SpecGroup'] = MACS_SPEC_GROUP
-        self._readdata(file, maxlines=maxlines)
+        self._buffers, self._offset = {}, self._header_end
+        self._readdata(file, maxlines=N.Inf)
         file.close()
         return self
 
+    def refresh(self):
+        """
+        Read the points added to the file since :meth:`follow` or the last
+        :meth:`refresh`, extending the data columns and the derived columns
+        such as TimeStamp, Ei and Ef.
+
+        Only the new part of the file is parsed.  If the file has been
+        replaced by a shorter one or a column changes from numeric to text
+        then the whole file is read again.
+
+        Returns the number of points added.
+        """
+        if self._offset is None:
+            raise RuntimeError("Use follow() before refresh() on '%s'"%self.path)
+        if os.path.getsize(self.path) < self._offset:
+            self.follow()
+            return self._npoints
+        file = fileio.open(self.path)
+        file.seek(self._offset)
+        rows = self._readrows(file, maxlines=N.Inf)
+        file.close()
+        start = self._npoints
+        try:
+            self._add_rows(rows)
+        except _ColumnTypeChanged:
+            self.follow()
+        return self._npoints - start
+
     def group(self, name):
         """
         Convert a detector group into a numpy array.
@@ -319,11 +406,12 @@ class ICE(object):
 
         # Make sure the group exists and has data
         columns = self.metadata.get(name, [])
-        if not columns or any(c not in self.data for c in columns):
+        if not columns or any(c not in self.data and c not in self._lazy
+                              for c in columns):
             return N.empty((0,0),'int32')
 
         # Gather data columns for the group into one list
-        block = [self.data[d] for d in columns]
+        block = [self._column(d) for d in columns]
 
         # Return the data as a transposed array so that points
         # are the first dimension
@@ -363,7 +451,7 @@ class ICE(object):
             group = self.metadata['AnalyzerDDGroup']
         else:
             group = self.metadata['AnalyzerDetectorDevicesOfInterest']
-        counts = N.array([self.data[c] for c in group])
+        counts = N.array([self._column(c) for c in group])
         if not group[0].startswith('PSD'):
             counts = N.sum(counts, axis=0)
         return counts
@@ -559,45 +647,134 @@ class ICE(object):
         self.metadata = metadata
 
         self.header = "\n".join(header)
+        self._header_end = file.tell()
 
-    def _readdata(self, file, maxlines):
+    def _readdata(self, file, maxlines, lazy=False):
         """
         Read the data columns, converting those that we can into numbers.
         """
-        data = [[] for _ in self.metadata['Columns']]
-        count = 0
-        while True:
-            line = file.readline()
-            if line == '':
-                break
+        if self.instrument == "MACS":
+            self.metadata['DiffGroup'] = MACS_DIFF_GROUP
+            self.metadata['SpecGroup'] = MACS_SPEC_GROUP
+        self._columns = list(self.metadata['Columns'])
+        self._npoints = 0
+        self.data = {}
+        self._lazy, self._counts = [], None
+        if lazy:
+            grouped = set()
+            for name in self.detector_groups:
+                grouped.update(self.metadata.get(name, []))
+            self._lazy = [c for c in self._columns if c in grouped]
+            self._counts = LazyCounts(self._loadcounts)
+        self._add_rows(self._readrows(file, maxlines))
+
+    def _loadcounts(self):
+        """
+        Read the detector columns skipped by a lazy :meth:`read`, returning
+        them as an array with one row per column.
+        """
+        file = fileio.open(self.path)
+        try:
+            file.seek(self._header_end)
+            rows = self._readrows(file, self._npoints)[:self._npoints]
+        finally:
+            file.close()
+        if len(rows) != self._npoints:
+            raise IOError("ICE file '%s' changed while reading"%self.path)
+        keep = set(self._lazy)
+        skip = [c for c in self._columns if c not in keep]
+        columns = _parse_columns(self._columns, rows, self.path, skip=skip)
+        return N.array([columns[c] for c in self._lazy])
+
+    def _column(self, name):
+        """
+        Return the values in column *name*, reading the detector columns
+        if they were skipped by a lazy :meth:`read`.
+        """
+        if name in self.data or not self._lazy:
+            return self.data[name]
+        return self._counts()[self._lazy.index(name)]
+
+    def _readrows(self, file, maxlines):
+        """
+        Split the data lines into tokens, skipping comments.
+
+        When following the file, stop at the last complete line and
+        advance the file offset past it.
+        """
+        if self._offset is not None:
+            text = file.read()
+            end = text.rfind('\n') + 1
+            self._offset += end
+            lines = text[:end].splitlines()
+        else:
+            lines = file
+        rows = []
+        for line in lines:
             if line.startswith("#"):
                 continue
-            values = line.strip().split()
-            for i,v in enumerate(line.strip().split()):
-                try:
-                    data[i].append(float(v))
-                except ValueError:
-                    if v == 'N/A':
-                        data[i].append(N.NaN)
-                    else:
-                        data[i].append(v)
-                except IndexError:
-                    print >>sys.stderr,"Line too long in",self.path
-                    break
-            count += 1
-            if count >= maxlines:
+            values = line.split()
+            if not values:
+                continue
+            rows.append(values)
+            if len(rows) >= maxlines:
                 break
+        return rows
 
-        self.data = dict(zip(self.metadata['Columns'],data))
-        self._fix_timestamp()
-        self._guess_monochromator_collimator()
-        self._guess_analyzer_collimator()
-        self._fix_varying()
-        self._fix_EiEf()
+    def _add_rows(self, rows):
+        """
+        Add rows of tokens to the data, then fill in the derived columns
+        for the new points.
+        """
+        start = self._npoints
+        if start > 0 and not rows:
+            return
+        # Columns which are already text stay text, so only a change from
+        # numeric to text requires the file to be read again.
+        text = [k for k,v in self.data.items() if v.dtype.kind == 'S']
+        columns = _parse_columns(self._columns, rows, self.path,
+                                 skip=self._lazy, text=text)
+        if start > 0 and any(v.dtype.kind != self.data[k].dtype.kind
+                             for k,v in columns.items()):
+            raise _ColumnTypeChanged()
+        for k,v in columns.items():
+            self._set_column(k, v, start)
+        self._npoints = start + len(rows)
+
+        self._fix_timestamp(start)
+        if start == 0:
+            self._guess_monochromator_collimator()
+            self._guess_analyzer_collimator()
+            self._fix_varying()
+        self._fix_EiEf(start)
 
         #self._generate_collimator_deltas()
         #self._generate_flipper_current_ratios()
 
+    def _set_column(self, name, values, start=0):
+        """
+        Store values in column *name* starting at point *start*.
+
+        When following the file, the column is a view into a buffer which
+        doubles in size whenever it runs out of room.
+        """
+        if self._buffers is None:
+            self.data[name] = values
+            return
+        n = start + len(values)
+        buffer = self._buffers.get(name, None)
+        if (buffer is None or n > len(buffer)
+                or values.dtype.itemsize > buffer.dtype.itemsize):
+            size = n if buffer is None else max(n, 2*len(buffer))
+            dtype = (values.dtype if buffer is None
+                     else N.promote_types(buffer.dtype, values.dtype))
+            grown = N.empty(size, dtype)
+            if buffer is not None:
+                grown[:start] = buffer[:start]
+            buffer = self._buffers[name] = grown
+        buffer[start:n] = values
+        self.data[name] = buffer[:n]
+
     def _guess_monochromator_collimator(self):
         
         try:
@@ -696,35 +873,43 @@ class ICE(object):
             self.data['EfFlipRatio'] = N.array(self.data['EFflip'])/N.sqrt(N.array(self.data['Ef']))
             self.metadata['Columns'].extend('EfFlipRatio')
 
-    def _fix_EiEf(self):
+    def _fix_EiEf(self, start=0):
         """
         Create Ei/Ef columns if they are missing.
+
+        Only points from *start* onward are computed.
         """
         # TODO: can compute Ei from A1-A2 and Ef from A5-A6
         if 'E' in self.data and 'FixedE' in self.metadata:
-            delta = N.array(self.data['E'])
+            delta = N.asarray(self.data['E'][start:])
             base,value = self.metadata['FixedE']
-            if not 'Ef' in self.data:
+            if not 'Ef' in self._columns:
                 if base == 'Ef':
-                    self.data['Ef'] = N.ones_like(delta)*value
+                    self._set_column('Ef', N.ones_like(delta)*value, start)
                 else:
-                    self.data['Ef'] = delta+value
-            if not 'Ei' in self.data:
+                    self._set_column('Ef', delta+value, start)
+            if not 'Ei' in self._columns:
                 if base == 'Ei':
-                    self.data['Ei'] = N.ones_like(delta)*value
+                    self._set_column('Ei', N.ones_like(delta)*value, start)
                 else:
-                    self.data['Ei'] = delta+value
+                    self._set_column('Ei', delta+value, start)
 
-    def _fix_timestamp(self):
+    def _fix_timestamp(self, start=0):
         """
         If there is no timestamp on the data, create one
+
+        Only points from *start* onward are computed.
         """
-        if 'TimeStamp' not in self.data:
-            epoch = self.metadata['Epoch']
+        if 'TimeStamp' not in self._columns:
             point_times = self.data['Time']
-            timestamp = N.cumsum([epoch]+point_times[:-1])
-            self.metadata['Columns'].append('TimeStamp')
-            self.data['TimeStamp'] = timestamp
+            if start == 0:
+                epoch = self.metadata['Epoch']
+            else:
+                epoch = self.data['TimeStamp'][start-1] + point_times[start-1]
+            timestamp = N.cumsum(N.hstack(([epoch],point_times[start:-1])))
+            if 'TimeStamp' not in self.metadata['Columns']:
+                self.metadata['Columns'].append('TimeStamp')
+            self._set_column('TimeStamp', timestamp, start)
 
     def _fix_varying(self):
         """
@@ -758,6 +943,62 @@ class ICE(object):
 
 
 
+class _ColumnTypeChanged(Exception):
+    """
+    Raised when new data for a column does not match the type so far.
+    """
+
+def _parse_columns(names, rows, path, skip=(), text=()):
+    """
+    Convert rows of tokens into a dictionary of named columns.
+
+    Columns are numeric unless they are known to be text, are named in
+    *text*, or the value in the first row is not a number, and numeric
+    columns are converted in bulk into float64 arrays with 'N/A' stored
+    as NaN.  Text columns are returned as string arrays.  Columns named
+    in *skip* are not converted.
+    """
+    ncolumns = len(names)
+    for i,values in enumerate(rows):
+        if len(values) > ncolumns:
+            print >>sys.stderr,"Line too long in",path
+            rows[i] = values[:ncolumns]
+        elif len(values) < ncolumns:
+            rows[i] = values + ['N/A']*(ncolumns-len(values))
+    if rows:
+        tokens = N.array(rows, 'S')
+    else:
+        tokens = N.empty((0,ncolumns), 'S1')
+
+    skip, text = set(skip), set(text)
+    numeric = [j for j,c in enumerate(names)
+               if c not in _TEXT_COLUMNS and c not in skip and c not in text
+               and (not rows or _isnumber(rows[0][j]))]
+    block = tokens[:,numeric]
+    block[block == 'N/A'] = 'nan'
+    try:
+        values = block.T.astype('d', order='C')
+    except ValueError:
+        # Some column which started out numeric isn't; find out which
+        values = [None]*len(numeric)
+        for k in range(len(numeric)):
+            try:
+                values[k] = block[:,k].astype('d')
+            except ValueError:
+                numeric[k] = None
+
+    data = dict((names[j],v) for j,v in zip(numeric,values) if j is not None)
+    data.update((c,tokens[:,j].copy()) for j,c in enumerate(names)
+                if j not in numeric and c not in skip)
+    return data
+
+def _isnumber(s):
+    try:
+        float(s)
+        return True
+    except ValueError:
+        return s == 'N/A'
+
 def _parse_keyval(line):
     """
     Split '#key value' into key,value pair.
@@ -782,16 +1023,25 @@ def undo_camel_case(names):
     return [all_cap.sub(r'\1_\2', first_cap.sum(r'\1\2', si)).lower()
             for si in names]
 
+def sniff(head, size):
+    """
+    Return True if the start of the file *head* looks like an ICE header,
+    which is a series of comment lines.
+    """
+    return head.startswith('#')
+
 def summary(path):
     """
     Open the fiile and read the data header.
     """
     return ICE(path).summary()
-def read(path):
+def read(path, lazy=False):
     """
     Open and read the file.
+
+    If *lazy*, the detector columns are read when first used.
     """
-    return ICE(path).read()
+    return ICE(path).read(lazy=lazy)
 
 # ============================================
 # Test, demo, driver code
@@ -803,6 +1053,72 @@ def test():
     F = read(example('bt7','201102-16363-largeq_90397.bt7'))
     assert abs(F.data['A2'][-1] - 23.2682) < 1e-5
     assert F.metadata['ScanVarying'][0] == 'E'
+    assert F.data['A2'].dtype == N.float64
+    assert F.data['Flip'][0] == 'A'
+    assert N.isnan(F.data['PostMonoColl']).all()  # all N/A
+
+    # Header only fields don't need the data, but can read it later
+    G = summary(F.path)
+    assert not _needs_data(G, ['Path','Date','ScanTitle','Npoints'])
+    assert not _needs_data(G, ['Path','NotAField'])
+    assert _needs_data(G, ['Path','A2'])
+    assert abs(G.read().data['A2'][-1] - 23.2682) < 1e-5
+
+    # Detector columns can be read on first use, and dropped
+    L = read(F.path, lazy=True)
+    assert 'SDC0' in F.data and 'SDC0' not in L.data
+    assert not L._counts.loaded
+    assert (L.counts() == F.counts()).all()
+    for name in ICE.detector_groups:
+        assert (L.group(name) == F.group(name)).all(), name
+    L._counts.drop()
+    assert (L.data['A2'] == F.data['A2']).all()
+    assert (L.group('AnalyzerSDGroup') == F.group('AnalyzerSDGroup')).all()
+
+    # Follow a file as it is written, starting with a partial line
+    import tempfile
+    lines = open(F.path).readlines()
+    ndata = lines.index([L for L in lines if not L.startswith('#')][0])
+    fd,path = tempfile.mkstemp(suffix='.bt7')
+    try:
+        os.write(fd, "".join(lines[:ndata+2])+lines[ndata+2][:20])
+        G = ICE(path).follow()
+        assert len(G) == 2
+        os.write(fd, lines[ndata+2][20:])
+        assert G.refresh() == 1
+        os.write(fd, "".join(lines[ndata+3:]))
+        assert G.refresh() == len(F)-3
+        assert G.refresh() == 0
+    finally:
+        os.close(fd)
+        os.unlink(path)
+    assert sorted(G.data.keys()) == sorted(F.data.keys())
+    for k,v in F.data.items():
+        assert ((G.data[k] == v) | (v != v)).all(), k  # v != v for NaN
+
+    # A text value in a numeric column causes one full read, after which
+    # the new points are added to the text column
+    column = F.metadata['Columns'].index('A2')
+    tokens = lines[ndata+3].split()
+    tokens[column] = 'ERR'
+    lines[ndata+3] = " ".join(tokens)+"\n"
+    fd,path = tempfile.mkstemp(suffix='.bt7')
+    try:
+        os.write(fd, "".join(lines[:ndata+3]))
+        G = ICE(path).follow()
+        buffers = G._buffers
+        os.write(fd, lines[ndata+3])
+        assert G.refresh() == 1 and G._buffers is not buffers
+        buffers = G._buffers
+        for line in lines[ndata+4:]:
+            os.write(fd, line)
+            assert G.refresh() == (0 if line.startswith('#') else 1)
+        assert G._buffers is buffers
+        assert G.data['A2'][3] == 'ERR' and len(G) == len(F)
+        assert (G.data['A2'] == read(path).data['A2']).all()
+    finally:
+        os.close(fd)
+        os.unlink(path)
 
 def demo():
     """
@@ -867,7 +1183,9 @@ def _tabulate(files, fields=_DEFAULT_FIELDS):
     print ",".join(fields)
     for f in files:
         try:
-            F = ICE(f).read()
+            F = ICE(f).summary()
+            if _needs_data(F, fields):
+                F.read()
         except:
             import traceback, sys
             print >>sys.stderr, "===== %s ====="%f
@@ -875,6 +1193,23 @@ def _tabulate(files, fields=_DEFAULT_FIELDS):
             continue
         print ",".join(_format(F,c) for c in fields)
 
+def _needs_data(file, fields):
+    """
+    Return True if any of the fields cannot be formatted from the header.
+
+    This includes data columns, columns and metadata derived from the
+    data such as the collimator types, and the scan ranges, whose names
+    are matched against the data columns.  Fields which are in neither
+    the header nor the column list are formatted as empty.
+    """
+    columns = file.metadata['Columns']
+    return any(field in _DATA_FORMATTERS
+               or field in _DERIVED_FIELDS
+               or (field not in _FIELD_FORMATTERS
+                   and field not in file.metadata
+                   and field in columns)
+               for field in fields)
+
 def _format(file,field):
     """
     Format metadata for printing
@@ -887,7 +1222,7 @@ def _format(file,field):
         # Generic metadata
         v = str(file.metadata[field]).replace('\n',r'\n').replace('"','""')
         return '"%s"'%v
-    elif field in file.data and file.data[field] != []:
+    elif field in file.data and len(file.data[field]) > 0:
         # Generic data
         return _compact_range(file.data[field])
     else:
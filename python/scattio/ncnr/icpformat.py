@@ -9,113 +9,170 @@ ICP data reader.
 summary(filename)  - reads the header information
 read(filename) - reads header information and data
 """
-__all__ = ["ICP", "read", "summary", "data", "plot"]
+__all__ = ["ICP", "read", "summary", "data", "plot", "sniff"]
 
+import os
 import numpy as N
 import datetime,sys
+from array import array
 
-# Try using precompiled matrix loader
-try:
-    from reflectometry.reduction import _reduction
-    def parsematrix(s, shape=None, linenum=0):
-        """
-        Parse a string into a matrix.  Provide a shape parameter if you
-        know the expected matrix size.
-        """
-        if shape != None:
-            # Have an existing block, so we know what size to allocate
-            z = N.empty(shape,'i')
-            i,j = _reduction.str2imat(s,z)
-            if i*j != z.size:
-                raise IOError,"Inconsistent dims at line %d"%linenum
-        else:
-            # No existing block.  Worst case is 2 bytes per int.
-            n = int(len(s)/2+1)
-            z = N.empty(n,'i')
-            i,j = _reduction.str2imat(s,z)
-            # Keep the actual size
-            if i==1 or j==1:
-                z = z[:i*j].reshape(i*j)
-            else:
-                z = z[:i*j].reshape(i,j)
-        return z
-except:
-    def parsematrix(s,shape=None,linenum=0):
-        """
-        Parse a string into a matrix.  Provide a shape parameter if you
-        know the expected matrix size.
-        """
-        z = N.matrix(s,'i').A
-        i,j = z.shape
-        if i==1 or j==1:
-            z = z.reshape(i*j)
-        if shape != None and N.any(z.shape != shape):
-            raise IOError,"Inconsistent dims at line %d"%linenum
-        return z
+from . import fileio
+from .utils import LazyCounts
+
+# Number of column lines converted together by readdata
+_CHUNK_ROWS = 4096
+
+def parseblocks(blocks, linenums=None):
+    """
+    Parse the text of PSD detector blocks into an array of counts.
+
+    Values in a block are separated by commas, with rows of an area
+    detector separated by semicolons.  Returns an int32 array of shape
+    (len(blocks), pixels) for linear detectors or (len(blocks), ny, nx)
+    for area detectors, which is filled in one block at a time.
 
+    *linenums* gives the line number of each block for error messages.
+    Raises IOError if the blocks are not all the same shape or contain
+    something other than integers.
+    """
+    if linenums is None: linenums = range(1, len(blocks)+1)
+    if not blocks: return N.empty((0,0),'i')
+    ny, shape = _blockshape(blocks[0])
+    Z = N.empty((len(blocks),)+shape, 'i')
+    for k,(s,linenum) in enumerate(zip(blocks, linenums)):
+        _fillblock(Z[k], ny, s, linenum)
+    return Z
+
+def _blockshape(s):
+    """
+    Return the number of semicolon separated rows in the detector block
+    *s* and the shape of its frame.
+    """
+    ny = s.count(';') + 1
+    size = s.count(',') + ny
+    nx = size//ny
+    return ny, ((ny, nx) if ny > 1 and nx > 1 else (size,))
+
+def _fillblock(frame, ny, s, linenum):
+    """
+    Convert the detector block *s* with *ny* rows into *frame*.
+    """
+    if s.count(';') + 1 != ny or s.count(',') + ny != frame.size:
+        raise IOError,"Inconsistent dims at line %d"%linenum
+    if ny > 1: s = s.replace(';',',')
+    values = N.fromstring(s, 'i', sep=',')
+    if values.size != frame.size:
+        raise IOError,"Bad detector values at line %d"%linenum
+    frame[...] = values.reshape(frame.shape)
+
+def parsematrix(s, shape=None, linenum=0):
+    """
+    Parse a string into a matrix.  Provide a shape parameter if you
+    know the expected matrix size.
+    """
+    z = parseblocks([s], [linenum])[0]
+    if shape != None and z.shape != tuple(shape):
+        raise IOError,"Inconsistent dims at line %d"%linenum
+    return z
 
-def readdata(fh):
+
+def readdata(fh, detector=True):
     """
     Read ICP data, including PSD data if lines contain commas.
+
+    The data lines are first classified as either the column values for
+    a point or part of the detector block which follows them, recording
+    only where each line is.  The column matrix and the detector cube
+    are then allocated and filled in place, with zero counts for points
+    which have no block.
+
+    If *detector* is False, the PSD data is skipped, and None is returned
+    for it if the file contains any.
     """
-    rows = []
-    blocks = []
-
-    line = fh.readline().rstrip()
-    linenum = 1
-    while line != '':
-        # While it might be easy to check for a comment mark on the beginning
-        # of the line, supporting this is ill-adviced.  First, users should
-        # be strongly discouraged from modifying the original data.
-        # Second, sequencing against the automatically generated motor
-        # columns will become more complicated.  Let's make life easier
-        # and put the masking in the application rather than the data reader.
-
-        # Process the instrument configuration line and move to the next line
-        rows.append([float(val) for val in line.split()])
-        line = fh.readline().rstrip()
+    # While it might be easy to check for a comment mark on the beginning
+    # of the line, supporting this is ill-adviced.  First, users should
+    # be strongly discouraged from modifying the original data.
+    # Second, sequencing against the automatically generated motor
+    # columns will become more complicated.  Let's make life easier
+    # and put the masking in the application rather than the data reader.
+    if getattr(fh, 'buffer', None) is not None:
+        # A fileio.DataFile; use its contents rather than a copy
+        text, pos = fh.buffer, fh.tell()
+    else:
+        text, pos = fh.read(), 0
+    rowstart, rowend = array('l'), array('l')
+    blocks = [] # (point, start, end, linenum) for each detector block
+    width, ragged = None, False
+    end, linenum = len(text), 0
+    while pos < end:
+        # The instrument configuration line; a blank line ends the data
+        eol = text.find('\n', pos)
+        if eol < 0: eol = end
+        line = text[pos:eol]
         linenum += 1
-
-        # Build up a multiline detector block by joining all lines that
-        # contain a comma
-        b = []
-        while ',' in line:
-            b.append(line)
-            line = fh.readline()
+        if line.strip() == '':
+            break
+        ntokens = len(line.split())
+        if width is None: width = ntokens
+        ragged = ragged or ntokens != width
+        rowstart.append(pos)
+        rowend.append(eol)
+        pos = eol+1
+
+        # A multiline detector block is all the following lines that
+        # contain a comma.  If the last of these ends with a comma then
+        # the last number for the block is on the next line.
+        start = last = pos
+        while pos < end:
+            eol = text.find('\n', pos)
+            if eol < 0: eol = end
+            if text.find(',', pos, eol) < 0: break
+            last, pos = pos, eol+1
             linenum += 1
-
-        # If last line ended with a comma then the last number for the
-        # the current block is on the current line.
-        if b != [] and b[-1].rstrip()[-1] == ",":
-            b.append(line)
-            line = fh.readline()
+        if pos > start and pos < end and text[last:pos].rstrip().endswith(','):
+            eol = text.find('\n', pos)
+            pos = eol+1 if eol >= 0 else end
             linenum += 1
-
-        if b != []:
-            # Have a detector block so add it
-            s = "".join(b)
-            if blocks != []:
-                z = parsematrix(s, shape=blocks[0].shape, linenum=linenum)
-            else:
-                z = parsematrix(s, shape=None, linenum=linenum)
-            blocks.append(z)
-
-        elif blocks != []:
-            # Oops...missing a detector block.  Set it to zero counts
-            # of the same size as the last block
-            blocks.append(N.zeros(blocks[-1].shape,'i'))
-        # Otherwise no detector block and don't need one
-        # Note: this strategy fails to identify that the first
-        # detector block is missing; those will be filled in later.
-
-    # recover from missing leading detector blocks
-    if blocks != [] and len(blocks) < len(rows):
-        blank = N.zeros(blocks[0].shape,'i')
-        blocks = [blank]*(len(blocks)-len(rows)) + blocks
-
-    # Convert data to arrays
-    X = N.array(rows, 'd')
-    Z = N.array(blocks)
+        if pos > start and detector:
+            blocks.append((len(rowstart)-1, start, pos, linenum))
+        elif pos > start:
+            blocks = None # skipped
+
+    # Convert the columns a chunk of rows at a time.  If the lines are not
+    # all the same length, convert them row by row so that ragged rows are
+    # reported rather than reshaped into the wrong rows.
+    npoints = len(rowstart)
+    if npoints == 0:
+        X = N.array([], 'd')
+    elif ragged:
+        X = N.array([[float(v) for v in text[rowstart[k]:rowend[k]].split()]
+                     for k in range(npoints)], 'd')
+    else:
+        X = N.empty((npoints, width), 'd')
+        for k in range(0, npoints, _CHUNK_ROWS):
+            n = min(_CHUNK_ROWS, npoints-k)
+            chunk = " ".join(text[rowstart[j]:rowend[j]]
+                             for j in range(k, k+n))
+            values = N.fromstring(chunk, 'd', sep=' ')
+            if values.size != n*width:
+                values = [float(v) for v in chunk.split()]
+            X[k:k+n] = N.reshape(values, (n, width))
+
+    # Fill the detector cube one block at a time, with zero counts for
+    # missing blocks
+    if blocks is None:
+        Z = None
+    elif blocks != []:
+        _, start, stop, _ = blocks[0]
+        ny, shape = _blockshape(text[start:stop])
+        if len(blocks) < npoints:
+            Z = N.zeros((npoints,)+shape, 'i')
+        else:
+            Z = N.empty((npoints,)+shape, 'i')
+        for point, start, stop, linenum in blocks:
+            _fillblock(Z[point], ny, text[start:stop], linenum)
+    else:
+        Z = N.array([])
     return X,Z
 
 
@@ -172,12 +229,27 @@ class MotorSet(object):
                    for m in motornames]
         return ", ".join(["%s[%g:%g]"%m for m in details])
 class ColumnSet(object):
+    _synthetic = frozenset()
     def __getitem__(self, k):
         return getattr(self,k)
     def __str__(self):
-        columnnames = self.__dict__.keys()
+        columnnames = [k for k in self.__dict__.keys() if not k.startswith('_')]
         columnnames.sort()
         return ", ".join(columnnames)
+    def add_synthetic(self, name, vector):
+        """
+        Add a column generated from the header rather than read from the
+        data.
+        """
+        setattr(self, name, vector)
+        self._synthetic = self._synthetic | set([name])
+    def synthetic(self):
+        """
+        Return the sorted names of the generated columns.  Constant
+        columns are read-only views of a single value, so copy them
+        before changing them.
+        """
+        return sorted(self._synthetic)
 
 class ICP(object):
     def __init__(self, path):
@@ -296,35 +368,20 @@ class ICP(object):
         #skip line describing fields
         file.readline()
 
-    def check_wavelength(self, default, overrides={}):
+    def check_wavelength(self, default, overrides=None):
         """
         ICP sometimes records the incorrect wavelength in the file.  Make
-        sure the right value is being used.  Be annoying about it so that
-        if the wavelength was changed for a legitimate reason the user can
-        override.  L is the value in the file.  dectector.wavelength should
-        already be set to the default for the instrument.
-        """
-        dataset = self.filename[:5]
-        wavelength = self.wavelength
-        if dataset in overrides:
-            # yuck! If already overridden for a particular file in
-            # a dataset, override for all files in the dataset.
-            wavelength = overrides[dataset]
-            message("Using wavelength %s for %s"%(wavelength,dataset))
-        elif wavelength == 0:
-            # yuck! If stored value is 0, use the default
-            wavelength = default
-            message("Using default wavelength %s for %s"\
-                    %(wavelength,self.path))
-        elif abs(default-wavelength)/default > 0.01:
-            # yuck! Value differs significantly from the default
-            if question("ICP recorded a wavelength of %s in %s. \
-    Do you want to use the default wavelength %s instead?"\
-              %(wavelength,self.path,default)):
-                wavelength = default
-        # Regardless of how the value was obtained, use that value for
-        # the entire dataset
-        return wavelength
+        sure the right value is being used.  *default* is the wavelength
+        for the instrument and *overrides* is the :class:`WavelengthTable`
+        to use, or :data:`WAVELENGTHS` if it is None.  A dictionary of
+        {dataset: wavelength} is also accepted.
+        """
+        if overrides is None:
+            overrides = WAVELENGTHS
+        elif not isinstance(overrides, WavelengthTable):
+            overrides = WavelengthTable(overrides)
+        return overrides.choose(self.filename, self.path, self.wavelength,
+                                default)
 
 
     def readmotors(self, file):
@@ -373,36 +430,73 @@ class ICP(object):
         self.columnnames = line.split()
 
 
-    def readcolumns(self, file):
+    def readcolumns(self, file, lazy=False):
         '''
         Read and parse ICP data columns listed in columns.  Return a dict of
         column name: vector.  If using a position sensitive detector, return
         an array of detector values x scan points.
+
+        If *lazy*, the detector values are read from the file when
+        :attr:`detector` is first used.
         '''
-        values,detector = readdata(file)
+        offset = file.tell()
+        values,detector = readdata(file, detector=not lazy)
         self.column = ColumnSet()
         for (c,v) in zip(self.columnnames,values.T):
             setattr(self.column,c,v)
-        self.detector = detector
-        self.counts = detector if detector.size > 0 else self.column.counts
+        if detector is None:
+            self._detector = LazyCounts(lambda: self._loadcounts(offset))
+        else:
+            self._detector = detector
         self.points = len(self.column.counts)
 
+    def _loadcounts(self, offset):
+        file = fileio.open(self.path)
+        try:
+            file.seek(offset)
+            _,detector = readdata(file)
+        finally:
+            file.close()
+        if len(detector) != self.points:
+            raise IOError("ICP file '%s' changed while reading"%self.path)
+        return detector
+
+    @property
+    def detector(self):
+        """
+        PSD values for each point, or an empty array for point detectors.
+        """
+        if isinstance(self._detector, LazyCounts):
+            return self._detector()
+        return self._detector
+
+    @property
+    def counts(self):
+        """
+        PSD values if there are any, otherwise the point detector counts.
+        """
+        return self.detector if self.PSD else self.column.counts
+
     def genmotorcolumns(self):
         """
         Generate vectors for each of the motors if a vector is not
         already stored in the file.
+
+        Scanned motors step from the start value for each point measured.
+        Fixed motors are a read-only view of the start value, so no memory
+        is used for them.  The generated columns are listed by
+        *self.column.synthetic()*.
         """
         if self.scantype in ['T']: return  # Skip motor generation for now for 'T'
+        index = None
         for (M,R) in self.motor.__dict__.iteritems():
             if not hasattr(self.column,M):
                 if R.step != 0.:
-                    vector = N.arange(R.start,R.step,R.stop)
-                    # truncate to number of points measured
-                    vector = vector[:self.points]+0
+                    if index is None: index = N.arange(self.points, dtype='d')
+                    vector = R.start + R.step*index
                 else:
-                    vector = R.start * N.ones(self.points)
-                setattr(self.column,M,vector)
-        pass
+                    vector = N.broadcast_to(N.float64(R.start), (self.points,))
+                self.column.add_synthetic(M, vector)
 
     def parseheader(self, file):
         """
@@ -429,7 +523,7 @@ class ICP(object):
         """
         Read header from file, setting the corresponding attributes the ICP object
         """
-        file = gzopen(self.path)
+        file = fileio.open(self.path)
         self.parseheader(file)
         data1 = file.readline()
         data2 = file.readline()
@@ -437,16 +531,21 @@ class ICP(object):
         file.close()
 
 
-    def read(self):
+    def read(self, lazy=False):
         """
         Read header and data from file, setting the corresponding attributes the ICP object
+
+        If *lazy*, PSD data is not read until :attr:`detector` or
+        :attr:`counts` is used, and is then kept only as long as it fits
+        in :data:`utils.COUNTS_CACHE` or is otherwise in use.
         """
-        file = gzopen(self.path)
+        file = fileio.open(self.path)
         self.parseheader(file)
 
         #read columns and detector images if available
-        self.readcolumns(file)
-        self.PSD = (self.detector.size>0)
+        self.readcolumns(file, lazy=lazy)
+        self.PSD = (isinstance(self._detector, LazyCounts)
+                    or self._detector.size>0)
 
         # fill in missing motor columns
         self.genmotorcolumns()
@@ -456,12 +555,6 @@ class ICP(object):
     def __contains__(self, column):
         return hasattr(self.column,column)
 
-    def counts(self):
-        if self.detector.size > 1:
-            return self.detector
-        else:
-            return self.column.counts
-
     def asdata(self):
         import data
         d = data.Data()
@@ -565,31 +658,116 @@ def replace_data(infilename, outfilename, columns, detector=None):
     write_icp_data(outfile, formats, columns, detector)
 
 # ==== General utilities ====
-def gzopen(filename,mode='r'):
+class WavelengthTable(object):
     """
-    Open file or gzip file
+    Wavelengths to use for ICP datasets.
+
+    ICP sometimes records the incorrect wavelength in the file.  The
+    table maps a dataset, which is the first five characters of the file
+    name such as 'jul04', to the wavelength to use for all its files.
+    For other datasets the recorded wavelength is used, unless it is zero
+    or differs from the instrument default by more than the relative
+    *tolerance*, in which case the default is used.
+
+    The choice never asks the user.  Each time the wavelength used is not
+    the one recorded, the decision is counted in *decisions*, keyed by
+    (dataset, recorded, wavelength, reason) so that reloading a dataset
+    does not add to it, and :meth:`report` returns the notes for a batch
+    of files together.  The table itself is not
+    changed by loading files, so one table can be shared by all the
+    workers in a batch.
     """
-    if filename.endswith('.gz'):
-        import gzip
-        file = gzip.open(filename, mode)
-    else:
-        file = open(filename, mode)
-    return file
+    def __init__(self, overrides=None, tolerance=0.01):
+        self.overrides = dict(overrides) if overrides else {}
+        self.tolerance = tolerance
+        self.decisions = {}
+
+    @classmethod
+    def load(cls, filename, tolerance=0.01):
+        """
+        Read a table file with lines of 'dataset wavelength'.  Blank
+        lines and text following '#' are ignored.
+        """
+        overrides = {}
+        with open(filename) as fid:
+            for linenum, line in enumerate(fid):
+                words = line.split('#')[0].split()
+                if not words: continue
+                try:
+                    dataset, wavelength = words
+                    overrides[dataset] = float(wavelength)
+                except ValueError:
+                    raise ValueError("expected 'dataset wavelength' at %s:%d"
+                                     %(filename, linenum+1))
+        return cls(overrides, tolerance=tolerance)
+
+    def digest(self):
+        """
+        Return a string which changes when the overrides or tolerance
+        change, for use in cache keys.
+        """
+        import hashlib
+        state = repr((sorted(self.overrides.items()), self.tolerance))
+        return hashlib.sha1(state).hexdigest()[:12]
+
+    def choose(self, filename, path, recorded, default):
+        """
+        Return the wavelength for the file *path* named *filename* in its
+        header, given the *recorded* and *default* wavelengths.
+        """
+        dataset = filename[:5]
+        if dataset in self.overrides:
+            wavelength, reason = self.overrides[dataset], "override"
+        elif recorded == 0:
+            wavelength, reason = default, "default for zero"
+        elif abs(default-recorded)/default > self.tolerance:
+            wavelength, reason = default, "default for unexpected"
+        else:
+            return recorded
+        if wavelength != recorded:
+            key = (dataset, recorded, wavelength, reason)
+            self.decisions[key] = self.decisions.get(key, 0) + 1
+        return wavelength
 
-# TODO: need message/question functions
-def message(text):
-    """Report an error from ICP load"""
-    pass
-def question(text):
-    """Ask user a yes/no question during ICP load"""
-    return True
+    def report(self):
+        """
+        Return the decisions noted since the last report, one line for
+        each dataset and choice, and forget them.
+        """
+        lines = sorted(set("%s: wavelength %g (%s) used instead of %g"
+                           %(dataset, wavelength, reason, recorded)
+                           for dataset, recorded, wavelength, reason
+                           in self.decisions))
+        self.decisions = {}
+        return lines
+
+# Shared wavelength table, read from $SCATTIO_WAVELENGTHS if it is set
+WAVELENGTHS = (WavelengthTable.load(os.environ['SCATTIO_WAVELENGTHS'])
+               if os.environ.get('SCATTIO_WAVELENGTHS') else WavelengthTable())
+
+def wavelength_report():
+    """
+    Return the notes from :data:`WAVELENGTHS` since the last report.
+    """
+    return WAVELENGTHS.report()
 
 # ==== File level access ====
 
-def read(filename):
-    """Read an ICP file and return the corresponding ICP file object"""
+def sniff(head, size):
+    """
+    Return True if the start of the file *head* looks like an ICP header,
+    which begins with the quoted file name.
+    """
+    return head.lstrip()[:1] == "'"
+
+def read(filename, lazy=False):
+    """
+    Read an ICP file and return the corresponding ICP file object
+
+    If *lazy*, the PSD data is read when it is first used.
+    """
     icp = ICP(filename)
-    icp.read()
+    icp.read(lazy=lazy)
     return icp
 
 def summary(filename):
@@ -655,6 +833,89 @@ def test():
     assert fields.wavelength == 4.76
     assert fields.column['qz'][-1] == 0.21
 
+    # Motor columns generated from the header
+    assert fields.column.synthetic() == ['Qx','Qz','S1','S2','S3','S4','a13']
+    assert 'counts' not in fields.column.synthetic()
+    assert fields.column.Qx.strides == (0,) and (fields.column.Qx == 0).all()
+    assert len(fields.column.Qz) == fields.points
+    assert abs(fields.column.Qz - fields.column.qz).max() < 1e-12
+
+    # Wavelength corrections come from the table without asking
+    import tempfile
+    fd, tablefile = tempfile.mkstemp(suffix='.txt')
+    os.write(fd, "# dataset wavelength\njul04 4.75\n\nmar06 5.0 # typo\n")
+    os.close(fd)
+    try:
+        table = WavelengthTable.load(tablefile)
+    finally:
+        os.unlink(tablefile)
+    assert table.overrides == {'jul04': 4.75, 'mar06': 5.0}
+    assert fields.check_wavelength(4.76, table) == 4.75
+    assert fields.check_wavelength(4.76, {}) == 4.76
+    assert table.choose('aug0101.ng7', 'a', 0, 4.76) == 4.76
+    assert table.choose('aug0102.ng7', 'b', 0, 4.76) == 4.76
+    assert table.choose('aug0103.ng7', 'c', 4.75, 4.76) == 4.75
+    assert table.choose('aug0104.ng7', 'd', 5.5, 4.76) == 4.76
+    assert table.choose('aug0105.ng7', 'e', 5.5, 4.76) == 4.76
+    assert table.decisions[('aug01', 5.5, 4.76, 'default for unexpected')] == 2
+    assert len(table.decisions) == 3
+    assert table.report() == [
+        'aug01: wavelength 4.76 (default for unexpected) used instead of 5.5',
+        'aug01: wavelength 4.76 (default for zero) used instead of 0',
+        'jul04: wavelength 4.75 (override) used instead of 4.76']
+    assert table.report() == []
+    assert table.digest() != WavelengthTable().digest()
+
+    # Linear and area detector blocks, with a missing leading block
+    Z = parseblocks(["1,2,\n 3,4", "5,6,7,8"])
+    assert Z.shape == (2,4) and Z[1,3] == 8
+    Z = parseblocks(["1,2;3,4;\n 5,6", "7,8;9,10;11,12"])
+    assert Z.shape == (2,3,2) and Z[1,2,0] == 11
+    from StringIO import StringIO
+    X,Z = readdata(StringIO(" 1 2\n 3 4\n 1,2,3,\n 4\n"))
+    assert X.shape == (2,2) and Z.tolist() == [[0,0,0,0],[1,2,3,4]]
+    X,Z = readdata(StringIO(" 1 2\n 3 4\n 1,2,3,\n 4\n"), detector=False)
+    assert X.tolist() == [[1,2],[3,4]] and Z is None
+    try:
+        readdata(StringIO(" 1\n 1,2,3\n 2\n 1,2\n"))
+    except IOError, exc:
+        assert "line 4" in str(exc)
+    else:
+        raise AssertionError("inconsistent blocks not detected")
+    try:
+        readdata(StringIO(" 1 2 3\n 4\n 5 6\n"))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("ragged rows not detected")
+    try:
+        parseblocks(["1,2,3", "1,2"], [10, 12])
+    except IOError, exc:
+        assert "line 12" in str(exc)
+    else:
+        raise AssertionError("inconsistent blocks not detected")
+
+    # PSD data can be loaded on first use, and dropped
+    filename = utils.example('ng7', 'mar06036.ng7')
+    eager = read(filename)
+    lazy = read(filename, lazy=True)
+    assert lazy.PSD and not lazy._detector.loaded
+    assert (lazy.column.counts == eager.column.counts).all()
+    assert (lazy.counts == eager.detector).all()
+    assert lazy._detector.loaded
+    lazy._detector.drop()
+    assert not lazy._detector.loaded
+    assert lazy.detector.shape == eager.detector.shape
+
+    # Least recently used counts are released when the cache is full
+    cache = utils.CountsCache(max_bytes=eager.detector.nbytes)
+    first = utils.LazyCounts(lambda: eager.detector.copy(), cache)
+    second = utils.LazyCounts(lambda: eager.detector.copy(), cache)
+    first(); second()
+    assert len(cache) == 1 and second.loaded and not first.loaded
+    cache.shrink()
+    assert len(cache) == 0 and cache.nbytes == 0 and not second.loaded
+
 if __name__=='__main__':
     plot_demo()
     #demo()
@@ -6,12 +6,11 @@ __all__ = ['load']
 import os
 import numpy
 
-from . import jsonutil
 from . import icpformat
 from . import qxqz
 from .utils import format_timestamp, template
 from .qxqz import neutron_energy
-from .write_nexus import write_nexus, main_driver
+from .write_nexus import write_nexus, load_layout, main_driver
 
 _NG7_TO_NICE = {
     'date': 'trajectory.start',
@@ -53,25 +52,23 @@ _UNITS = {
     'h-field': 'T',
     }
 
-# If wavelength seems to be stored incorrectly in the file, the icpformat
-# loader will ask the user if the stored value should be used or the default
-# value; WAVELENGTH_OVERRIDES remembers for each dataset what value to use.
-WAVELENGTH_OVERRIDES = {}
-
-
-def convert(infile, outfile=None):
+def convert(infile, outfile=None, wavelengths=None):
     """
     Convert NG-7 ICP data to NeXus.
+
+    If the wavelength seems to be stored incorrectly in the file, the
+    value to use is chosen by the :class:`icpformat.WavelengthTable`
+    *wavelengths*, or by the shared *icpformat.WAVELENGTHS* table.
     """
     data = icpformat.read(infile)
-    nicedata = ng7_icp_to_nice(data)
-    nexus_layout = jsonutil.relaxed_load(template("ng7nxs.json"))
+    nicedata = ng7_icp_to_nice(data, wavelengths)
+    nexus_layout = load_layout(template("ng7nxs.json"))
     #import pprint; pprint.pprint(nexus_layout)
     if not outfile:
         outfile = os.path.basename(os.path.splitext(infile)[0]) + ":entry"
     return write_nexus(outfile, nicedata, nexus_layout)
 
-def ng7_icp_to_nice(data):
+def ng7_icp_to_nice(data, wavelengths=None):
     """
     Convert NCNR NG-7 ICP names to NICE names.
     """
@@ -129,7 +126,7 @@ def ng7_icp_to_nice(data):
     std = 0.025/2.35 # 2.5% FWHM wavelength spread expressed as 1-sigma error
     # This spread is small enough that it is accurate for E ~ 1/lambda as well.
     default_wavelength = 4.76
-    wavelength = data.check_wavelength(default_wavelength, WAVELENGTH_OVERRIDES)
+    wavelength = data.check_wavelength(default_wavelength, wavelengths)
     F('monochromator.wavelength', wavelength, "Angstrom")
     F('monochromator.wavelengthSpread', wavelength*std, "Angstrom")
     F('monochromator.wavelength',neutron_energy(wavelength),"meV")
@@ -177,7 +174,7 @@ def test():
     assert (wavelength-0.476) < 1e-6  # float32(4.76)/10 is not exactly 0.476
 
 if __name__ == "__main__":
-    main_driver(convert)
+    main_driver(convert, report=icpformat.wavelength_report)
 
 ## Use unix tools to identifier motors that people use
 # find . -name "*.ng7" | grep -v fpx | xargs grep -h -A1 Mot: | grep -v "Mot:" | sort | uniq
@@ -0,0 +1,186 @@
+"""
+Benchmark the NeXus converters.
+
+Usage::
+
+    python -m scattio.ncnr.nxsbench [file...]
+    python -m scattio.ncnr.nxsbench --chunks
+
+For each compression policy in POLICIES, reports the time spent writing
+fields, the write throughput for the uncompressed data and the size of
+the files on disk.  Without files, the SANS and BT-7 examples are used.
+
+With --chunks, reports append and read throughput of the chunk layouts
+in CHUNK_LAYOUTS for point detector, PSD and area detector streams.
+"""
+import os
+import glob
+import time
+import shutil
+import tempfile
+
+import numpy
+
+import h5nexus
+
+from . import write_nexus
+from . import sansnxs
+from . import bt7nxs
+from .h5nexus import CompressionPolicy
+from .utils import example
+
+POLICIES = [
+    ('none', CompressionPolicy('none')),
+    ('gzip-1', CompressionPolicy(1)),
+    ('gzip-1+shuffle', CompressionPolicy(1, shuffle=True)),
+    ('gzip-9', CompressionPolicy(9)),
+    ('lzf', CompressionPolicy('lzf')),
+    ('lzf+shuffle', CompressionPolicy('lzf', shuffle=True)),
+    ]
+
+def compression_benchmark(convert, files, policies=POLICIES, repeat=3):
+    """
+    Convert *files* with each of the compression *policies*.
+
+    Returns a list of (name, write time, data bytes, file bytes) for each
+    policy, using the best of *repeat* runs for the time.
+    """
+    tmpdir = tempfile.mkdtemp(prefix="nxsbench")
+    saved = write_nexus.COMPRESSION
+    results = []
+    try:
+        for name, policy in policies:
+            write_nexus.COMPRESSION = policy
+            best = None
+            for _ in range(repeat):
+                elapsed = data_bytes = file_bytes = 0
+                for i,f in enumerate(files):
+                    path = os.path.join(tmpdir, "bench%d"%i)
+                    root = convert(f, path+":entry")
+                    elapsed += write_nexus.last_timing['fields']
+                    data_bytes += sum(node.size*node.dtype.itemsize
+                                      for node in _iter_datasets(root))
+                    root.close()
+                    file_bytes += os.path.getsize(path+".nxs")
+                    os.remove(path+".nxs")
+                if best is None or elapsed < best[1]:
+                    best = (name, elapsed, data_bytes, file_bytes)
+            results.append(best)
+    finally:
+        write_nexus.COMPRESSION = saved
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return results
+
+def _iter_datasets(root):
+    nodes = []
+    root.visititems(lambda name, node: nodes.append(node)
+                    if isinstance(node, h5nexus.h5.Dataset) else None)
+    return nodes
+
+def print_results(title, results):
+    print "==", title, "=="
+    print "%-16s %10s %10s %10s %8s"%("policy","write ms","MB/s","file kB","ratio")
+    for name, elapsed, data_bytes, file_bytes in results:
+        rate = data_bytes/elapsed/1e6 if elapsed > 0 else float('inf')
+        print "%-16s %10.2f %10.1f %10.1f %8.2f"%(name, elapsed*1e3, rate,
+            file_bytes/1024., float(data_bytes)/file_bytes)
+
+# Streams as (name, frame shape, dtype, number of frames)
+CHUNK_STREAMS = [
+    ('point', (), 'float32', 200000),
+    ('PSD', (256,), 'int32', 10000),
+    ('area', (128,128), 'int32', 200),
+    ]
+
+def _old_chunks(maxshape, dtype, compression):
+    # Chunks from make_chunks before the chunk budget was introduced
+    chunks = [(v if v else 1) for v in maxshape]
+    fixed_size = numpy.prod(chunks) * numpy.dtype(dtype).itemsize
+    chunks[0] = h5nexus.CHUNK_SIZE//fixed_size + 1
+    return tuple(chunks)
+
+CHUNK_LAYOUTS = [
+    ('1000 bytes', _old_chunks),
+    ('frame 1M', lambda maxshape, dtype, compression:
+        h5nexus.make_chunks(maxshape, dtype, budget=2**20)),
+    ('frame', lambda maxshape, dtype, compression:
+        h5nexus.make_chunks(maxshape, dtype, compression=compression)),
+    ('column', lambda maxshape, dtype, compression:
+        h5nexus.make_chunks(maxshape, dtype, compression=compression,
+                            access='column')),
+    ]
+
+def chunk_benchmark(streams=CHUNK_STREAMS, layouts=CHUNK_LAYOUTS,
+                    compressions=(None, 'lzf', 1), frame_reads=100):
+    """
+    Stream frames to a file for each combination of chunk layout and
+    compression, then read back random frames and single pixel columns.
+
+    Returns a list of (stream, layout, compression, chunks, append MB/s,
+    frame reads/s, column reads/s).
+    """
+    tmpdir = tempfile.mkdtemp(prefix="nxsbench")
+    path = os.path.join(tmpdir, "chunks.nxs")
+    results = []
+    try:
+        for stream, shape, dtype, n in streams:
+            frames = numpy.random.randint(0, 100, size=(n,)+shape).astype(dtype)
+            maxshape = [None]+list(shape)
+            frame_idx = numpy.random.randint(0, n, size=frame_reads)
+            column_idx = [tuple(numpy.random.randint(0, d) for d in shape)
+                          for _ in range(5)]
+            for compression in compressions:
+                for name, layout in layouts:
+                    chunks = layout(maxshape, dtype, compression)
+                    root = h5nexus.open(path, "w")
+                    node = h5nexus.field(root, 'data', maxshape=maxshape,
+                                         dtype=dtype, units="counts",
+                                         chunks=chunks,
+                                         compression=compression or 'none')
+                    start = time.time()
+                    with h5nexus.Appender(node) as appender:
+                        for i in range(0, n, 100):
+                            appender.extend(frames[i:i+100])
+                    root.flush()
+                    append_rate = frames.nbytes/(time.time()-start)/1e6
+                    start = time.time()
+                    for i in frame_idx:
+                        node[i]
+                    frame_rate = frame_reads/(time.time()-start)
+                    start = time.time()
+                    for idx in column_idx:
+                        node[(slice(None),)+idx]
+                    column_rate = len(column_idx)/(time.time()-start)
+                    root.close()
+                    results.append((stream, name, compression, chunks,
+                                    append_rate, frame_rate, column_rate))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return results
+
+def print_chunk_results(results):
+    print "%-6s %-10s %-5s %-16s %10s %10s %10s"%(
+        "stream", "layout", "comp", "chunks", "append MB/s",
+        "frames/s", "columns/s")
+    for stream, name, compression, chunks, append, frame, column in results:
+        print "%-6s %-10s %-5s %-16s %10.1f %10.0f %10.1f"%(
+            stream, name, compression or "none",
+            "x".join(str(c) for c in chunks), append, frame, column)
+
+def main():
+    import sys
+    if sys.argv[1:] == ['--chunks']:
+        print_chunk_results(chunk_benchmark())
+        return
+    files = sys.argv[1:]
+    if files:
+        sets = [("BT-7", bt7nxs.convert, [f for f in files if f.endswith('.bt7')]),
+                ("SANS", sansnxs.convert, [f for f in files if not f.endswith('.bt7')])]
+    else:
+        sets = [("BT-7", bt7nxs.convert, sorted(glob.glob(example('bt7','*.bt7')))),
+                ("SANS", sansnxs.convert, sorted(glob.glob(example('sans','SILIC*'))))]
+    for title, convert, paths in sets:
+        if paths:
+            print_results(title, compression_benchmark(convert, paths))
+
+if __name__ == "__main__": main()
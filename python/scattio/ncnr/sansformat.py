@@ -2,7 +2,8 @@
 File loaders for NCNR VAX SANS format
 """
 
-__all__ = ["load", "save"]
+__all__ = ["load", "load_many", "save", "read_headers", "headers_from_buffer",
+           "sniff"]
 
 import os
 import struct
@@ -10,7 +11,9 @@ import time
 
 import numpy
 
-from .utils import R4_VAX2IEEE, R4_IEEE2VAX
+from . import fileio
+from .utils import R4_VAX2IEEE, R4_IEEE2VAX, LazyCounts
+from .utils import R4_VAX2IEEE_array, R4_IEEE2VAX_array
 
 
 DATETIME_FORMAT = '%d-%b-%Y %H:%M:%S'
@@ -30,6 +33,25 @@ class SansFormatInfo:
         assert struct.calcsize(self.header_struct) == 512
         self.reals = [name for name,dtype in args if dtype=='vaxR4']
         self.strings = [name for name,dtype in args if dtype.endswith('s')]
+        # Equivalent numpy record layout, with VAX reals left as raw words
+        # in header_dtype and decoded to float32 in record_dtype
+        dtype_to_numpy_type = {
+            'i': '<i4',
+            'L': '<u4',
+            'vaxR4': '<u4',
+            DATETIME_FORMAT: 'S20',
+            DATE_FORMAT: 'S8',
+            }
+        def numpy_type(dtype):
+            if dtype.endswith('s') and dtype[:-1].isdigit():
+                return 'S'+dtype[:-1]
+            return dtype_to_numpy_type[dtype]
+        self.header_dtype = numpy.dtype([(name,numpy_type(dtype))
+                                         for name,dtype in args])
+        self.record_dtype = numpy.dtype([(name,'<f4' if dtype=='vaxR4'
+                                               else numpy_type(dtype))
+                                         for name,dtype in args])
+        assert self.header_dtype.itemsize == 512
         self.data_struct = '<16401h'
         self.units = dict([
             ('run.ctime','s'),           #  27  count time per prefactor (s)
@@ -179,12 +201,25 @@ INFO = SansFormatInfo(
 
 
 
-def load(filename):
+# File sizes for data, sensitivity and mask files
+_SIZES = (33316, 66116, 16896)
+def sniff(head, size):
+    """
+    Return True if a file of *size* bytes may be an NCNR VAX SANS file.
+    Files of unknown size, such as .bz2 files, may be.
+    """
+    return size is None or size in _SIZES
+
+def load(filename, lazy=False):
     """
     Load NCNR VAX SANS format filename.
 
     Returns data, metadata
 
+    If *lazy*, only the header is read, and data is a
+    :class:`utils.LazyCounts` object which reads the detector values
+    when it is called.
+
     The filename type returned in metadata['run.type'] may be 'RAW' for a
     measurement filename, 'DIV' for a detector sensitivity filename or 'MASK' for
     a detector mask filename.
@@ -194,17 +229,22 @@ def load(filename):
     Raises IOError if the filename length does not correspond to one of the
     possible filename types.  Other errors may be raised if the conversion fails.
     """
-    size = os.path.getsize(filename)
-    if size == 33316:
+    size = fileio.getsize(filename)
+    if size == 33316 and lazy:
+        metadata = _decode_metadata(fileio.head(filename, 514))
+        data = LazyCounts(lambda: readNCNRData(filename)[0])
+    elif size == 33316:
         data,metadata = readNCNRData(filename)
     elif size == 66116:
-        data = readNCNRSensitivity(filename)
+        data = (LazyCounts(lambda: readNCNRSensitivity(filename)) if lazy
+                else readNCNRSensitivity(filename))
         metadata = {
             'fname.filename': filename,
             'run.type': 'DIV',
             }
     elif size == 16896:
-        data = readNCNRMask(filename)
+        data = (LazyCounts(lambda: readNCNRMask(filename)) if lazy
+                else readNCNRMask(filename))
         metadata = {
             'fname.filename': filename,
             'run.type': 'MASK',
@@ -215,6 +255,38 @@ def load(filename):
     return data,metadata
 
 
+def load_many(paths):
+    """
+    Load a set of NCNR VAX SANS RAW files.
+
+    Returns counts, headers where counts is an int32 array of shape
+    (len(paths),128,128) and headers is a structured array as returned
+    by :func:`read_headers`.
+
+    Each file is memory mapped and its detector values are copied into
+    the preallocated stack, which is then decompressed in one pass.  This
+    is much faster than calling :func:`load` for each file when summing
+    hundreds of frames.  Compressed files and files in bundles are read
+    into memory instead (see :mod:`fileio`).
+
+    Raises IOError if any of the files is not a RAW data file.
+    """
+    n = len(paths)
+    counts = numpy.empty((n,128,128), 'int32')
+    frames = counts.reshape(n,16384)
+    headers = []
+    for i,filename in enumerate(paths):
+        with fileio.open(filename, mmap_bytes=0) as f:
+            if len(f) != 33316:
+                raise IOError("SANS file '%s' is not a RAW data file"%filename)
+            headers.append(f.buffer[2:514])
+            body = numpy.frombuffer(f.buffer, '<i2', count=16401, offset=514)
+            frames[i] = body[_DATA_INDEX]
+            del body # release the view before closing the map
+    _expand_counts(frames)
+    raw = numpy.frombuffer("".join(headers), INFO.header_dtype)
+    return counts, decode_headers(raw)
+
 def save(filename, data, metadata):
     """
     Save NCNR VAX SANS format filename.
@@ -228,46 +300,84 @@ def save(filename, data, metadata):
     writeNCNRData(filename, data, metadata)
 
 
-def readNCNRSensitivity(inputfile):
-    """
-    Read VAX format SANS sensitivity file.
+def read_headers(paths):
     """
+    Read the headers of a set of NCNR VAX SANS RAW files.
 
-    f = open(inputfile, 'rb')
-    data = f.read()
-    f.close()
+    Returns a numpy structured array with one record per file and one
+    column per header field, as described by INFO.record_dtype.  Only
+    the header of each file is read.  Reals are converted to float32
+    and string fields are stripped, but dates are left as strings.
 
-    #skip the fake header and just read the data
-    #data is 32bit VAX floats
-    dataformatstring = '<65600s'
-    #print len(data[516:])
-    (rawdatastring,) = struct.unpack_from(dataformatstring,data, offset=516)
+    For example, to select the runs with detector distance above 10 m::
 
-    detdata = numpy.empty(16384)
+        files = expand_input_args(path)
+        H = read_headers(files)
+        far = [f for f,keep in zip(files, H['det.dis'] > 10) if keep]
 
-    a = 0
-    offset = 0
-    for _i in range(16):
-        for _j in range(511):
-            #if jj == 0: print rawdatastring[offset:offset+4]
-            detdata[a] = R4_VAX2IEEE(rawdatastring[offset:offset+4])
-            a += 1
-            offset += 4
+    Raises IOError if a file is too short to contain a header.
+    """
+    blocks = []
+    for filename in paths:
+        block = fileio.head(filename, 514)
+        if len(block) != 514:
+            raise IOError("SANS file '%s' is too short"%filename)
+        blocks.append(block[2:])
+    raw = numpy.frombuffer("".join(blocks), INFO.header_dtype)
+    return decode_headers(raw)
+
+def headers_from_buffer(buffer, count=None, stride=33316, offset=0):
+    """
+    Read the headers from a concatenation of NCNR VAX SANS RAW files.
 
-        offset += 2
+    *buffer* is any object supporting the buffer interface, such as a
+    string or an mmap of the concatenated files.  The files are *stride*
+    bytes apart starting at *offset*, and there are *count* of them, or
+    as many as fit in the buffer if *count* is None.  The headers are
+    viewed in place; only the decoded copy is allocated.
 
-        for _k in range(510):
-            detdata[a] = R4_VAX2IEEE(rawdatastring[offset:offset+4])
-            a += 1
-            offset += 4
+    Returns the same structure as :func:`read_headers`.
+    """
+    if count is None:
+        count = (len(buffer) - offset - 2 - INFO.header_dtype.itemsize)//stride + 1
+    raw = numpy.ndarray(shape=(count,), dtype=INFO.header_dtype,
+                        buffer=buffer, offset=offset+2, strides=(stride,))
+    return decode_headers(raw)
 
-        offset += 2
+def decode_headers(raw):
+    """
+    Convert an array of INFO.header_dtype records to INFO.record_dtype,
+    decoding the VAX reals a column at a time.
+    """
+    records = numpy.empty(raw.shape, INFO.record_dtype)
+    for k in INFO.fields:
+        if k in INFO.reals:
+            records[k] = R4_VAX2IEEE_array(raw[k])
+        elif k in INFO.strings:
+            records[k] = numpy.char.strip(raw[k])
+        else:
+            records[k] = raw[k]
+    return records
 
-    for _i in range(48):
-        detdata[a] = R4_VAX2IEEE(rawdatastring[offset:offset+4])
-        a += 1
-        offset += 4
+def readNCNRSensitivity(inputfile):
+    """
+    Read VAX format SANS sensitivity file.
+    """
+
+    with fileio.open(inputfile) as f:
+        data = f.read()
 
+    #skip the fake header and just read the data
+    #data is 32bit VAX floats stored in 16 records of 511+510 values, with
+    #each group of values followed by a 2 byte gap, then a final 48 values
+    raw = numpy.frombuffer(data, 'u1', count=65600, offset=516)
+    records = raw[:16*4088].reshape(16,4088)
+    words = numpy.hstack((records[:,:2044].copy().view('<u4'),
+                          records[:,2046:4086].copy().view('<u4')))
+    tail = raw[16*4088:].copy().view('<u4')
+    vax = numpy.concatenate((words.flatten(), tail))
+
+    detdata = numpy.asarray(R4_VAX2IEEE_array(vax), 'd')
     detdata.resize(128,128)
 
     return detdata
@@ -277,9 +387,8 @@ def readNCNRMask(inputfile):
     """
     Read NCNR format mask file
     """
-    f = open(inputfile, 'rb')
-    data = f.read()
-    f.close()
+    with fileio.open(inputfile) as f:
+        data = f.read()
 
     # four bytes before and 508 bytes after should be 0
     mask = numpy.array(struct.unpack_from('<16384B',data, offset=4)) # 4:16384+4
@@ -292,14 +401,26 @@ def readNCNRData(inputfile):
     Read VAX format SANS data from NCNR.
     """
     #print "reading",inputfile
-    f = open(inputfile, 'rb')
-    data = f.read()
-    f.close()
+    with fileio.open(inputfile) as f:
+        data = f.read()
 
     if len(data) != 33316:
         raise IOError("Data file corrupted.  Incorrect length")
 
+    metadata = _decode_metadata(data)
 
+    #print "data len",len(data[514:])
+    rawdata = numpy.array(struct.unpack_from(INFO.data_struct, data, offset=514))
+
+    detdata = decompress(rawdata)
+
+    #print "first 2",struct.unpack_from('>h', data, offset=0)
+    return detdata,metadata
+
+def _decode_metadata(data):
+    """
+    Interpret the header at the start of the SANS data file contents.
+    """
     # Interpret structure 
     #print formatstring
     #print struct.calcsize(HEADER_STRUCT)
@@ -316,14 +437,7 @@ def readNCNRData(inputfile):
     #Convert dates
     metadata['run.datetime'] = time.strptime(metadata['run.datetime'],
                                              INFO.types['run.datetime'])
-
-    #print "data len",len(data[514:])
-    rawdata = numpy.array(struct.unpack_from(INFO.data_struct, data, offset=514))
-
-    detdata = decompress(rawdata)
-
-    #print "first 2",struct.unpack_from('>h', data, offset=0)
-    return detdata,metadata
+    return metadata
 
 def writeNCNRData(filename, data, metadata):
     """
@@ -338,7 +452,8 @@ def writeNCNRData(filename, data, metadata):
             rawdata[k] = INFO.default_value(k)
 
     # convert reals to vax format
-    rawdata.update((k,R4_IEEE2VAX(metadata[k])) for k in INFO.reals)
+    vax = R4_IEEE2VAX_array([rawdata[k] for k in INFO.reals]).tostring()
+    rawdata.update((k,vax[4*i:4*i+4]) for i,k in enumerate(INFO.reals))
     
     # extend strings with spaces
     for k in INFO.strings:
@@ -368,6 +483,9 @@ def writeNCNRData(filename, data, metadata):
     f.close()
 
 
+# Detector values in the stored data, skipping the values at 0, 1022, ...
+_DATA_INDEX = numpy.nonzero(numpy.arange(16401)%1022 != 0)[0]
+
 def decompress(data):
     """
     Convert semi-logarithmic 2-byte integer to 4-byte integer value.
@@ -376,23 +494,31 @@ def decompress(data):
     The storage format for numbers above 32767 is
          - (mantissa + 10000*10**power)
     where the mantissa is 4 digits and power is 1, 2 or 3.
+
+    *data* can be a single record of 16401 values or a stack of them,
+    with the records along the last dimension.
     """
 
     # Drop values at 0, 1022, 2*1022, ...
-    idx = numpy.arange(len(data),dtype='i')%1022 != 0
-    #print "not idx",data[~idx]
-    data = data[idx]
-    assert len(data) == 16384
+    data = numpy.asarray(data)[...,_DATA_INDEX]
+    assert data.shape[-1] == 16384
+    if data.dtype.itemsize < 4:
+        data = numpy.asarray(data, 'int32')
 
     # Logarithmic decompression
-    base = 10000
-    idx = data <= -base
-    power = numpy.floor(-data[idx]/base)
-    data[idx] = numpy.asarray(((-data[idx])%base)*10**power, data.dtype)
+    _expand_counts(data)
 
     # Recast as 128x128 array
-    data.resize(128,128)
-    return data
+    return data.reshape(data.shape[:-1]+(128,128))
+
+def _expand_counts(data):
+    """
+    Logarithmic decompression of the detector values, done in place.
+    """
+    base = 10000
+    idx = data <= -base
+    value = -data[idx]
+    data[idx] = numpy.asarray((value%base)*10**(value//base), data.dtype)
 
 def compress(data):
     """
@@ -463,6 +589,24 @@ def test():
     data, metadata = readNCNRData(example("sans","SILIC002.SA3_SRK_S102"))
     assert int(metadata['run.detcnt']) == 119610
     assert numpy.sum(data) == int(metadata['run.detcnt'])
+    lazy, header = load(example("sans","SILIC002.SA3_SRK_S102"), lazy=True)
+    assert header == metadata and not lazy.loaded
+    assert (lazy() == data).all() and lazy.loaded
+    H = read_headers([example("sans","SILIC002.SA3_SRK_S102")]*2)
+    assert H.shape == (2,)
+    for k in INFO.fields:
+        if k in INFO.reals:
+            assert H[k][1] == numpy.float32(metadata[k]), k
+        elif k in INFO.strings:
+            # numpy drops trailing NULs from fixed width strings
+            assert H[k][1] == metadata[k].rstrip('\0'), k
+        elif k != 'run.datetime':
+            assert H[k][1] == metadata[k], k
+    counts, headers = load_many([example("sans","SILIC001.SA3_SRK_S101"),
+                                 example("sans","SILIC002.SA3_SRK_S102")])
+    assert counts.shape == (2,128,128)
+    assert (counts[1] == data).all()
+    assert headers['run.detcnt'][1] == H['run.detcnt'][0]
     mask = readNCNRMask(example("sans","DEFAULT.MASK"))
     assert mask.shape == (128,128)
     assert mask[0,0] == 1
@@ -473,6 +617,13 @@ def test():
     target = 0.702753245830536
     assert abs(div[-1,-1] - target) <= 2e-15
 
+    # Check the bulk VAX conversion against the scalar version
+    values = numpy.array([0., 1., -2.5, 119610., 1e-30, 3.25e30], 'f')
+    vax = R4_IEEE2VAX_array(values).tostring()
+    assert vax[8:12] == R4_IEEE2VAX(-2.5)
+    assert (R4_VAX2IEEE_array(vax) == values).all()
+    assert [R4_VAX2IEEE(vax[i:i+4]) for i in range(0,len(vax),4)] == list(values)
+
 def test_defaults():
     # Make sure every type has a default
     dict((k,INFO.default_value(k)) for k in INFO.fields)
@@ -2,10 +2,9 @@ import os
 import numpy
 
 from . import sansformat
-from . import jsonutil
 from .utils import template
 from .utils import format_timestamp
-from .write_nexus import write_nexus, main_driver
+from .write_nexus import write_nexus, load_layout, main_driver
 
 _SANS_TO_NICE = {
     'fname.filename': 'trajectory.filename', #   2  filename
@@ -128,7 +127,7 @@ def convert(infile, outfile=None):
     """
     counts, header = sansformat.readNCNRData(infile)
     nicedata = ncnr_sans_to_nice(counts, header)
-    nexus_layout = jsonutil.relaxed_load(template("sansnxs.json"))
+    nexus_layout = load_layout(template("sansnxs.json"))
     #import pprint; pprint.pprint(nexus_layout)
     if not outfile:
         outfile = os.path.basename(os.path.splitext(infile)[0]) + ":entry"
@@ -10,6 +10,7 @@ import numpy as np
 import math
 import jsonutil
 import demjson
+import fileio
 #from demjson import OrderedDict
 
 try:
@@ -158,7 +159,7 @@ def load(filename):
     """
     Load a NICE trajectory from a file.
     """
-    with open(filename,"rt") as fid:
+    with fileio.open(filename) as fid:
         raw = fid.read()
     return parse(raw)
 
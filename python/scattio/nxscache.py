@@ -0,0 +1,148 @@
+"""
+Cache of converted NeXus files.
+
+Converting a raw data file to NeXus requires parsing the file and
+building the NeXus tree, which is repeated every time a reduction
+session reloads a run.  :class:`ConversionCache` keeps the converted
+files in a directory, keyed by the path, size and modification time of
+the raw file and the name and version of the converter, so that a
+repeated load only reads the HDF-5 file back into an in-memory
+:mod:`memnexus` tree.
+
+The cache can be shared by several processes.  Entries are written to a
+temporary file and renamed into place, so readers never see a partial
+file, and readers mark entries as used by updating their modification
+time.  When the total size exceeds *max_bytes*, the least recently used
+entries are removed.
+"""
+__all__ = ["ConversionCache"]
+
+import os
+import time
+import errno
+import hashlib
+import tempfile
+
+from . import fileio
+from . import h5nexus
+from . import memnexus
+
+# Default cache size: 1 GiB
+MAX_BYTES = 2**30
+# Cached files are written often, so favour speed over size
+COMPRESSION = h5nexus.CompressionPolicy(1)
+# Age in seconds after which temporary files are considered abandoned
+STALE_TEMP = 3600
+
+class ConversionCache(object):
+    """
+    Cache of converted NeXus files in *directory*.
+
+    The directory is created if it does not exist.  The least recently
+    used files are removed when the total size exceeds *max_bytes*.
+    """
+    def __init__(self, directory, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key(self, path, name, version):
+        """
+        Return the cache file name for converting *path* using converter
+        *name* at *version*.
+        """
+        st = fileio.stat(path)
+        ident = repr((os.path.abspath(path), st.st_size, st.st_mtime,
+                      name, version))
+        digest = hashlib.sha1(ident).hexdigest()[:20]
+        return "%s-%s.nxs"%(os.path.basename(path), digest)
+
+    def load(self, path, convert, name, version):
+        """
+        Return the NeXus tree for *path*.
+
+        The cached file is read into a :class:`memnexus.File` if it
+        exists.  Otherwise *convert(path)* is called, and its result
+        returned after it has been saved to the cache.  Either way the
+        tree is writable, does not need to be closed, and records the
+        cached file as its *file_name*.
+        """
+        target = os.path.join(self.directory, self.key(path, name, version))
+        if os.path.exists(target):
+            try:
+                root = memnexus.load(target)
+            except IOError:
+                pass # evicted or unreadable; convert it again
+            else:
+                try:
+                    os.utime(target, None)
+                except OSError:
+                    pass
+                return root
+        root = convert(path)
+        if hasattr(root, 'save'):
+            if self.store(root, target):
+                # Match the tree that is read back from the cache
+                root.filename = root.attrs['file_name'] = target
+            self.evict()
+        return root
+
+    def store(self, root, target):
+        """
+        Save the in-memory NeXus tree *root* as *target*.
+
+        Returns True if the file was saved.
+        """
+        try:
+            os.makedirs(self.directory)
+        except OSError, exc:
+            if exc.errno != errno.EEXIST: raise
+        fd, temp = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        os.close(fd)
+        try:
+            root.save(temp, compression=COMPRESSION, file_name=target)
+            os.rename(temp, target)
+        except Exception:
+            # Another process may have stored it first (rename can't
+            # replace a file on windows); either way, drop our copy.
+            try: os.remove(temp)
+            except OSError: pass
+            return False
+        return True
+
+    def evict(self, max_bytes=None):
+        """
+        Remove the least recently used files until the cache is smaller
+        than *max_bytes*, which defaults to the cache size.  Temporary
+        files abandoned by failed writers are also removed.
+        """
+        if max_bytes is None: max_bytes = self.max_bytes
+        if not os.path.isdir(self.directory): return
+        entries, total = [], 0
+        now = time.time()
+        for f in os.listdir(self.directory):
+            path = os.path.join(self.directory, f)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue # removed by another process
+            if f.endswith(".tmp"):
+                if now - st.st_mtime > STALE_TEMP: _remove(path)
+            elif f.endswith(".nxs"):
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= max_bytes: break
+            _remove(path)
+            total -= size
+
+    def clear(self):
+        """
+        Remove all files from the cache.
+        """
+        self.evict(max_bytes=0)
+
+def _remove(path):
+    # Files may be removed by another process or be open on windows
+    try: os.remove(path)
+    except OSError: pass
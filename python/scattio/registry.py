@@ -106,19 +106,56 @@ filename.  For example::
 This could be used, for example, to present the list of available formats
 returned by registry.formats to the user, and have them choose which
 format to use, or None for the default based on file extension.
+
+Loaders can also register a cheap test of the file contents, so that
+loaders which cannot read the file are not tried first::
+
+    >>> def cx_sniff(head, size): return head.startswith('CX')
+    >>> registry.sniff(cx1, cx_sniff)
+
+The sniff function is called with the first few kilobytes of the file
+(decompressed if the file is compressed) and the size of the file after
+decompression, or None if it is not recorded in the compressed file, and
+returns True if the file is in the loader format and False if it is
+not.  Loaders are tried in the order matched, not tested, rejected,
+keeping the extension order within each group.  registry.choose
+returns the candidate loaders in the order they will be tried, along
+with the reason for their position::
+
+    >>> print registry.choose('hello.cx')
+    [ (cx1, 'sniff matched'), (cx2, 'no sniff'), (cx3, 'no sniff') ]
+
+After a successful load, the loader and the reason it was chosen are
+available in registry.last_choice.
 """
 
+import os
+import re
+import zlib
 import fnmatch
 
+from . import fileio
+
+# Number of bytes given to the sniff functions
+SNIFF_BYTES = 4096
+# Number of extensions to remember in lookup
+MEMO_SIZE = 10000
+
 class ExtensionRegistry(object):
     """
     Associate file loaders with file extensions.
     """
     def __init__(self):
         self.loaders = {}
+        self.sniffers = {}
+        self.last_choice = None
+        self._order = [] # registration order, for ties in lookup
+        self._matcher = None
 
     def __setitem__(self, ext, loader):
+        if ext not in self.loaders: self._order.append(ext)
         self.loaders.setdefault(ext,[]).append(loader)
+        self._matcher = None
 
     def __getitem__(self, ext):
         return self.loaders[ext]
@@ -126,6 +163,13 @@ class ExtensionRegistry(object):
     def __contains__(self, ext):
         return ext in self.loaders
 
+    def sniff(self, loader, sniff):
+        """
+        Register *sniff(head, size)* to test if a file can be read by
+        *loader*.
+        """
+        self.sniffers[loader] = sniff
+
     def formats(self):
         """
         Return a sorted list of the registered formats.
@@ -148,55 +192,137 @@ class ExtensionRegistry(object):
         """
         Return the loaders associated with the file name.
 
+        Loaders for longer extensions come first, with extensions of the
+        same length in the order they were registered.
+
         Raises ValueError if file type is not known.
         """
-        # Find matching extensions
-        extlist = [ext for ext in self.extensions()
-                   if fnmatch.fnmatch(path, '*'+ext)]
-
-        # Sort matching extensions by decreasing order of length
-        extlist.sort(lambda a,b: len(a)<len(b))
-
-        # Combine loaders for matching extensions into one big list
-        loaders = []
-        for L in [self.loaders[ext] for ext in extlist]:
-            loaders.extend(L)
-
-        # Remove duplicates if they exist
-        if len(loaders) != len(set(loaders)):
-            result = []
-            for L in loaders:
-                if L not in result: result.append(L)
-            loaders = result
+        if self._matcher is None: self._compile()
+        dotted, other, memo = self._matcher
+
+        # Extensions starting with '.' can only match the part of the
+        # file name from its first '.', so remember the matches for it.
+        name = os.path.normcase(os.path.basename(path))
+        dot = name.find('.')
+        suffix = name[dot:] if dot >= 0 else ''
+        matches = memo.get(suffix, None)
+        if matches is None:
+            if len(memo) >= MEMO_SIZE: memo.clear()
+            extlist = [(rank,ext) for rank,ext,match in dotted if match(suffix)]
+            matches = memo[suffix] = (extlist, self._combine(extlist))
+
+        # Other patterns can match anywhere in the path
+        extlist, loaders = matches
+        if other:
+            normpath = os.path.normcase(path)
+            extra = [(rank,ext) for rank,ext,match in other if match(normpath)]
+            if extra:
+                loaders = self._combine(sorted(extlist+extra))
 
         # Raise an error if there are no matching extensions
         if len(loaders) == 0:
             raise ValueError, "Unknown file type for "+path
 
         # All done
+        return loaders[:]
+
+    def _compile(self):
+        """
+        Precompile the extension patterns in lookup order.
+        """
+        exts = [a for a in self._order if a.startswith('.') or "*" in a]
+        # Sort is stable, so ties stay in registration order
+        exts.sort(key=len, reverse=True)
+        dotted, other = [], []
+        for rank,ext in enumerate(exts):
+            regex = fnmatch.translate(os.path.normcase('*'+ext))
+            target = dotted if ext.startswith('.') else other
+            target.append((rank, ext, re.compile(regex).match))
+        self._matcher = dotted, other, {}
+
+    def _combine(self, extlist):
+        """
+        Combine loaders for the ranked extensions into one list, without
+        duplicates.
+        """
+        loaders, seen = [], set()
+        for _,ext in extlist:
+            for L in self.loaders[ext]:
+                if L not in seen:
+                    seen.add(L)
+                    loaders.append(L)
         return loaders
 
+    def choose(self, path, format=None):
+        """
+        Return the list of (loader, reason) for the loaders to try on
+        *path*, in the order they should be tried.
+
+        The loaders matching the extension, or the loaders for *format*,
+        are ranked by their sniff functions.  The file is read once to
+        provide the sniffers with the first SNIFF_BYTES of the file.
+        """
+        if format is None:
+            loaders = self.lookup(path)
+        else:
+            loaders = self.loaders[format]
+        if not any(fn in self.sniffers for fn in loaders):
+            return [(fn, 'no sniff') for fn in loaders]
+
+        head, size = _read_head(path)
+        matched, untested, rejected = [], [], []
+        for fn in loaders:
+            sniff = self.sniffers.get(fn, None)
+            if sniff is None or head is None:
+                untested.append((fn, 'no sniff'))
+                continue
+            try:
+                result = sniff(head, size)
+            except Exception, exc:
+                untested.append((fn, 'sniff failed: %s'%exc))
+                continue
+            if result:
+                matched.append((fn, 'sniff matched'))
+            else:
+                rejected.append((fn, 'sniff rejected'))
+        return matched + untested + rejected
+
     def load(self, path, format=None):
         """
         Try loading all datasets from the given path.  If no format is
         specified, try all formats which match the path extension.
+        Loaders are tried in the order given by :meth:`choose`, and the
+        successful (loader, reason) is stored in *last_choice*.
 
         Raises ValueError if no loader is available
         Raises KeyError if format is not available.
         Raises a loader-defined exception if all loaders fails.
         """
-        if format is None:
-            loaders = self.lookup(path)
-        else:
-            loaders = self.loaders[format]
-        for fn in loaders:
+        for fn, reason in self.choose(path, format=format):
             try:
-                return fn(path)
+                result = fn(path)
             except:
                 pass # give other loaders a chance to succeed
+            else:
+                self.last_choice = (fn, reason)
+                return result
         # If we get here it is because all loaders failed
         raise # reraises last exception
 
+def _read_head(path):
+    """
+    Return the first SNIFF_BYTES of the file and the file size, or
+    (None, None) if the file can't be read.  Compressed files are not
+    decompressed in full to find their size, which is None if the file
+    does not record it.
+    """
+    try:
+        head = fileio.head(path, SNIFF_BYTES)
+        size = fileio.getsize(path, decompress=False)
+    except (IOError, OSError, EOFError, zlib.error):
+        return None, None
+    return head, size
+
 def test():
     reg = ExtensionRegistry()
     class CxError(Exception): pass
@@ -241,4 +367,40 @@ def test():
     assert reg.load('hello.gz') == 'gunzip'
     assert reg.load('hello.cx1.gz') == 'gunzip' # Since .cx1.gz fails
 
+    # Sniffing the file contents
+    import tempfile
+    def cx_sniff(head, size): return head.startswith('CX')
+    def new_cx_sniff(head, size): return size > 100
+    reg.sniff(cx, cx_sniff)
+    reg.sniff(new_cx, new_cx_sniff)
+    fid, path = tempfile.mkstemp(suffix='.cx')
+    try:
+        os.write(fid, 'NEW CX')
+        os.close(fid)
+        assert reg.choose(path) == [(cx, 'sniff rejected'),
+                                    (new_cx, 'sniff rejected')]
+        with open(path, 'wb') as fid: fid.write('CX'+' '*100)
+        assert reg.choose(path) == [(cx, 'sniff matched'),
+                                    (new_cx, 'sniff matched')]
+        with open(path, 'wb') as fid: fid.write(' '*200)
+        assert reg.load(path) == 'new_cx'
+        assert reg.last_choice == (new_cx, 'sniff matched')
+        import gzip
+        with gzip.open(path, 'wb') as fid: fid.write('CX')
+        assert reg.choose(path)[0] == (cx, 'sniff matched')
+    finally:
+        os.remove(path)
+    assert reg.choose('missing.cx') == [(cx, 'no sniff'), (new_cx, 'no sniff')]
+
+    # Longest extensions first, registration order for ties
+    assert reg.lookup('hello.cx1.gz') == [fail_cx, gunzip]
+    assert reg.lookup('dir.d/hello.cx.gz') == [new_cx, gunzip]
+    reg['.c?'] = gunzip
+    reg['.SA[123]*'] = cat
+    reg['*xyz*'] = cat
+    assert reg.lookup('hello.cx') == [cx, new_cx, gunzip]
+    assert reg.lookup('hello.cx') == [cx, new_cx, gunzip] # memoized
+    assert reg.lookup('SILIC001.SA3_SRK_S101') == [cat]
+    assert reg.lookup('xyz.cx') == [cat, cx, new_cx, gunzip]
+
 if __name__ == "__main__": test()
@@ -3,8 +3,16 @@ from __future__ import division
 
 import numpy
 
+from . import fileio
+
+def sniff(head, size):
+    """
+    Return True if the start of the file *head* has the Rigaku RAS marker.
+    """
+    return head.startswith("*RAS_DATA_START")
+
 def load(filename):
-    with open(filename, 'rb') as fid:
+    with fileio.open(filename) as fid:
         data = fid.read()
     try:
         return loads(data)
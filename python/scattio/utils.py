@@ -5,6 +5,13 @@ import os
 import time
 import datetime
 import struct
+import weakref
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordered_dict import OrderedDict
+
+import numpy
 
 def field_label(name,units):
     """
@@ -46,6 +53,101 @@ def format_timestamp(t):
     offset = "%02d:%02d"%(abs(dt)//3600,(abs(dt)%3600)//60)
     return local+sign+offset
 
+# Default size of the shared detector counts cache: 256 MiB
+COUNTS_CACHE_BYTES = 2**28
+
+class CountsCache(object):
+    """
+    Strong references to the most recently used detector count arrays.
+
+    Arrays are dropped in least recently used order once their total size
+    exceeds *max_bytes*.  The most recent array is always kept, even if it
+    is larger than *max_bytes*.
+    """
+    def __init__(self, max_bytes=COUNTS_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._arrays = OrderedDict()
+
+    def __len__(self):
+        return len(self._arrays)
+
+    def __contains__(self, counts):
+        return id(counts) in self._arrays
+
+    def add(self, counts):
+        """
+        Add *counts* to the cache, or mark it as the most recently used.
+        """
+        key = id(counts)
+        if key in self._arrays:
+            del self._arrays[key]
+        else:
+            self.nbytes += counts.nbytes
+        self._arrays[key] = counts
+        self._evict(self.max_bytes, keep=1)
+
+    def discard(self, counts):
+        """
+        Remove *counts* from the cache if it is there.
+        """
+        counts = self._arrays.pop(id(counts), None)
+        if counts is not None:
+            self.nbytes -= counts.nbytes
+
+    def shrink(self, max_bytes=0):
+        """
+        Drop the least recently used arrays until the cache is no larger
+        than *max_bytes*.  Call *shrink()* to empty the cache when memory
+        is low.
+        """
+        self._evict(max_bytes, keep=0)
+
+    def _evict(self, max_bytes, keep):
+        while self.nbytes > max_bytes and len(self._arrays) > keep:
+            _, counts = self._arrays.popitem(last=False)
+            self.nbytes -= counts.nbytes
+
+COUNTS_CACHE = CountsCache()
+
+class LazyCounts(object):
+    """
+    Detector counts which are loaded from the file when first used.
+
+    Call the object to get the counts array.  The array is returned by
+    *loadcounts()* and held by weak reference, with a strong reference in
+    *cache* (default :data:`COUNTS_CACHE`), so that the counts for many
+    files can be browsed without keeping them all in memory.  Once the
+    cache drops the array and nothing else refers to it, the next call
+    loads it again.
+    """
+    def __init__(self, loadcounts, cache=None):
+        self.loadcounts = loadcounts
+        self.cache = cache if cache is not None else COUNTS_CACHE
+        self._ref = None
+
+    def __call__(self):
+        counts = self._ref() if self._ref is not None else None
+        if counts is None:
+            counts = self.loadcounts()
+            self._ref = weakref.ref(counts)
+        self.cache.add(counts)
+        return counts
+
+    @property
+    def loaded(self):
+        """True if the counts are in memory."""
+        return self._ref is not None and self._ref() is not None
+
+    def drop(self):
+        """
+        Release the counts.  They are loaded again on the next call.
+        """
+        counts = self._ref() if self._ref is not None else None
+        if counts is not None:
+            self.cache.discard(counts)
+        self._ref = None
+
 # From: www.mpp.mpg.de/~huber/VMSSIG/src/C/lib_routines/VAX-IEEE-FLOAT.C
 # X-VMS-News: vax3 comp.os.vms:1034
 # From: woods@ncar.ucar.edu (Greg Woods)
@@ -82,3 +184,33 @@ def R4_IEEE2VAX(value):
         return "\0\0\0\0"
     else:
         return "".join((ieee[2], chr(ord(ieee[3])+1),ieee[0],ieee[1]))
+
+def R4_VAX2IEEE_array(vax):
+    """
+    Convert a block of VAX REAL*4 values into an array of IEEE float32.
+
+    *vax* is a string of 4*n bytes, or an array of n little endian uint32
+    words as they appear in the file.  This is the vectorized equivalent
+    of :func:`R4_VAX2IEEE`: the 16-bit halves of each word are swapped and
+    the exponent is reduced by two (one in the high byte) for nonzero
+    exponents.
+    """
+    if isinstance(vax, str):
+        word = numpy.frombuffer(vax, '<u4')
+    else:
+        word = numpy.ascontiguousarray(vax).view('<u4')
+    ieee = (word >> 16) | (word << 16)
+    ieee -= numpy.where(ieee & 0xFF000000, 0x01000000, 0).astype('<u4')
+    return ieee.view('<f4')
+
+def R4_IEEE2VAX_array(value):
+    """
+    Convert an array of floating point values to VAX REAL*4 words.
+
+    Returns an array of little endian uint32 words with the same shape as
+    *value*; use *.tostring()* to get the bytes to write to the file.  This
+    is the vectorized equivalent of :func:`R4_IEEE2VAX`.
+    """
+    ieee = numpy.asarray(value, '<f4').view('<u4')
+    vax = ieee + numpy.where(ieee != 0, 0x01000000, 0).astype('<u4')
+    return (vax >> 16) | (vax << 16)
@@ -2,125 +2,482 @@
 Internal helper module which converts a dataset to nexus.
 """
 
+import os
 import re
+import sys
+import time
+import shutil
+import tempfile
+import traceback
 
 import numpy
 
 import h5nexus
+from h5nexus import h5
 
+from . import jsonutil
 from .utils import field_label
 
-def main_driver(convert):
-    import sys
-    if len(sys.argv) < 2:
-        print >>sys.stderr, "usage: %s [-o pattern] file..."
+# Directory for staging files when converting in a batch worker process
+_STAGING_DIR = None
+
+# Compiled layouts indexed by template path, with the template mtime
+_LAYOUT_CACHE = {}
+
+# Default compression policy for converted files
+COMPRESSION = h5nexus.CompressionPolicy(1)
+
+# Time spent in each phase of the most recent write_nexus call
+last_timing = {}
+
+def main_driver(convert, report=None):
+    """
+    Command line driver for the converters.
+
+    Usage::
+
+        python -m scattio.ncnr.zzznxs [-j jobs] [-o pattern] file...
+
+    See :func:`batch_convert` for details, including *report*.
+    """
+    args = sys.argv[1:]
+    outfile, jobs = None, 1
+    while len(args) > 1 and args[0] in ('-o', '-j'):
+        if args[0] == '-o':
+            outfile = args[1]
+        else:
+            jobs = int(args[1])
+        args = args[2:]
+    if not args:
+        print >>sys.stderr, "usage: %s [-j jobs] [-o pattern] file..."%sys.argv[0]
         sys.exit(1)
-    if sys.argv[1] == '-o':
-        outfile = sys.argv[2]
-        infiles = sys.argv[3:]
+    failed = batch_convert(convert, args, outfile, jobs=jobs, report=report)
+    sys.exit(1 if failed else 0)
+
+def batch_convert(convert, infiles, outfile=None, jobs=1, log=sys.stderr,
+                  report=None):
+    """
+    Convert a set of files, reporting the time for each file to *log*.
+
+    *convert(infile, outfile)* is the converter function.  *outfile* is
+    the "path:entry" pattern for the output; if several input files
+    expand to the same path, then each becomes a separate entry in that
+    file.
+
+    With *jobs* greater than one, the files are converted by a pool of
+    worker processes.  Each worker writes to a private staging file and
+    the entries are copied to the output files by this process, so that
+    no output file is ever opened by two processes at once.
+
+    Failures are reported without stopping the batch.  Returns the list
+    of input files which failed.
+
+    *report()* is called after each file in the process which converted
+    it, and returns a list of notes about the conversion, such as values
+    which were corrected.  The notes are written to *log* together at the
+    end of the batch, with the number of files for repeated notes.  It
+    must be a module level function so that it can be sent to the worker
+    processes.
+    """
+    tasks = [(convert, infile, outfile, report) for infile in infiles]
+    failed, notes = [], {}
+    start = time.time()
+    if jobs > 1:
+        import multiprocessing
+        staging = tempfile.mkdtemp(prefix="nxsbatch")
+        pool = multiprocessing.Pool(jobs, _init_worker, (staging,))
+        results = pool.imap_unordered(_convert_one, tasks)
     else:
-        outfile = None
-        infiles = sys.argv[1:]
-    for infile in infiles:
-        convert(infile, outfile)
+        staging = pool = None
+        results = (_convert_one(task) for task in tasks)
+    try:
+        for (infile, staged, target, entries, elapsed, timing, error,
+             file_notes) in results:
+            for note in file_notes:
+                notes[note] = notes.get(note, 0) + 1
+            if error is None and staged is not None:
+                try:
+                    _merge_entries(staged, target, entries)
+                except Exception:
+                    error = traceback.format_exc()
+            if error is None:
+                phases = ", ".join("%s %.3f"%(k,v)
+                                   for k,v in sorted(timing.items()))
+                print >>log, "%7.2f s  %s -> %s (%s)"%(elapsed, infile,
+                                                       target, phases)
+            else:
+                failed.append(infile)
+                print >>log, "%7.2f s  %s failed\n%s"%(elapsed, infile, error)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if staging is not None:
+            shutil.rmtree(staging, ignore_errors=True)
+    for note, count in sorted(notes.items()):
+        print >>log, note + (" (%d files)"%count if count > 1 else "")
+    print >>log, "%d converted, %d failed in %.2f s" % (
+        len(infiles)-len(failed), len(failed), time.time()-start)
+    return failed
+
+def _init_worker(staging):
+    global _STAGING_DIR
+    _STAGING_DIR = staging
+
+def _convert_one(task):
+    """
+    Convert one file, returning the staging file and output target.
+    """
+    convert, infile, outfile, report = task
+    start = time.time()
+    try:
+        root = convert(infile, outfile)
+        entries = list(root.keys())
+        target = root.attrs['file_name']
+        staged = root.filename if _STAGING_DIR is not None else None
+        root.close()
+        elapsed = time.time()-start
+        timing = dict(last_timing, read=elapsed-sum(last_timing.values()))
+        result = infile, staged, target, entries, elapsed, timing, None
+    except Exception:
+        result = (infile, None, None, None, time.time()-start, None,
+                  traceback.format_exc())
+    notes = report() if report is not None else []
+    return result + (notes,)
+
+def _merge_entries(staged, target, entries):
+    """
+    Copy entries from a staging file to the target file.
+    """
+    source = h5nexus.open(staged, mode="r")
+    try:
+        root = h5nexus.open(target, mode="a", creator="ncnrconvert")
+        try:
+            for entry in entries:
+                source.copy(source[entry], root, name=entry)
+        finally:
+            root.close()
+    finally:
+        source.close()
+        os.remove(staged)
+
+def write_nexus(outfile, data, nexus_layout, compression=None):
+    """
+    Write *data* to the NeXus file *outfile* using *nexus_layout*.
 
-def write_nexus(outfile, data, nexus_layout):
+    The layout is either a layout tree as loaded from the json template
+    or a list of operations as returned by :func:`compile_layout`.
+
+    The entire entry is planned before the file is opened, then the
+    groups, fields, attributes and links are written in turn using the
+    low level h5py interface.  Fields are compressed according to the
+    :class:`h5nexus.CompressionPolicy` *compression*, or the module
+    default :data:`COMPRESSION`.  The time for each phase is stored in
+    :data:`last_timing`.
+
+    If *outfile* has no file path, as in ":entry", the entry is built
+    in an in-memory :mod:`memnexus` tree instead of an HDF-5 file, and
+    the fields are not compressed.
+    """
+    global last_timing
+    timing = {}
+    start = time.time()
+    if isinstance(nexus_layout, dict):
+        nexus_layout = compile_layout(nexus_layout)
+    policy = compression if compression is not None else COMPRESSION
     outfile = _expand_pattern(outfile, data)
     #print "outfile",outfile
     
     # create filename from scanid
     creator = "ncnrconvert"
     path,entryname = outfile.split(':')
-    if path:
-        root = h5nexus.open(path+".nxs", mode="a", creator=creator)
-    else:
-        root = h5nexus.open(None, mode="mem", creator=creator)
-    entry = h5nexus.group(root, entryname, 'NXentry')
-    das = _make_daslogs(entry, data)
-    _make_group(das, entry, nexus_layout, data)
+    objects, links = _plan_entry(entryname, nexus_layout, data)
+    timing['plan'] = time.time() - start
+
+    start = time.time()
+    root = staged = None
+    if path and _STAGING_DIR is not None:
+        # Batch worker: stage the entry for the writer process to merge
+        fd,staged = tempfile.mkstemp(suffix=".nxs", dir=_STAGING_DIR)
+        os.close(fd)
+    try:
+        if staged is not None:
+            root = h5nexus.open(staged, mode="w", creator=creator)
+            root.attrs['file_name'] = path+".nxs"
+        elif path:
+            root = h5nexus.open(path+".nxs", mode="a", creator=creator)
+        else:
+            root = h5nexus.open(None, mode="tree", creator=creator)
+        timing['open'] = time.time() - start
+        if isinstance(root, h5.File):
+            _write_entry(root, objects, links, policy, timing)
+        else:
+            _write_tree(root, objects, links, timing)
+    except:
+        # Don't leave the file open or the partial entry staged
+        if root is not None: root.close()
+        if staged is not None: os.remove(staged)
+        raise
+    last_timing = timing
     return root
 
-def _expand_pattern(pattern, data):
+def load_layout(path):
     """
-    substitute into scanid to create output file entry.
-    
-    Uses the same pattern format as the NICE trajectory  code.
+    Load and compile the NeXus layout template in *path*.
+
+    The compiled layout is cached, and reused until the template file
+    is modified.
     """
-    parts = re.split(r'<(.*?)>', pattern)
-    missing = [pi for i,pi in enumerate(parts)
-               if i%2==1 and pi not in data]
-    if missing:
-        raise IOError("Filename pattern substitution for %r cannot resolve %s"
-                      % (pattern,", ".join(missing)))
-    subst = [(pi if i%2==0 else str(data[pi]['value'])) 
-             for i,pi in enumerate(parts)]
-    return "".join(subst)
+    mtime = os.path.getmtime(path)
+    cached = _LAYOUT_CACHE.get(path, None)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    layout = compile_layout(jsonutil.relaxed_load(path))
+    _LAYOUT_CACHE[path] = (mtime, layout)
+    return layout
 
-def _make_daslogs(path, data):
-    daslogs = h5nexus.group(path, "DASlogs", "NXcollection")
-    for k,v in data.items():
-        #print "make_daslogs",k
-        groupname,fieldname = k.split('.')
-        try:
-            group = daslogs[groupname]
-        except KeyError:
-            group = h5nexus.group(daslogs, groupname, "NXcollection")
-        
-        _make_field(group, fieldname, v)
-    return daslogs
-        
-def _make_group(das, path, config, data):
-    #print "group",path,config
+def compile_layout(config, parent=""):
+    """
+    Convert a NeXus layout tree into a flat list of operations.
+
+    Each operation is a tuple *(op, parent, name, arg)*, where *parent*
+    is the path of the containing group relative to the entry and *op*
+    is one of:
+
+        group
+            create group *name* with NeXus class *arg*
+        field
+            create field *name* from the (*value*, *kw*) pair *arg*
+            returned by :func:`_field_args`
+        link
+            link *name* to the DAS log field *arg*
+        data
+            create field *name* from the data column *arg*
+
+    Groups are always created before their contents.
+    """
+    ops = []
     for k,v in config.items():
-        #print "config",k,v
         if "$NX" in k:
             # subgroup name(NXclass)
             name, nxclass = k.split('$')
-            # Create the DAS entry for the sensor
-            p = h5nexus.group(path, name, nxclass)
-            _make_group(das, p, v, data)
+            path = parent+"/"+name if parent else name
+            ops.append(('group', parent, name, nxclass))
+            ops.extend(compile_layout(v, path))
         elif isinstance(v, dict):
             # numeric value and units
-            _make_field(path, k, v)
+            ops.append(('field', parent, k, _field_args(parent, k, v)))
         elif isinstance(v, list):
             # array of floats
-            _make_field(path, k, {'value': numpy.asarray(v), 
-                                  'units': ''})
+            conf = {'value': numpy.asarray(v), 'units': ''}
+            ops.append(('field', parent, k, _field_args(parent, k, conf)))
         elif v.startswith('->'):
             # link to data column (turns into immediate value)
-            source = v[2:].replace('.','/')
-            target = "/".join((path.name,k))
-            #print "linking",source,"->",target
-            try:
-                p = h5nexus.link(das[source], target)
-            except KeyError:
-                print KeyError("Could not link %r to %r"%(target,source))
-                continue
-
-
+            ops.append(('link', parent, k, v[2:].replace('.','/')))
         elif v.startswith('$'):
             # immediate value from data column
-            key = v[1:]
-            if key in data:
-                _make_field(path, k, data[key])
-            else:
-                print "field %r not found in data"%key
-                continue
+            ops.append(('data', parent, k, v[1:]))
         else:
             try:
                 # Check for "value units"
                 valuestr,units = v.split(' ')
-                field = {'value': float(valuestr), 'units': units}
+                conf = {'value': float(valuestr), 'units': units}
             except:
                 try:
                     # Check for number
-                    field = {'value': float(v), 'units': None}
+                    conf = {'value': float(v), 'units': None}
                 except:
                     # Otherwise string
-                    field = {'value': v, 'type':'|S'}
-            _make_field(path, k, field)
+                    conf = {'value': v, 'type':'|S'}
+            ops.append(('field', parent, k, _field_args(parent, k, conf)))
+    return ops
+
+def _expand_pattern(pattern, data):
+    """
+    substitute into scanid to create output file entry.
+    
+    Uses the same pattern format as the NICE trajectory  code.
+    """
+    parts = re.split(r'<(.*?)>', pattern)
+    missing = [pi for i,pi in enumerate(parts)
+               if i%2==1 and pi not in data]
+    if missing:
+        raise IOError("Filename pattern substitution for %r cannot resolve %s"
+                      % (pattern,", ".join(missing)))
+    subst = [(pi if i%2==0 else str(data[pi]['value'])) 
+             for i,pi in enumerate(parts)]
+    return "".join(subst)
+
+def _plan_entry(entryname, layout, data):
+    """
+    Resolve the layout against the data.
+
+    Returns the list of objects to create, each as (path, value, attrs)
+    with value None for groups, and the list of links as (path, source).
+    """
+    entry = "/"+entryname
+    objects = [(entry, None, {'NX_class': 'NXentry'})]
+    links = []
+    # DAS log object attributes by path relative to DASlogs, for linking
+    das = {}
+    objects.append((entry+"/DASlogs", None, {'NX_class': 'NXcollection'}))
+    for k,v in data.items():
+        groupname,fieldname = k.split('.')
+        if groupname not in das:
+            das[groupname] = {'NX_class': 'NXcollection'}
+            objects.append((entry+"/DASlogs/"+groupname, None, das[groupname]))
+        field = _plan_field(entry+"/DASlogs/"+groupname, fieldname,
+                            *_field_args(groupname, fieldname, v))
+        if field is not None:
+            das[k.replace('.','/')] = field[2]
+            objects.append(field)
+
+    for op, parent, name, arg in layout:
+        path = entry+"/"+parent if parent else entry
+        if op == 'group':
+            objects.append((path+"/"+name, None, {'NX_class': arg}))
+        elif op == 'field':
+            field = _plan_field(path, name, *arg)
+            if field is not None: objects.append(field)
+        elif op == 'link':
+            target = path+"/"+name
+            #print "linking",arg,"->",target
+            if arg in das:
+                das[arg].setdefault('target', entry+"/DASlogs/"+arg)
+                links.append((target, entry+"/DASlogs/"+arg))
+            else:
+                print KeyError("Could not link %r to %r"%(target,arg))
+        elif arg in data: # op == 'data'
+            field = _plan_field(path, name, *_field_args(path, name, data[arg]))
+            if field is not None: objects.append(field)
+        else:
+            print "field %r not found in data"%arg
+    return objects, links
+
+_NON_ASCII = re.compile(u'[^\x00-\x7f]')
+def _plan_field(path, name, value, kw):
+    """
+    Return (path, value, attrs) for a field, or None if it is empty.
+    """
+    target = path+"/"+name
+    if value.size == 0:
+        return None
+    units, label = kw['units'], kw['label']
+    if value.dtype.kind in ('u','i','f','c') and units is None:
+        raise TypeError("Units required for numeric data at %s"%target)
+    attrs = kw['attrs'].copy()
+    if units is not None:
+        attrs['units'] = units
+    if label: # not None or ""
+        attrs['long_name'] = label
+    for k,v in attrs.items():
+        if isinstance(v, basestring):
+            attrs[k] = _NON_ASCII.sub('', v)
+    return target, value, attrs
+
+def _write_entry(root, objects, links, policy, timing):
+    """
+    Write the planned entry to *root* using the low level h5py interface.
+    """
+    timing.update(groups=0., fields=0., attrs=0.)
+    ids = {}
+    for path, value, attrs in objects:
+        start = time.time()
+        parent, name = path.rsplit('/', 1)
+        loc = ids[parent] if parent else root.id
+        if value is None:
+            ids[path] = oid = h5.h5g.create(loc, name)
+            timing['groups'] += time.time() - start
+        else:
+            oid = _create_dataset(loc, name, value, policy)
+            timing['fields'] += time.time() - start
+        start = time.time()
+        _write_attrs(root, path, oid, attrs)
+        timing['attrs'] += time.time() - start
+
+    start = time.time()
+    for path, source in links:
+        try:
+            root.id.links.create_hard(path, root.id, source)
+        except RuntimeError, exc:
+            print "Could not link %r to %r: %s"%(path, source, exc)
+    timing['links'] = time.time() - start
+
+def _write_tree(root, objects, links, timing):
+    """
+    Write the planned entry to the in-memory tree *root*.
+    """
+    timing.update(groups=0., fields=0., attrs=0.)
+    for path, value, attrs in objects:
+        start = time.time()
+        if value is None:
+            node = root.create_group(path)
+            timing['groups'] += time.time() - start
+        else:
+            node = root.create_dataset(path, data=value)
+            timing['fields'] += time.time() - start
+        start = time.time()
+        node.attrs.update(attrs)
+        timing['attrs'] += time.time() - start
 
-def _make_field(path, name, conf):
+    start = time.time()
+    for path, source in links:
+        try:
+            root[path] = root[source]
+        except (KeyError, RuntimeError), exc:
+            print "Could not link %r to %r: %s"%(path, source, exc)
+    timing['links'] = time.time() - start
+
+def _create_dataset(loc, name, value, policy):
+    value = numpy.ascontiguousarray(value)
+    plist = h5.h5p.create(h5.h5p.DATASET_CREATE)
+    plist.set_fill_time(h5.h5d.FILL_TIME_NEVER)
+    opts = policy.options(value.dtype, value.shape)
+    if opts:
+        # Chunk along the first dimension as for an extensible field
+        chunks = list(h5nexus.make_chunks((None,)+value.shape[1:], value.dtype,
+                                          compression=opts['compression']))
+        chunks[0] = max(1, min(chunks[0], value.shape[0]))
+        plist.set_chunk(tuple(chunks))
+        if opts.get('shuffle', False):
+            plist.set_shuffle()
+        if opts['compression'] == 'lzf':
+            plist.set_filter(h5.h5z.FILTER_LZF, h5.h5z.FLAG_OPTIONAL)
+        else:
+            plist.set_deflate(opts.get('compression_opts', 4))
+    tid = h5.h5t.py_create(value.dtype, logical=True)
+    space = h5.h5s.create_simple(value.shape)
+    oid = h5.h5d.create(loc, name, tid, space, dcpl=plist)
+    oid.write(h5.h5s.ALL, h5.h5s.ALL, value)
+    return oid
+
+_VLEN_STR = h5.special_dtype(vlen=str)
+_VLEN_STR_TYPE = h5.h5t.py_create(_VLEN_STR, logical=True)
+def _write_attrs(root, path, oid, attrs):
+    """
+    Write the attributes of an object.
+
+    String and numeric attributes are written directly. Anything else is
+    left to h5py to convert.
+    """
+    for k,v in attrs.items():
+        k = str(k)
+        if isinstance(v, basestring):
+            if isinstance(v, unicode): v = v.encode('ascii')
+            value = numpy.array(v, dtype=_VLEN_STR)
+            tid = _VLEN_STR_TYPE
+        else:
+            value = numpy.asarray(v)
+            if value.dtype.kind not in ('b','i','u','f'):
+                root[path].attrs[k] = v
+                continue
+            tid = h5.h5t.py_create(value.dtype)
+        space = h5.h5s.create_simple(value.shape)
+        h5.h5a.create(oid, k, tid, space).write(value)
+
+def _field_args(path, name, conf):
+    """
+    Return the value and the h5nexus.field keywords for a field.
+    """
     dtype = conf.get('type',None)
     units = conf.get('units',None)
     label = conf.get('label',field_label(name,units))
@@ -142,7 +499,4 @@ def _make_field(path, name, conf):
                  for k,v in conf.items()
                  if k not in ('type','units',
                               'long_name','value','fields'))
-    h5nexus.field(path, name, data=value, units=units,
-                label=label, attrs=attrs)
-
-
+    return value, dict(units=units, label=label, attrs=attrs)